@@ -0,0 +1,328 @@
+import math
+import random
+import socket
+import threading
+import time
+from collections import deque, namedtuple
+
+from command_writer import MAX_PHASE_SECONDS
+from scheduler import PhasePlan, YELLOW_SECONDS
+
+SATURATION_FLOW = 1800.0 # Lưu lượng bão hòa mỗi hướng (xe/giờ xanh)
+LOST_TIME_PER_PHASE = 4.0 # Thời gian tổn thất mỗi pha (giây): khởi động + phần vàng không sử dụng
+MAX_FLOW_RATIO = 0.9 # Chặn tổng tỉ số lưu lượng để công thức Webster không tiến tới vô cùng khi quá tải
+MIN_WINDOW_SECONDS = 60.0 # Số giây dữ liệu tối thiểu trước khi ra quyết định
+
+# Quyết định cho một ngã tư: lưu lượng hai hướng (xe/giờ), chu kỳ Webster và thời gian xanh (giây),
+# mức bão hòa (x) của hướng tới hạn với thời gian xanh đã chọn
+Decision = namedtuple("Decision", "m1_rate m2_rate cycle green saturation")
+
+
+def webster_greens(demands, saturation_flow=SATURATION_FLOW, min_green=5, max_green=60):
+    """
+    Tính thời gian xanh cho nhiều ngã tư cùng lúc theo công thức chu kỳ tối ưu của Webster:
+    C0 = (1.5 L + 5) / (1 - Y), với L là tổng thời gian tổn thất và Y tổng tỉ số lưu lượng tới hạn.
+    Firmware chỉ có một thời gian xanh chung cho hai mạch (đỏ = xanh + 2), nên hai pha luôn dài bằng nhau;
+    khi đó mỗi pha phải phục vụ được hướng đông nhất, tức Y = 2 * max(y1, y2) thay vì y1 + y2.
+
+    Args:
+        demands (list): Các cặp (lưu lượng Mạch 1, lưu lượng Mạch 2) tính bằng xe/giờ.
+        saturation_flow (float): Lưu lượng bão hòa mỗi hướng (xe/giờ xanh).
+        min_green (int): Thời gian xanh tối thiểu (giây).
+        max_green (int): Thời gian xanh tối đa (giây).
+
+    Returns:
+        list: Các Decision theo đúng thứ tự demands.
+    """
+    lost = 2 * LOST_TIME_PER_PHASE
+    decisions = []
+    for m1_rate, m2_rate in demands:
+        critical = max(m1_rate, m2_rate) / saturation_flow
+        flow_ratio = min(2 * critical, MAX_FLOW_RATIO)
+        cycle = (1.5 * lost + 5) / (1 - flow_ratio)
+        # Chu kỳ firmware: 2 * (xanh + vàng)
+        green = min(max(int(round(cycle / 2 - YELLOW_SECONDS)), min_green), max_green)
+        effective = green + YELLOW_SECONDS - LOST_TIME_PER_PHASE
+        saturation = critical * 2 * (green + YELLOW_SECONDS) / effective if effective > 0 else math.inf
+        decisions.append(Decision(m1_rate, m2_rate, cycle, green, saturation))
+    return decisions
+
+
+class DemandWindow:
+    """
+    Cửa sổ trượt số xe đếm được của một ngã tư; lưu lượng là tổng số xe trong cửa sổ quy ra xe/giờ.
+    """
+    def __init__(self, window_seconds=300.0):
+        self.window_seconds = window_seconds
+        self.samples = deque() # (thời điểm, xe Mạch 1, xe Mạch 2)
+        self.m1_total = 0
+        self.m2_total = 0
+        self.started = None # Thời điểm nhận mẫu đầu tiên
+
+    def add(self, m1_count, m2_count, now):
+        if self.started is None:
+            self.started = now
+        self.samples.append((now, m1_count, m2_count))
+        self.m1_total += m1_count
+        self.m2_total += m2_count
+        self.expire(now)
+
+    def expire(self, now):
+        samples = self.samples
+        while samples and now - samples[0][0] > self.window_seconds:
+            _, m1_count, m2_count = samples.popleft()
+            self.m1_total -= m1_count
+            self.m2_total -= m2_count
+
+    def rates(self, now):
+        """
+        Returns:
+            tuple: (xe/giờ Mạch 1, xe/giờ Mạch 2), hoặc None khi chưa đủ MIN_WINDOW_SECONDS dữ liệu.
+        """
+        if self.started is None or now - self.started < MIN_WINDOW_SECONDS:
+            return None
+        self.expire(now)
+        span = min(now - self.started, self.window_seconds)
+        return self.m1_total * 3600 / span, self.m2_total * 3600 / span
+
+
+def parse_counts(line):
+    """
+    Phân tích một dòng số xe từ bộ đếm: "<ngã tư>,<xe Mạch 1>,<xe Mạch 2>" hoặc "<xe Mạch 1>,<xe Mạch 2>".
+
+    Returns:
+        tuple: (tên ngã tư hoặc None, xe Mạch 1, xe Mạch 2).
+
+    Raises:
+        ValueError: Dòng không đúng định dạng.
+    """
+    parts = [part.strip() for part in line.split(",")]
+    if len(parts) == 2:
+        name = None
+    elif len(parts) == 3:
+        name = parts.pop(0)
+    else:
+        raise ValueError(f"Dòng số xe không hợp lệ: {line!r}")
+    m1_count, m2_count = int(parts[0]), int(parts[1])
+    if m1_count < 0 or m2_count < 0:
+        raise ValueError(f"Số xe âm: {line!r}")
+    return name, m1_count, m2_count
+
+
+def follow_file(f, stop_event, poll=0.5):
+    """
+    Đọc các dòng được ghi thêm vào file đã mở (như tail -f), bắt đầu từ cuối file.
+    """
+    with f:
+        f.seek(0, 2)
+        while not stop_event.is_set():
+            line = f.readline()
+            if line:
+                yield line
+            else:
+                stop_event.wait(poll)
+
+
+def udp_lines(sock, stop_event):
+    """
+    Nhận các dòng số xe qua socket UDP đã bind (mỗi gói một hoặc nhiều dòng).
+    """
+    with sock:
+        sock.settimeout(0.5)
+        while not stop_event.is_set():
+            try:
+                data, _ = sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            yield from data.decode("utf-8", "replace").splitlines()
+
+
+def poisson(mean):
+    """
+    Số mẫu Poisson (thuật toán Knuth, đủ cho trung bình nhỏ mỗi giây).
+    """
+    limit = math.exp(-mean)
+    count = 0
+    product = random.random()
+    while product > limit:
+        count += 1
+        product *= random.random()
+    return count
+
+
+def simulated_detector(names, m1_rate, m2_rate, stop_event, period=1.0):
+    """
+    Bộ đếm xe giả lập: mỗi period giây sinh số xe ngẫu nhiên (Poisson) cho mọi ngã tư.
+
+    Args:
+        names (Iterable): Tên các ngã tư (đọc lại mỗi chu kỳ).
+        m1_rate (float): Lưu lượng trung bình Mạch 1 (xe/giờ).
+        m2_rate (float): Lưu lượng trung bình Mạch 2 (xe/giờ).
+    """
+    while not stop_event.wait(period):
+        for name in names:
+            yield f"{name},{poisson(m1_rate * period / 3600)},{poisson(m2_rate * period / 3600)}"
+
+
+def open_demand_source(spec, names, stop_event):
+    """
+    Mở nguồn số xe theo chuỗi mô tả: "udp:<cổng>", "sim:<xe/giờ M1>,<xe/giờ M2>" hoặc đường dẫn file.
+    File và socket được mở ngay để lỗi được báo khi khởi động.
+
+    Returns:
+        iterator: Các dòng số xe.
+
+    Raises:
+        ValueError: Mô tả không hợp lệ.
+        OSError: Không mở được file hoặc cổng UDP.
+    """
+    kind, _, value = spec.partition(":")
+    if kind == "udp":
+        try:
+            port = int(value)
+        except ValueError:
+            raise ValueError(f"Nguồn UDP cần dạng udp:<cổng>: {spec}") from None
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(("0.0.0.0", port))
+        except OSError:
+            sock.close()
+            raise
+        return udp_lines(sock, stop_event)
+    if kind == "sim":
+        try:
+            m1_rate, m2_rate = (float(rate) for rate in value.split(","))
+        except ValueError:
+            raise ValueError(f"Nguồn giả lập cần dạng sim:<xe/giờ M1>,<xe/giờ M2>: {spec}") from None
+        return simulated_detector(names, m1_rate, m2_rate, stop_event)
+    return follow_file(open(spec, encoding="utf-8"), stop_event)
+
+
+class AdaptiveController:
+    """
+    Điều khiển thời gian xanh thích ứng theo lưu lượng đo được.
+    Luồng bộ đếm đưa số xe vào cửa sổ trượt của từng ngã tư; định kỳ, một lần tính duy nhất
+    (webster_greens) ra quyết định cho mọi ngã tư, và thời gian xanh mới được giao cho PhaseApplier
+    của ngã tư đó (gửi SET,GREEN lúc chuyển chu kỳ, xác nhận bằng SET_UPDATED).
+    Thay đổi nhỏ hơn min_change giây bị bỏ qua để không gửi lệnh liên tục.
+    """
+    def __init__(self, source=None, window_seconds=300.0, interval=30.0, saturation_flow=SATURATION_FLOW,
+                 min_green=5, max_green=60, min_change=2, clock=time.monotonic):
+        """
+        Args:
+            source (str): Nguồn số xe (xem open_demand_source), None: chỉ nhận qua add_counts().
+                Nguồn được mở ngay, nên ValueError/OSError của open_demand_source được ném tại đây.
+            window_seconds (float): Độ dài cửa sổ trượt (giây).
+            interval (float): Chu kỳ ra quyết định (giây).
+            saturation_flow (float): Lưu lượng bão hòa mỗi hướng (xe/giờ xanh).
+            min_green (int): Thời gian xanh tối thiểu (giây), không nhỏ hơn 1 (giới hạn firmware).
+            max_green (int): Thời gian xanh tối đa (giây).
+            min_change (int): Độ thay đổi tối thiểu (giây) để gửi thời gian xanh mới.
+            clock (callable): Đồng hồ đơn điệu.
+        """
+        if not 1 <= min_green <= max_green <= MAX_PHASE_SECONDS - YELLOW_SECONDS:
+            raise ValueError(f"Cần 1 <= xanh tối thiểu <= xanh tối đa <= {MAX_PHASE_SECONDS - YELLOW_SECONDS}")
+        self.appliers = {} # Tên ngã tư -> PhaseApplier (đăng ký bằng attach())
+        self.window_seconds = window_seconds
+        self.source = source
+        self.interval = interval
+        self.saturation_flow = saturation_flow
+        self.min_green = min_green
+        self.max_green = max_green
+        self.min_change = min_change
+        self.clock = clock
+        self.windows = {} # Tên ngã tư -> DemandWindow
+        self.decisions = {} # Tên ngã tư -> Decision gần nhất
+        self.requested = {} # Tên ngã tư -> thời gian xanh đã giao cho PhaseApplier
+        self.invalid_lines = 0
+        self.error = None # Lỗi của nguồn số xe (nếu luồng bộ đếm dừng vì lỗi)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._lines = open_demand_source(source, self.windows, self._stop_event) if source else None
+        self._threads = [threading.Thread(target=self._run, name="adaptive-controller", daemon=True)]
+        if source:
+            self._threads.append(threading.Thread(target=self._read_source, name="demand-feed", daemon=True))
+
+    def attach(self, name, applier):
+        """
+        Đưa một ngã tư vào bộ điều khiển (gọi trước start()).
+
+        Args:
+            name (str): Tên ngã tư, khớp với tên trong dòng số xe.
+            applier (PhaseApplier): Bộ áp dụng thời gian pha của ngã tư.
+        """
+        self.appliers[name] = applier
+        self.windows[name] = DemandWindow(self.window_seconds)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join(timeout)
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def add_counts(self, name, m1_count, m2_count, now=None):
+        """
+        Ghi nhận số xe của một ngã tư (an toàn luồng). Tên None được hiểu là ngã tư duy nhất.
+
+        Returns:
+            bool: False nếu ngã tư không thuộc bộ điều khiển.
+        """
+        if name is None and len(self.windows) == 1:
+            name = next(iter(self.windows))
+        window = self.windows.get(name)
+        if window is None:
+            return False
+        with self._lock:
+            window.add(m1_count, m2_count, self.clock() if now is None else now)
+        return True
+
+    def decide(self, now=None):
+        """
+        Tính thời gian xanh cho mọi ngã tư có đủ dữ liệu và giao cho PhaseApplier khi thay đổi đủ lớn.
+
+        Returns:
+            dict: Tên ngã tư -> Decision của lần tính này.
+        """
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            rates = {name: window.rates(now) for name, window in self.windows.items()}
+        names = [name for name, rate in rates.items() if rate is not None]
+        decisions = dict(zip(names, webster_greens([rates[name] for name in names], self.saturation_flow,
+                                                   self.min_green, self.max_green)))
+        for name, decision in decisions.items():
+            previous = self.requested.get(name)
+            if previous is None or abs(decision.green - previous) >= self.min_change:
+                self.requested[name] = decision.green
+                self.appliers[name].request(PhasePlan(
+                    f"thích ứng {decision.m1_rate:.0f}/{decision.m2_rate:.0f} xe/h", decision.green,
+                    decision.green + YELLOW_SECONDS, f"SET,GREEN,{decision.green}"))
+        self.decisions.update(decisions)
+        return decisions
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.decide()
+
+    def _read_source(self):
+        try:
+            for line in self._lines:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    name, m1_count, m2_count = parse_counts(line)
+                except ValueError:
+                    self.invalid_lines += 1
+                    continue
+                if not self.add_counts(name, m1_count, m2_count):
+                    self.invalid_lines += 1
+        except OSError as e:
+            self.error = e
@@ -0,0 +1,218 @@
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from engine import IntersectionState
+
+
+def synthetic_stream(count, green_secs=5, yellow_secs=2, interval_ms=200, seed=0):
+    """
+    Sinh luồng dòng Serial giống firmware: khung "S," mỗi interval_ms theo chu kỳ xanh/vàng/đỏ,
+    xen kẽ ngẫu nhiên các đợt khẩn cấp, phản hồi SET_UPDATED, cảnh báo và thông báo debug.
+
+    Args:
+        count (int): Số dòng cần sinh.
+        green_secs (int): Thời gian đèn xanh (giây).
+        yellow_secs (int): Thời gian đèn vàng (giây).
+        interval_ms (int): Khoảng cách giữa hai khung trạng thái (mili giây).
+        seed (int): Hạt giống ngẫu nhiên để kết quả lặp lại được.
+
+    Returns:
+        list: Các dòng (str) theo thứ tự nhận.
+    """
+    rng = random.Random(seed)
+    green_ms = green_secs * 1000
+    red_ms = (green_secs + yellow_secs) * 1000
+    cycle_ms = 2 * red_ms
+    lines = []
+    now = 0
+    while len(lines) < count:
+        cycle_time = now % cycle_ms
+        if cycle_time < red_ms: # Pha 1: Mạch 1 đỏ, Mạch 2 xanh rồi vàng
+            m1 = ("RED", (red_ms - cycle_time) // 1000)
+            if cycle_time < green_ms:
+                m2 = ("GREEN", (green_ms - cycle_time) // 1000)
+            else:
+                m2 = ("YELLOW", (red_ms - cycle_time) // 1000)
+        else: # Pha 2: Mạch 1 xanh rồi vàng, Mạch 2 đỏ
+            phase2_time = cycle_time - red_ms
+            m2 = ("RED", (cycle_ms - cycle_time) // 1000)
+            if phase2_time < green_ms:
+                m1 = ("GREEN", (green_ms - phase2_time) // 1000)
+            else:
+                m1 = ("YELLOW", (cycle_ms - cycle_time) // 1000)
+        lines.append(f"S,{m1[0]},{m1[1]},{m2[0]},{m2[1]}")
+
+        roll = rng.random()
+        if roll < 0.002: # Đợt khẩn cấp: thông báo, vài khung giữ nguyên, rồi tắt khẩn cấp
+            lines.append(">>> KHẨN CẤP: MẠCH 1 XANH <<<")
+            lines.extend(["S,GREEN,0,RED,0"] * 10)
+            lines.append(">>> TẮT KHẨN CẤP - QUAY LẠI BÌNH THƯỜNG <<<")
+        elif roll < 0.003:
+            lines.append(f"SET_UPDATED,GREEN,{green_secs},{green_secs + yellow_secs}")
+        elif roll < 0.004:
+            lines.append(">>> Cảnh báo: Thời gian đỏ quá ngắn. Đèn xanh tối thiểu 1s. Đã điều chỉnh. <<<")
+        elif roll < 0.005:
+            lines.append("SET_ERROR: Màu không hợp lệ (chỉ GREEN/RED)")
+        now += interval_ms
+    return lines[:count]
+
+
+def load_recording(path):
+    """
+    Đọc luồng dòng đã ghi lại từ file (mỗi dòng một thông điệp).
+    Chấp nhận cả dòng nhật ký của GUI dạng "[HH:MM:SS] Nhận: <dòng>".
+    """
+    lines = []
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        for raw in f:
+            line = raw.strip()
+            if line.startswith("[") and "] Nhận: " in line:
+                line = line.split("] Nhận: ", 1)[1]
+            if line:
+                lines.append(line)
+    return lines
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_benchmark(lines, repeat=5, alloc_sample=20000):
+    """
+    Phát lại luồng dòng qua IntersectionState và đo hiệu năng.
+
+    Args:
+        lines (list): Các dòng cần phát lại.
+        repeat (int): Số lần phát lại khi đo thông lượng (lấy lần nhanh nhất).
+        alloc_sample (int): Số dòng dùng để đo cấp phát bộ nhớ (tracemalloc chậm).
+
+    Returns:
+        dict: lines, lines_per_sec, p50_us, p99_us, alloc_bytes_per_line,
+            retained_blocks_per_line, events.
+    """
+    counter = [0]
+
+    def count_event(event):
+        counter[0] += 1
+
+    # 1. Thông lượng: lấy lần chạy nhanh nhất
+    best = None
+    for _ in range(repeat):
+        state = IntersectionState()
+        state.subscribe(count_event)
+        feed = state.feed
+        counter[0] = 0
+        start = time.perf_counter()
+        for line in lines:
+            feed(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    events = counter[0]
+
+    # 2. Độ trễ từng dòng
+    state = IntersectionState()
+    state.subscribe(count_event)
+    feed = state.feed
+    clock = time.perf_counter_ns
+    latencies = []
+    append = latencies.append
+    for line in lines:
+        t0 = clock()
+        feed(line)
+        append(clock() - t0)
+    latencies.sort()
+
+    # 3. Cấp phát bộ nhớ: đỉnh bộ nhớ tạm thời mỗi dòng và số khối còn giữ lại
+    sample = lines[:alloc_sample]
+    state = IntersectionState()
+    state.subscribe(count_event)
+    feed = state.feed
+    tracemalloc.start()
+    peak_total = 0
+    for line in sample:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        feed(line)
+        peak_total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    blocks_before = sys.getallocatedblocks()
+    for line in sample:
+        feed(line)
+    retained = sys.getallocatedblocks() - blocks_before
+
+    return {
+        "lines": len(lines),
+        "lines_per_sec": len(lines) / best if best else 0.0,
+        "p50_us": percentile(latencies, 0.50) / 1000,
+        "p99_us": percentile(latencies, 0.99) / 1000,
+        "alloc_bytes_per_line": peak_total / len(sample) if sample else 0.0,
+        "retained_blocks_per_line": retained / len(sample) if sample else 0.0,
+        "events": events,
+    }
+
+
+def check_regression(result, baseline, max_regression):
+    """
+    So sánh kết quả với mốc (baseline) đã lưu.
+
+    Returns:
+        list: Các mô tả hồi quy vượt ngưỡng (rỗng nếu đạt).
+    """
+    problems = []
+    if result["lines_per_sec"] < baseline["lines_per_sec"] * (1 - max_regression):
+        problems.append(f"Thông lượng giảm: {result['lines_per_sec']:,.0f} < {baseline['lines_per_sec']:,.0f} dòng/s")
+    if result["p99_us"] > baseline["p99_us"] * (1 + max_regression):
+        problems.append(f"p99 tăng: {result['p99_us']:.2f} > {baseline['p99_us']:.2f} µs")
+    if result["alloc_bytes_per_line"] > baseline["alloc_bytes_per_line"] * (1 + max_regression):
+        problems.append(f"Cấp phát tăng: {result['alloc_bytes_per_line']:.0f} > "
+                        f"{baseline['alloc_bytes_per_line']:.0f} B/dòng")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Đo hiệu năng bộ máy trạng thái ngã tư (IntersectionState)")
+    parser.add_argument("--input", help="File luồng dòng đã ghi lại (mặc định: sinh luồng tổng hợp)")
+    parser.add_argument("--lines", type=int, default=100000, help="Số dòng tổng hợp (mặc định 100000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Số lần phát lại khi đo thông lượng")
+    parser.add_argument("--seed", type=int, default=0, help="Hạt giống cho luồng tổng hợp")
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON (dùng làm mốc cho lần sau)")
+    parser.add_argument("--baseline", help="File JSON mốc để phát hiện hồi quy")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Mức hồi quy tối đa cho phép so với mốc (mặc định 0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    lines = load_recording(args.input) if args.input else synthetic_stream(args.lines, seed=args.seed)
+    if not lines:
+        print("Không có dòng dữ liệu nào để phát lại")
+        return 2
+    result = run_benchmark(lines, repeat=args.repeat)
+
+    print(f"Dòng: {result['lines']:,} | Sự kiện: {result['events']:,}")
+    print(f"Thông lượng: {result['lines_per_sec']:,.0f} dòng/s")
+    print(f"Độ trễ: p50 {result['p50_us']:.2f} µs | p99 {result['p99_us']:.2f} µs")
+    print(f"Cấp phát: {result['alloc_bytes_per_line']:.0f} B/dòng (đỉnh tracemalloc) | "
+          f"giữ lại {result['retained_blocks_per_line']:.3f} khối/dòng")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = check_regression(result, baseline, args.max_regression)
+        for problem in problems:
+            print(f"HỒI QUY: {problem}")
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,329 @@
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import engine
+from metrics import LatencyHistogram
+
+# Quy tắc xác nhận theo loại lệnh:
+#   (dòng xác nhận cuối, dòng chấp nhận trung gian, dòng báo lỗi) - đều so khớp theo tiền tố.
+# Dòng trung gian (ví dụ "chuyển vàng 2s rồi KHẨN CẤP") cho biết ESP32 đã nhận lệnh và
+# sẽ thực hiện sau pha vàng chuyển tiếp, nên thời hạn chờ được kéo dài thêm.
+ACK_RULES = {
+    "E1": ((">>> KHẨN CẤP: MẠCH 1", ">>> TẮT KHẨN CẤP - MẠCH 1"), (">>> Mạch 2 đang xanh/vàng",), ()),
+    "E2": ((">>> KHẨN CẤP: MẠCH 2", ">>> TẮT KHẨN CẤP - MẠCH 2"), (">>> Mạch 1 đang xanh/vàng",), ()),
+    "E3": ((">>> KHẨN CẤP: CẢ HAI ĐỎ", ">>> TẮT KHẨN CẤP - QUAY LẠI"), (">>> Có đèn xanh/vàng",), ()),
+    "NORMAL": ((">>> TẮT KHẨN CẤP - QUAY LẠI",), (), ()),
+    "SET": (("SET_UPDATED,",), (), ("SET_ERROR",)),
+    "PROTO": (("PROTO_OK,",), (), ()),
+}
+TRANSITION_GRACE = 2.5 # Thời gian (giây) cộng thêm khi ESP32 báo đang chuyển vàng trước khẩn cấp
+# Lệnh bật/tắt: gửi lại sau khi hết hạn có thể tắt đúng chế độ vừa bật (khi chỉ dòng xác nhận bị mất)
+TOGGLE_COMMANDS = frozenset(("E1", "E2", "E3"))
+_WAKE = object() # Đánh thức luồng ghi đang chờ hàng đợi khi có lệnh khẩn
+
+# Kết quả của một lệnh
+# ok: ESP32 xác nhận thành công; acked: có dòng xác nhận (kể cả SET_ERROR);
+# reply: dòng xác nhận; latency: giây từ lần gửi đầu tiên tới khi nhận xác nhận; error: mô tả lỗi
+CommandResult = namedtuple("CommandResult", "command kind ok acked reply latency attempts error")
+
+
+SIMPLE_COMMANDS = frozenset(("E1", "E2", "E3", "NORMAL"))
+MAX_PHASE_SECONDS = 999
+
+
+def validate_command(command):
+    """
+    Kiểm tra một lệnh điều khiển đến từ bên ngoài GUI (API, dòng lệnh):
+    chỉ chấp nhận E1, E2, E3, NORMAL và SET,<GREEN|RED>,<giây>.
+
+    Args:
+        command (str): Chuỗi lệnh.
+
+    Returns:
+        str: Lệnh đã chuẩn hóa (chữ hoa, bỏ khoảng trắng).
+
+    Raises:
+        ValueError: Lệnh không hợp lệ.
+    """
+    command = command.strip().upper()
+    if command in SIMPLE_COMMANDS:
+        return command
+    parts = command.split(",")
+    if len(parts) == 3 and parts[0] == "SET" and parts[1] in ("GREEN", "RED"):
+        if parts[2].isdigit() and 0 < int(parts[2]) <= MAX_PHASE_SECONDS:
+            return f"SET,{parts[1]},{int(parts[2])}"
+        raise ValueError(f"Thời gian phải là số nguyên từ 1 đến {MAX_PHASE_SECONDS}: {parts[2]}")
+    raise ValueError(f"Lệnh không hợp lệ: {command}")
+
+
+def describe_result(result, latency_summary=None):
+    """
+    Mô tả kết quả của một lệnh cho nhật ký (dùng chung cho GUI, supervisor và trafficctl).
+
+    Args:
+        result (CommandResult): Kết quả từ CommandWriter.
+        latency_summary (str): Tóm tắt độ trễ của loại lệnh, thêm vào khi ESP32 xác nhận (None: bỏ qua).
+
+    Returns:
+        tuple: (nhóm engine.LOG_*, tin nhắn), hoặc None với lệnh không cần xác nhận đã gửi xong.
+    """
+    if result.ok and result.acked:
+        message = (f"ESP32 xác nhận '{result.command}' sau {result.latency * 1000:.0f} ms "
+                   f"(lần gửi {result.attempts})")
+        if latency_summary:
+            message += f" – độ trễ {result.kind}: {latency_summary}"
+        return engine.LOG_INFO, message
+    if result.acked:
+        return engine.LOG_WARNING, f"ESP32 từ chối lệnh '{result.command}': {result.reply}"
+    if not result.ok:
+        return engine.LOG_ERROR, f"Lệnh '{result.command}' thất bại – {result.error} (đã gửi {result.attempts} lần)"
+    return None
+
+
+def command_kind(command):
+    """
+    Loại lệnh dùng để chọn quy tắc xác nhận, ví dụ "SET,GREEN,5" -> "SET".
+    """
+    return command.split(",", 1)[0]
+
+
+class PendingCommand:
+    """
+    Lệnh đang chờ xác nhận (được luồng ghi và luồng đọc cùng truy cập dưới khóa).
+    """
+    def __init__(self, kind, rule, urgent=False):
+        self.kind = kind
+        self.urgent = urgent # Lệnh khẩn: không bị lệnh khẩn khác cắt ngang
+        self.final, self.intermediate, self.errors = rule
+        self.reply = None
+        self.reply_at = None
+        self.accepted = False
+        self.preempted = False # Bị cắt ngang để gửi lệnh khẩn
+
+
+class CommandWriter:
+    """
+    Hàng đợi lệnh gửi đi với luồng ghi riêng, để ser.write()/flush() không bao giờ chặn luồng Tkinter.
+    Mỗi lệnh được ghép với dòng xác nhận của ESP32 (">>> KHẨN CẤP: ...", "TẮT KHẨN CẤP",
+    "SET_UPDATED,..."/"SET_ERROR", "PROTO_OK,..."), có thời hạn chờ và gửi lại; độ trễ khứ hồi
+    được ghi vào biểu đồ độ trễ theo từng loại lệnh.
+
+    Các lệnh E1/E2/E3 là lệnh bật/tắt nên không bao giờ được gửi lại khi hết hạn: im lặng không phân biệt được
+    ESP32 chưa nhận lệnh hay đã thực hiện nhưng dòng xác nhận bị mất, và gửi lại trong trường hợp sau
+    sẽ tắt chính chế độ khẩn cấp vừa bật. Kết quả được báo là chưa xác nhận.
+
+    Lệnh khẩn (send_urgent, ví dụ E3 tự động của bộ giám sát an toàn) nằm ở một ô riêng được xét trước
+    hàng đợi thường và cắt ngang lần chờ xác nhận của lệnh thường đang gửi dở.
+    """
+    def __init__(self, get_serial, on_result=None, timeout=1.0, retries=1, maxsize=100):
+        """
+        Args:
+            get_serial (callable): Hàm trả về đối tượng Serial hiện tại (hoặc None khi chưa kết nối).
+            on_result (callable): Hàm được gọi (trên luồng ghi) với CommandResult của mỗi lệnh.
+            timeout (float): Thời hạn chờ xác nhận (giây) cho mỗi lần gửi.
+            retries (int): Số lần gửi lại tối đa khi hết thời hạn mà không nhận được gì (trừ E1/E2/E3).
+            maxsize (int): Số lệnh tối đa chờ trong hàng đợi.
+        """
+        self.get_serial = get_serial
+        self.on_result = on_result
+        self.timeout = timeout
+        self.retries = retries
+        self.latency = {} # Loại lệnh -> LatencyHistogram
+        self.sent = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize)
+        self._urgent = None # Lệnh khẩn chờ gửi (ô riêng, xét trước hàng đợi thường)
+        self._pending = None
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="command-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Dừng luồng ghi (lệnh đang chờ xác nhận bị hủy).
+        """
+        self._stop_event.set()
+        with self._cond:
+            self._cond.notify_all()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def join(self, timeout=None):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def send(self, command):
+        """
+        Đưa một lệnh vào hàng đợi gửi (không chặn).
+
+        Args:
+            command (str): Chuỗi lệnh, ví dụ "E1" hoặc "SET,GREEN,10".
+
+        Returns:
+            bool: False nếu hàng đợi đầy và lệnh bị từ chối.
+        """
+        try:
+            self._queue.put_nowait(command)
+        except queue.Full:
+            self._report(CommandResult(command, command_kind(command), False, False, None, None, 0,
+                                       "Hàng đợi lệnh đầy"))
+            return False
+        return True
+
+    def send_urgent(self, command):
+        """
+        Gửi một lệnh khẩn (không chặn, gọi từ luồng bất kỳ): lệnh được gửi trước mọi lệnh trong hàng đợi,
+        lần chờ xác nhận của lệnh thường đang gửi bị dừng và lệnh đó được báo là chưa xác nhận.
+
+        Args:
+            command (str): Chuỗi lệnh, ví dụ "E3".
+
+        Returns:
+            bool: False nếu đã có một lệnh khẩn khác đang chờ gửi.
+        """
+        with self._cond:
+            if self._urgent is not None:
+                busy = True
+            else:
+                busy = False
+                self._urgent = command
+                pending = self._pending
+                if pending is not None and not pending.urgent:
+                    pending.preempted = True
+                    self._cond.notify_all()
+        if busy:
+            self._report(CommandResult(command, command_kind(command), False, False, None, None, 0,
+                                       "Đã có lệnh khẩn khác đang chờ gửi"))
+            return False
+        try:
+            self._queue.put_nowait(_WAKE)
+        except queue.Full: # Hàng đợi còn lệnh nên luồng ghi không bị chặn ở get()
+            pass
+        return True
+
+    def on_line(self, line):
+        """
+        Kiểm tra một dòng nhận được (gọi trên luồng đọc) có phải xác nhận của lệnh đang chờ hay không.
+        """
+        pending = self._pending
+        if pending is None or line.__class__ is not str:
+            return
+        if line.startswith(pending.final) or (pending.errors and line.startswith(pending.errors)):
+            now = time.monotonic()
+            with self._cond:
+                if self._pending is pending and pending.reply is None:
+                    pending.reply = line
+                    pending.reply_at = now
+                    self._cond.notify_all()
+        elif pending.intermediate and line.startswith(pending.intermediate):
+            with self._cond:
+                pending.accepted = True
+                self._cond.notify_all()
+
+    def latency_summary(self, kind):
+        """
+        Tóm tắt độ trễ của một loại lệnh (chuỗi rỗng nếu chưa có dữ liệu).
+        """
+        histogram = self.latency.get(kind)
+        return histogram.summary() if histogram else ""
+
+    def _report(self, result):
+        if not result.ok:
+            self.failed += 1
+        if self.on_result:
+            self.on_result(result)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self._cond:
+                urgent, self._urgent = self._urgent, None
+            if urgent is not None:
+                self._execute(urgent, urgent=True)
+                continue
+            item = self._queue.get()
+            if item is None:
+                break
+            if item is not _WAKE:
+                self._execute(item)
+
+    def _execute(self, command, urgent=False):
+        """
+        Gửi một lệnh, chờ xác nhận và gửi lại khi cần (chạy trên luồng ghi).
+        Lệnh thường dừng chờ (không gửi lại) ngay khi có lệnh khẩn.
+        """
+        kind = command_kind(command)
+        rule = ACK_RULES.get(kind)
+        payload = (command + "\n").encode()
+        first_sent = None
+        attempts = 0
+        error = None
+        while attempts <= self.retries and not self._stop_event.is_set():
+            attempts += 1
+            ser = self.get_serial()
+            if not ser or not ser.is_open:
+                error = "Không có kết nối Serial"
+                break
+            pending = PendingCommand(kind, rule, urgent) if rule else None
+            with self._cond:
+                if not urgent and self._urgent is not None: # Chưa ghi: nhường lệnh khẩn
+                    error = "Bị hủy để gửi lệnh khẩn trước"
+                    break
+                self._pending = pending
+            sent_at = time.monotonic()
+            if first_sent is None:
+                first_sent = sent_at
+            try:
+                ser.write(payload)
+                ser.flush()
+            except OSError as e: # SerialException/SerialTimeoutException: cổng treo hoặc bị ngắt
+                error = f"Lỗi ghi Serial: {e}"
+                self._clear_pending()
+                continue
+            self.sent += 1
+            if pending is None: # Lệnh không có xác nhận: coi như thành công khi đã ghi xong
+                self._report(CommandResult(command, kind, True, False, None, None, attempts, None))
+                return
+
+            with self._cond:
+                deadline = sent_at + self.timeout
+                extended = False
+                while pending.reply is None and not pending.preempted and not self._stop_event.is_set():
+                    if pending.accepted and not extended:
+                        deadline += TRANSITION_GRACE
+                        extended = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self._pending = None
+
+            if pending.reply is not None:
+                latency = pending.reply_at - first_sent
+                self.latency.setdefault(kind, LatencyHistogram()).observe(latency)
+                ok = not (pending.errors and pending.reply.startswith(pending.errors))
+                self._report(CommandResult(command, kind, ok, True, pending.reply, latency, attempts,
+                                           None if ok else pending.reply))
+                return
+            if pending.preempted:
+                error = "Ngừng chờ xác nhận để gửi lệnh khẩn – không rõ ESP32 đã thực hiện hay chưa"
+                break
+            error = "Hết thời hạn chờ xác nhận"
+            if pending.accepted: # ESP32 đã nhận lệnh, không gửi lại lệnh bật/tắt
+                error = "ESP32 đã nhận lệnh nhưng không xác nhận hoàn tất"
+                break
+            if kind in TOGGLE_COMMANDS:
+                error = "Chưa xác nhận – không rõ ESP32 đã thực hiện hay chưa (lệnh bật/tắt không được gửi lại)"
+                break
+        self._report(CommandResult(command, kind, False, False, None, None, attempts, error))
+
+    def _clear_pending(self):
+        with self._cond:
+            self._pending = None
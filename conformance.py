@@ -0,0 +1,338 @@
+import argparse
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import engine
+from bench import run_benchmark, synthetic_stream
+from protocol import FRAME_SYNC, StatusFrame
+from serial_reader import LineSplitter
+from simulator import FirmwareModel, encode_output
+
+MAX_UINT_DIGITS = 10 # unsigned long 32 bit của ESP32: tối đa 10 chữ số thập phân
+EMERGENCY_STATUS = {mode: status for _, _, _, status, mode in engine.EMERGENCY_ANNOUNCEMENTS}
+
+# Lệnh ngẫu nhiên gửi tới mô hình firmware trong phép kiểm tra đối chiếu
+COMMANDS = ("E1", "E2", "E3", "NORMAL", "SET,GREEN,{n}", "SET,RED,{n}", "SET,BLUE,{n}",
+            "PROTO,BIN", "PROTO,BIN,{ms}", "PROTO,TEXT", "PROTO,SPARSE", "PROTO,SPARSE,{ms}")
+
+
+def is_uint(text):
+    """
+    Số nguyên không dấu như firmware gửi: chỉ chữ số ASCII, không quá MAX_UINT_DIGITS chữ số.
+    """
+    return 0 < len(text) <= MAX_UINT_DIGITS and text.isascii() and text.isdigit()
+
+
+def reference_status(line):
+    """
+    Ngữ pháp tham chiếu của khung trạng thái văn bản, viết độc lập với engine.py:
+    "S,<màu>,<giây>,<màu>,<giây>" hoặc khung thưa "S,<màu>,<giây>,<màu>,<giây>,<ms>,<ms>".
+
+    Returns:
+        tuple: (màu M1, giây M1, màu M2, giây M2) nếu khung hợp lệ, ngược lại None.
+    """
+    parts = line.split(",")
+    if parts[0] != "S" or len(parts) not in (5, 7):
+        return None
+    if parts[1] not in engine.VALID_COLORS or parts[3] not in engine.VALID_COLORS:
+        return None
+    if not all(is_uint(part) for part in parts[2:3] + parts[4:]):
+        return None
+    return parts[1], int(parts[2]), parts[3], int(parts[4])
+
+
+def lights(state):
+    return state.m1_color, state.m1_secs, state.m2_color, state.m2_secs
+
+
+def expected_protocol(model):
+    if model.binary_frames:
+        return "BIN"
+    return "SPARSE" if model.sparse_frames else "TEXT"
+
+
+def random_command(rng):
+    return rng.choice(COMMANDS).format(n=rng.choice((1, 2, 3, 5, 10, 30, 0, 250)),
+                                       ms=rng.choice((20, 50, 500, 1000, 3000)))
+
+
+class Checker:
+    """
+    Ghi nhận các vi phạm (tối đa limit mô tả để báo cáo ngắn gọn).
+    """
+    def __init__(self, limit=20):
+        self.limit = limit
+        self.checks = 0
+        self.failures = []
+
+    def expect(self, ok, message):
+        self.checks += 1
+        if not ok and len(self.failures) < self.limit:
+            self.failures.append(message)
+        return ok
+
+
+def check_against_firmware(seed, duration_ms, command_every_ms=3000, checker=None):
+    """
+    Kiểm tra đối chiếu: chạy FirmwareModel (mô hình tham chiếu của máy trạng thái firmware) theo đồng hồ giả lập
+    với lệnh ngẫu nhiên, đưa byte đầu ra qua LineSplitter vào IntersectionState như đường Serial thật,
+    rồi so trạng thái của engine với mô hình sau mỗi mục: màu/thời gian của khung trạng thái, chế độ khẩn cấp,
+    trạng thái hệ thống khi khẩn cấp, định dạng khung đã thỏa thuận và thời gian pha của SET_UPDATED.
+
+    Returns:
+        Checker: Kết quả kiểm tra.
+    """
+    checker = checker or Checker()
+    rng = random.Random(seed)
+    model = FirmwareModel(0)
+    state = engine.IntersectionState()
+    splitter = LineSplitter()
+    phase_times = []
+    state.subscribe(lambda event: phase_times.append(event) if type(event) is engine.PhaseTimesUpdated else None)
+    next_command = rng.randrange(command_every_ms)
+    for now in range(0, duration_ms, 10): # Mỗi vòng loop() của firmware ~10 ms
+        out = []
+        if now >= next_command:
+            command = random_command(rng)
+            out.extend(model.handle_command(command, now))
+            next_command = now + rng.randrange(1, 2 * command_every_ms)
+        # Khung trạng thái được tạo ở đầu loop(), trước khi đèn được cập nhật trong cùng vòng
+        expected = model.status(now)
+        out.extend(model.tick(now))
+        data = b"".join(encode_output(item) for item in out)
+        if not data:
+            continue
+        for item in splitter.feed(data):
+            del phase_times[:]
+            state.feed(item)
+            context = f"seed={seed} t={now}ms mục={item!r}"
+            if item.__class__ is StatusFrame:
+                binary = (expected[0], min(expected[1], 255), expected[2], min(expected[3], 255))
+                checker.expect(lights(state) == binary, f"{context}: đèn {lights(state)} != firmware {binary}")
+            elif item.startswith("S,"):
+                checker.expect(lights(state) == expected, f"{context}: đèn {lights(state)} != firmware {expected}")
+            for event in phase_times:
+                green, red = model.green_ms // 1000, model.red_ms // 1000
+                got = (event.seconds, event.opposing_seconds) if event.color == "GREEN" else \
+                    (event.opposing_seconds, event.seconds)
+                checker.expect(got == (green, red), f"{context}: SET_UPDATED xanh/đỏ {got} != firmware {(green, red)}")
+        context = f"seed={seed} t={now}ms"
+        checker.expect(state.emergency_mode == model.emergency_mode,
+                       f"{context}: chế độ khẩn cấp {state.emergency_mode} != firmware {model.emergency_mode}")
+        checker.expect(state.protocol == expected_protocol(model),
+                       f"{context}: định dạng khung {state.protocol} != firmware {expected_protocol(model)}")
+        if model.emergency_mode and not model.yellow_phase:
+            checker.expect(state.status == EMERGENCY_STATUS[model.emergency_mode],
+                           f"{context}: trạng thái {state.status} khi khẩn cấp E{model.emergency_mode}")
+    return checker
+
+
+def mutate(line, rng):
+    """
+    Sinh một biến thể hỏng của dòng hợp lệ: cắt cụt, màu sai, số quá lớn/âm/không phải ASCII,
+    trường rỗng/thừa, ký tự lạ chèn vào.
+    """
+    parts = line.split(",")
+    # Chỉ khung "S," đủ trường mới đổi được từng trường; dòng khác chỉ bị cắt cụt hoặc chèn ký tự
+    kind = rng.randrange(8) if len(parts) >= 5 else rng.choice((0, 6, 7))
+    if kind == 0: # Dòng bị cắt cụt
+        return line[:rng.randrange(len(line))]
+    if kind == 1: # Màu không hợp lệ
+        parts[rng.choice((1, 3))] = rng.choice(("BLUE", "red", "", "GREEN ", "NONE", "RÉD"))
+    elif kind == 2: # Số quá lớn
+        parts[rng.choice((2, 4))] = "9" * rng.choice((11, 20, 400, 5000))
+    elif kind == 3: # Số âm, có dấu, khoảng trắng, gạch dưới, chữ số không phải ASCII
+        parts[rng.choice((2, 4))] = rng.choice(("-1", "+5", " 5", "1_0", "٣", "²", "0x1F", "5.0", ""))
+    elif kind == 4: # Thừa/thiếu trường
+        parts = parts + ["7"] * rng.choice((1, 3)) if rng.random() < 0.5 else parts[:rng.randrange(1, len(parts))]
+    elif kind == 5: # Khung thưa với mili giây hỏng
+        parts = parts[:5] + [rng.choice(("1500", "²", "-3", "9" * 30, "")), rng.choice(("0", "٣", "abc"))]
+    elif kind == 6: # Ký tự lạ chèn giữa dòng
+        position = rng.randrange(len(line) + 1)
+        return line[:position] + rng.choice(("\x00", "�", "\x1b[0m", ",", "S,")) + line[position:]
+    else: # Dòng khác có tiền tố gần đúng
+        return rng.choice(("SET_UPDATED,GREEN,x,7", "SET_UPDATED,GREEN", "SET_UPDATED,RED,²,5",
+                           "PROTO_OK", "PROTO_OK,BIN,²", "PROTO_OK,SPARSE,99999999999999999999999",
+                           "PROTO_OK,XYZ,5", ">>> KHẨN CẤP: <<<", ">>> Cảnh báo:", "S", "S,", "ESP32 reboot"))
+    return ",".join(parts)
+
+
+def fuzz_lines(seed, count, checker=None):
+    """
+    Fuzz mức dòng: xen khung hợp lệ với biến thể hỏng. Mỗi dòng không được làm engine ném ngoại lệ;
+    khung hợp lệ theo ngữ pháp tham chiếu phải được áp dụng đúng; khung "S," không hợp lệ chỉ được
+    giữ nguyên đèn hoặc đặt trạng thái lỗi (NONE); dòng khác không được đổi đèn (trừ thông báo khẩn cấp).
+    """
+    checker = checker or Checker()
+    rng = random.Random(seed)
+    valid = synthetic_stream(2000, seed=seed)
+    state = engine.IntersectionState()
+    for index in range(count):
+        base = valid[index % len(valid)]
+        line = mutate(base, rng) if rng.random() < 0.7 else base
+        line = line.strip() # LineSplitter luôn cắt khoảng trắng hai đầu
+        if not line:
+            continue
+        before = lights(state)
+        try:
+            state.feed(line)
+        except Exception as e: # Bất kỳ ngoại lệ nào cũng là lỗi: luồng xử lý sẽ dừng
+            checker.expect(False, f"seed={seed} dòng {line[:80]!r}: ngoại lệ {type(e).__name__}: {e}")
+            state = engine.IntersectionState()
+            continue
+        after = lights(state)
+        reference = reference_status(line)
+        if reference is not None:
+            checker.expect(after == reference, f"seed={seed} dòng {line[:80]!r}: đèn {after} != {reference}")
+        elif line.startswith("S,"):
+            checker.expect(after == before or after == ("NONE", 0, "NONE", 0),
+                           f"seed={seed} khung hỏng {line[:80]!r} được chấp nhận: đèn {after}")
+        elif not line.startswith(">>> KHẨN CẤP:"):
+            checker.expect(after == before, f"seed={seed} dòng {line[:80]!r} làm đổi đèn: {before} -> {after}")
+    return checker
+
+
+def fuzz_bytes(seed, count, checker=None):
+    """
+    Fuzz mức byte qua LineSplitter: byte ngẫu nhiên, UTF-8 hỏng, byte đồng bộ nhị phân lạc, dòng quá dài.
+    Sau mỗi đoạn rác, một khung hợp lệ trên dòng riêng phải đưa engine về đúng trạng thái.
+    """
+    checker = checker or Checker()
+    rng = random.Random(seed)
+    splitter = LineSplitter()
+    state = engine.IntersectionState()
+    for index in range(count):
+        kind = rng.randrange(4)
+        if kind == 0:
+            garbage = bytes(rng.randrange(256) for _ in range(rng.randrange(1, 64)))
+        elif kind == 1: # UTF-8 hỏng giữa một khung
+            garbage = b"S,RE\xff\xfeD,5,GR\xc3EEN,3"
+        elif kind == 2: # Byte đồng bộ lạc ở đầu dòng
+            garbage = bytes((FRAME_SYNC,)) + bytes(rng.randrange(256) for _ in range(rng.randrange(0, 12)))
+        else: # Dòng quá dài
+            garbage = b"S," + b"9" * rng.choice((100, 5000, 9000))
+        m1_secs, m2_secs = rng.randrange(60), rng.randrange(60)
+        frame = f"S,RED,{m1_secs},GREEN,{m2_secs}"
+        # Ký tự xuống dòng kép: khung nhị phân hỏng ở đầu dòng có thể nuốt một ký tự xuống dòng
+        data = garbage + b"\n\n" + frame.encode() + b"\r\n"
+        chunk = rng.choice((1, 7, 64, 4096)) # Dữ liệu tới theo từng mẩu như khi đọc Serial
+        try:
+            for start in range(0, len(data), chunk):
+                for item in splitter.feed(data[start:start + chunk]):
+                    state.feed(item)
+        except Exception as e:
+            checker.expect(False, f"seed={seed} rác {garbage[:40]!r}: ngoại lệ {type(e).__name__}: {e}")
+            splitter, state = LineSplitter(), engine.IntersectionState()
+            continue
+        checker.expect(lights(state) == ("RED", m1_secs, "GREEN", m2_secs),
+                       f"seed={seed} lần {index}: không phục hồi sau rác {garbage[:40]!r}, đèn {lights(state)}")
+    return checker
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def measure_throughput(seed, lines, repeat):
+    """
+    Đo thông lượng phân tích trên luồng hợp lệ và luồng có 30% dòng hỏng (dùng run_benchmark của bench.py).
+    """
+    rng = random.Random(seed)
+    valid = synthetic_stream(lines, seed=seed)
+    malformed = [mutate(line, rng).strip() or line if rng.random() < 0.3 else line for line in valid]
+    results = {}
+    for name, stream in (("valid", valid), ("malformed", malformed)):
+        result = run_benchmark(stream, repeat=repeat, alloc_sample=2000)
+        results[name] = {"lines_per_sec": result["lines_per_sec"], "p99_us": result["p99_us"]}
+    return results
+
+
+def check_history(history, current, window, max_regression):
+    """
+    So thông lượng hiện tại với trung vị của window lần chạy gần nhất trong lịch sử.
+
+    Returns:
+        list: Các mô tả hồi quy vượt ngưỡng.
+    """
+    problems = []
+    recent = history[-window:]
+    for name, result in current.items():
+        previous = [entry["throughput"][name]["lines_per_sec"] for entry in recent if name in entry["throughput"]]
+        if not previous:
+            continue
+        median = statistics.median(previous)
+        if result["lines_per_sec"] < median * (1 - max_regression):
+            problems.append(f"Thông lượng {name} giảm: {result['lines_per_sec']:,.0f} < trung vị "
+                            f"{median:,.0f} dòng/s của {len(previous)} lần gần nhất")
+    return problems
+
+
+def load_history(path):
+    entries = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Kiểm tra tuân thủ giao thức (đối chiếu mô hình firmware, fuzz) và đo thông lượng bộ phân tích")
+    parser.add_argument("--seeds", type=int, default=5, help="Số hạt giống ngẫu nhiên (mặc định 5)")
+    parser.add_argument("--seed", type=int, default=0, help="Hạt giống đầu tiên")
+    parser.add_argument("--duration", type=int, default=600, help="Thời gian mô phỏng firmware mỗi hạt giống (giây)")
+    parser.add_argument("--fuzz", type=int, default=20000, help="Số dòng fuzz mỗi hạt giống")
+    parser.add_argument("--no-bench", action="store_true", help="Bỏ qua phần đo thông lượng")
+    parser.add_argument("--lines", type=int, default=50000, help="Số dòng khi đo thông lượng")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần phát lại khi đo thông lượng")
+    parser.add_argument("--history", help="File JSONL lưu lịch sử thông lượng (mỗi lần chạy thêm một dòng)")
+    parser.add_argument("--window", type=int, default=5, help="Số lần chạy gần nhất dùng làm mốc so sánh")
+    parser.add_argument("--max-regression", type=float, default=0.15,
+                        help="Mức giảm thông lượng tối đa so với trung vị lịch sử (mặc định 0.15 = 15%%)")
+    args = parser.parse_args(argv)
+
+    checker = Checker()
+    started = time.perf_counter()
+    for seed in range(args.seed, args.seed + args.seeds):
+        check_against_firmware(seed, args.duration * 1000, checker=checker)
+        fuzz_lines(seed, args.fuzz, checker=checker)
+        fuzz_bytes(seed, args.fuzz // 10, checker=checker)
+    print(f"Tuân thủ: {checker.checks:,} phép kiểm tra, {len(checker.failures)} vi phạm "
+          f"({time.perf_counter() - started:.1f}s)")
+    for failure in checker.failures:
+        print(f"VI PHẠM: {failure}")
+    status = 1 if checker.failures else 0
+
+    if not args.no_bench:
+        throughput = measure_throughput(args.seed, args.lines, args.repeat)
+        for name, result in throughput.items():
+            print(f"Thông lượng {name}: {result['lines_per_sec']:,.0f} dòng/s | p99 {result['p99_us']:.2f} µs")
+        if args.history:
+            history = load_history(args.history)
+            problems = check_history(history, throughput, args.window, args.max_regression)
+            for problem in problems:
+                print(f"HỒI QUY: {problem}")
+            if problems:
+                status = 1
+            entry = {"time": datetime.now().isoformat(timespec="seconds"), "revision": git_revision(),
+                     "python": sys.version.split()[0], "throughput": throughput}
+            with open(args.history, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+import threading
+import time
+from collections import namedtuple
+
+import serial
+
+from protocol import StatusFrame
+from engine import VALID_COLORS, parse_uint
+from serial_reader import MultiSerialReader, SerialLineReader
+
+# Các trạng thái kết nối
+STATE_CONNECTING = "CONNECTING"     # Đang mở cổng
+STATE_WAITING_READY = "WAITING"     # Đã mở cổng, chờ khung "S," hợp lệ đầu tiên
+STATE_CONNECTED = "CONNECTED"       # Đã nhận khung hợp lệ: ESP32 sẵn sàng
+STATE_DISCONNECTED = "DISCONNECTED" # Mở cổng thất bại hoặc mất kết nối, sẽ thử lại
+STATE_CLOSED = "CLOSED"             # Đã dừng hẳn (đóng ứng dụng)
+
+RECONNECT_INITIAL_DELAY = 0.5 # Thời gian chờ (giây) trước lần thử lại đầu tiên
+RECONNECT_MAX_DELAY = 30.0    # Thời gian chờ tối đa (giây) giữa các lần thử lại (tăng gấp đôi mỗi lần)
+
+# Sự kiện thay đổi trạng thái kết nối
+# attempt: số lần thử hiện tại, retry_in: số giây trước lần thử lại, error: lỗi gây mất kết nối
+ConnectionState = namedtuple("ConnectionState", "state attempt retry_in error")
+
+
+def is_ready_frame(item):
+    """
+    Kiểm tra một mục có phải khung trạng thái hợp lệ hay không (dùng để xác nhận ESP32 sẵn sàng).
+    """
+    if item.__class__ is StatusFrame:
+        return True
+    if not item.startswith("S,"):
+        return False
+    parts = item.split(",")
+    return (len(parts) in (5, 7) and parts[1] in VALID_COLORS and parts[3] in VALID_COLORS
+            and parse_uint(parts[2]) is not None and parse_uint(parts[4]) is not None)
+
+
+class SerialConnection:
+    """
+    Quản lý kết nối Serial trên một luồng nền: mở cổng, khởi động luồng đọc,
+    phát hiện mất kết nối (SerialException khi đọc) và tự kết nối lại với thời gian chờ
+    tăng theo cấp số nhân. ESP32 được coi là sẵn sàng khi nhận khung trạng thái hợp lệ đầu tiên,
+    thay vì chờ cố định sau khi mở cổng. Mọi thay đổi trạng thái được báo qua on_state()
+    (gọi trên luồng nền, không chặn luồng giao diện).
+    """
+    def __init__(self, port, baudrate, on_item, on_state, reader_mode="auto",
+                 initial_delay=RECONNECT_INITIAL_DELAY, max_delay=RECONNECT_MAX_DELAY, open_port=serial.Serial,
+                 metrics=None):
+        """
+        Args:
+            port (str): Tên cổng Serial (ví dụ "COM5", "/dev/ttyUSB0").
+            baudrate (int): Tốc độ baud.
+            on_item (callable): Hàm được gọi (trên luồng đọc) cho mỗi dòng/khung nhận được.
+            on_state (callable): Hàm được gọi với ConnectionState khi trạng thái kết nối thay đổi.
+            reader_mode (str): Chế độ của SerialLineReader ("auto", "blocking", "selector").
+            initial_delay (float): Thời gian chờ (giây) trước lần thử lại đầu tiên.
+            max_delay (float): Thời gian chờ tối đa (giây) giữa các lần thử lại.
+            open_port (callable): Hàm mở cổng, mặc định serial.Serial.
+            metrics (PipelineMetrics): Bộ đo truyền cho luồng đọc (None: không đo).
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.on_item = on_item
+        self.on_state = on_state
+        self.reader_mode = reader_mode
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.open_port = open_port
+        self.metrics = metrics
+        self.ser = None # Kết nối Serial hiện tại (None khi chưa kết nối)
+        self.reader = None
+        self.state = None
+        self.ready = False
+        self.lost_error = None # Lỗi làm mất kết nối hiện tại
+        self._wake = threading.Event() # Đánh thức luồng quản lý: sẵn sàng, mất kết nối hoặc dừng
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="serial-connection", daemon=True)
+
+    def start(self):
+        """
+        Bắt đầu luồng quản lý kết nối.
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Dừng luồng quản lý (và luồng đọc), đóng cổng.
+        """
+        self._stop_event.set()
+        self._wake.set()
+
+    def join(self, timeout=None):
+        """
+        Chờ luồng quản lý kết thúc.
+
+        Returns:
+            bool: True nếu luồng đã dừng.
+        """
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    @property
+    def is_connected(self):
+        return self.state == STATE_CONNECTED
+
+    def _set_state(self, state, attempt=0, retry_in=None, error=None):
+        self.state = state
+        self.on_state(ConnectionState(state, attempt, retry_in, error))
+
+    def _on_item(self, item):
+        """
+        Được gọi trên luồng đọc: chuyển mục cho nơi xử lý và xác nhận ESP32 sẵn sàng.
+        """
+        if not self.ready and is_ready_frame(item):
+            self.ready = True
+            self._wake.set()
+        self.on_item(item)
+
+    def _on_reader_error(self, error):
+        """
+        Được gọi trên luồng đọc khi đọc lỗi (thường là rút cáp USB).
+        """
+        self.lost_error = error
+        self._wake.set()
+
+    def _run(self):
+        stop_event = self._stop_event
+        delay = self.initial_delay
+        attempt = 0
+        while not stop_event.is_set():
+            attempt += 1
+            self._set_state(STATE_CONNECTING, attempt)
+            try:
+                # write_timeout: ghi bị treo sẽ báo lỗi thay vì chặn luồng ghi lệnh mãi mãi
+                self.ser = self.open_port(self.port, self.baudrate, timeout=1, write_timeout=2)
+            except (serial.SerialException, OSError, ValueError) as e:
+                self._set_state(STATE_DISCONNECTED, attempt, delay, e)
+                stop_event.wait(delay)
+                delay = min(delay * 2, self.max_delay)
+                continue
+
+            self.ready = False
+            self.lost_error = None
+            self._wake.clear()
+            self.reader = SerialLineReader(self.ser, self._on_item, on_error=self._on_reader_error,
+                                           mode=self.reader_mode, metrics=self.metrics)
+            self.reader.start()
+            self._set_state(STATE_WAITING_READY, attempt)
+
+            # Chờ khung hợp lệ đầu tiên, mất kết nối hoặc yêu cầu dừng
+            while not stop_event.is_set() and self.lost_error is None:
+                self._wake.wait()
+                self._wake.clear()
+                if self.ready and self.state != STATE_CONNECTED:
+                    self._set_state(STATE_CONNECTED, attempt)
+                    delay = self.initial_delay
+                    attempt = 0
+
+            self._close_port()
+            if not stop_event.is_set():
+                self._set_state(STATE_DISCONNECTED, attempt, delay, self.lost_error)
+                stop_event.wait(delay)
+                delay = min(delay * 2, self.max_delay)
+        self._set_state(STATE_CLOSED)
+
+    def _close_port(self):
+        """
+        Dừng luồng đọc và đóng cổng hiện tại.
+        """
+        if self.reader:
+            self.reader.stop()
+            self.reader.join(timeout=2)
+            self.reader = None
+        ser, self.ser = self.ser, None
+        if ser:
+            try:
+                ser.close()
+            except Exception:
+                pass
+
+
+class PortLink:
+    """
+    Trạng thái kết nối của một cổng trong MultiSerialConnection.
+    """
+    def __init__(self, port, baudrate, on_item, initial_delay):
+        self.port = port
+        self.baudrate = baudrate
+        self.on_item = on_item
+        self.ser = None # Kết nối Serial hiện tại (None khi chưa kết nối)
+        self.state = None
+        self.attempt = 0
+        self.delay = initial_delay # Thời gian chờ trước lần thử lại kế tiếp
+        self.retry_at = 0.0 # Thời điểm (monotonic) được thử mở lại cổng
+        self.ready = False
+        self.lost_error = None # Lỗi đọc làm mất kết nối, chờ luồng quản lý xử lý
+
+
+class MultiSerialConnection:
+    """
+    Quản lý kết nối của nhiều cổng Serial dùng chung một luồng đọc MultiSerialReader (supervisor).
+    Một luồng nền duy nhất mở các cổng, gỡ cổng đọc lỗi khỏi luồng đọc rồi mở lại nó với thời gian chờ
+    tăng theo cấp số nhân riêng cho từng cổng; các cổng khác không bị ảnh hưởng. Trạng thái giống
+    SerialConnection (ESP32 sẵn sàng khi nhận khung hợp lệ đầu tiên) và được báo qua on_state(key, state)
+    trên luồng nền.
+    """
+    def __init__(self, on_state, reader_mode="auto", initial_delay=RECONNECT_INITIAL_DELAY,
+                 max_delay=RECONNECT_MAX_DELAY, open_port=serial.Serial):
+        """
+        Args:
+            on_state (callable): Hàm on_state(key, ConnectionState) khi trạng thái của một cổng thay đổi.
+            reader_mode (str): Chế độ của MultiSerialReader ("auto", "selector", "polling").
+            initial_delay (float): Thời gian chờ (giây) trước lần thử lại đầu tiên.
+            max_delay (float): Thời gian chờ tối đa (giây) giữa các lần thử lại.
+            open_port (callable): Hàm mở cổng, mặc định serial.Serial.
+        """
+        self.on_state = on_state
+        self.reader_mode = reader_mode
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.open_port = open_port
+        self.links = {} # key -> PortLink
+        self.reader = MultiSerialReader(on_error=self._on_reader_error)
+        self._wake = threading.Event() # Đánh thức luồng quản lý: sẵn sàng, mất kết nối hoặc dừng
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="multi-serial-connection", daemon=True)
+
+    def add(self, key, port, baudrate, on_item):
+        """
+        Khai báo một cổng cần quản lý (gọi trước start()).
+
+        Args:
+            key: Khóa nhận diện cổng (ví dụ tên ngã tư).
+            port (str): Tên cổng Serial.
+            baudrate (int): Tốc độ baud.
+            on_item (callable): Hàm được gọi (trên luồng đọc chung) cho mỗi dòng/khung của cổng này.
+        """
+        self.links[key] = PortLink(port, baudrate, on_item, self.initial_delay)
+
+    def serial(self, key):
+        """
+        Trả về đối tượng Serial hiện tại của một cổng (None khi chưa kết nối), an toàn luồng.
+        """
+        link = self.links.get(key)
+        return link.ser if link else None
+
+    def start(self):
+        """
+        Bắt đầu luồng quản lý kết nối (luồng đọc chung được khởi động sau lần mở cổng đầu tiên).
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Dừng luồng quản lý và luồng đọc, đóng mọi cổng.
+        """
+        self._stop_event.set()
+        self._wake.set()
+
+    def join(self, timeout=None):
+        """
+        Chờ luồng quản lý kết thúc.
+
+        Returns:
+            bool: True nếu luồng đã dừng.
+        """
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _set_state(self, key, link, state, retry_in=None, error=None):
+        link.state = state
+        self.on_state(key, ConnectionState(state, link.attempt, retry_in, error))
+
+    def _on_item(self, link, item):
+        """
+        Được gọi trên luồng đọc chung: xác nhận ESP32 sẵn sàng rồi chuyển mục cho nơi xử lý.
+        """
+        if not link.ready and is_ready_frame(item):
+            link.ready = True
+            self._wake.set()
+        link.on_item(item)
+
+    def _on_reader_error(self, key, error):
+        """
+        Được gọi trên luồng đọc chung khi một cổng lỗi (cổng đã bị gỡ khỏi luồng đọc).
+        """
+        link = self.links.get(key)
+        if link is not None:
+            link.lost_error = error
+            self._wake.set()
+
+    def _open(self, key, link):
+        """
+        Thử mở một cổng và thêm vào luồng đọc chung; thất bại thì hẹn lần thử lại.
+        """
+        link.attempt += 1
+        self._set_state(key, link, STATE_CONNECTING)
+        try:
+            # timeout=0: luồng đọc chung không bao giờ chặn trên một cổng;
+            # write_timeout: ghi bị treo sẽ báo lỗi thay vì chặn luồng ghi lệnh mãi mãi
+            ser = self.open_port(link.port, link.baudrate, timeout=0, write_timeout=2)
+        except (serial.SerialException, OSError, ValueError) as e:
+            self._schedule_retry(key, link, e)
+            return
+        link.ready = False
+        link.lost_error = None
+        link.ser = ser
+        self.reader.add(key, ser, lambda item, link=link: self._on_item(link, item))
+        self._set_state(key, link, STATE_WAITING_READY)
+
+    def _drop(self, key, link):
+        """
+        Gỡ cổng mất kết nối khỏi luồng đọc, đóng nó và hẹn lần mở lại.
+        """
+        error, link.lost_error = link.lost_error, None
+        self.reader.remove(key)
+        ser, link.ser = link.ser, None
+        if ser:
+            try:
+                ser.close()
+            except Exception:
+                pass
+        self._schedule_retry(key, link, error)
+
+    def _schedule_retry(self, key, link, error):
+        self._set_state(key, link, STATE_DISCONNECTED, link.delay, error)
+        link.retry_at = time.monotonic() + link.delay
+        link.delay = min(link.delay * 2, self.max_delay)
+
+    def _run(self):
+        stop_event = self._stop_event
+        # Mở mọi cổng trước khi khởi động luồng đọc để chế độ "auto" chọn được selector hay quét
+        for key, link in self.links.items():
+            self._open(key, link)
+        self.reader.start(self.reader_mode)
+        while not stop_event.is_set():
+            self._wake.clear()
+            now = time.monotonic()
+            timeout = None
+            for key, link in self.links.items():
+                if link.lost_error is not None:
+                    self._drop(key, link)
+                elif link.ready and link.state == STATE_WAITING_READY:
+                    self._set_state(key, link, STATE_CONNECTED)
+                    link.delay = self.initial_delay
+                    link.attempt = 0
+                if link.ser is None:
+                    if now >= link.retry_at:
+                        self._open(key, link)
+                    if link.ser is None:
+                        wait = max(link.retry_at - now, 0)
+                        timeout = wait if timeout is None else min(timeout, wait)
+            self._wake.wait(timeout)
+        self.reader.stop()
+        self.reader.join(timeout=2)
+        for key, link in self.links.items():
+            ser, link.ser = link.ser, None
+            if ser:
+                try:
+                    ser.close()
+                except Exception:
+                    pass
+            self._set_state(key, link, STATE_CLOSED)
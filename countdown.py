@@ -0,0 +1,119 @@
+import time
+
+SPARSE_SYNC_INTERVAL_MS = 5000 # Chu kỳ khung đồng bộ mặc định của firmware ở chế độ khung thưa
+DRIFT_TOLERANCE = 0.25 # Độ lệch (giây) giữa đồng hồ cục bộ và ESP32 được coi là bình thường
+
+
+class CountdownModel:
+    """
+    Mô hình đếm ngược theo đồng hồ đơn điệu (time.monotonic) cho chế độ khung thưa ("PROTO,SPARSE"):
+    ESP32 chỉ gửi khung khi chuyển pha và khung đồng bộ định kỳ, kèm thời gian còn lại tính bằng mili giây.
+    Mỗi khung neo lại thời điểm kết thúc pha của từng mạch; giữa hai khung, số giây hiển thị
+    được nội suy cục bộ (làm tròn xuống như firmware, dừng ở 0 cho tới khung chuyển pha kế tiếp).
+    Khi khung đồng bộ tới, giá trị dự đoán được so với giá trị ESP32 báo để phát hiện lệch đồng hồ.
+    """
+    def __init__(self, sync_interval_ms=SPARSE_SYNC_INTERVAL_MS, tolerance=DRIFT_TOLERANCE):
+        """
+        Args:
+            sync_interval_ms (int): Chu kỳ khung đồng bộ mà ESP32 xác nhận.
+            tolerance (float): Ngưỡng lệch (giây) để coi là lệch đồng hồ.
+        """
+        self.sync_interval_ms = sync_interval_ms
+        self.tolerance = tolerance
+        self.m1_color = None
+        self.m2_color = None
+        self.m1_end = 0.0 # Thời điểm (monotonic) pha hiện tại của Mạch 1 kết thúc
+        self.m2_end = 0.0
+        self.synced_at = None # Thời điểm nhận khung gần nhất
+        self.syncs = 0 # Số khung đã nhận
+        self.drift = 0.0 # Độ lệch của khung đồng bộ gần nhất (giây, dương: đếm cục bộ chậm hơn ESP32)
+        self.max_drift = 0.0 # Độ lệch tuyệt đối lớn nhất
+        self.drift_warnings = 0 # Số khung đồng bộ lệch quá ngưỡng
+        self.restarted = False # Chu kỳ vừa được đặt lại (SET, NORMAL...): khung kế tiếp không dùng để đo lệch
+
+    def sync(self, m1_color, m1_ms, m2_color, m2_ms, now=None):
+        """
+        Neo lại mô hình theo một khung của ESP32.
+
+        Args:
+            m1_color (str): Màu Mạch 1.
+            m1_ms (int): Thời gian còn lại của pha Mạch 1 (mili giây).
+            m2_color (str): Màu Mạch 2.
+            m2_ms (int): Thời gian còn lại của pha Mạch 2 (mili giây).
+            now (float): Thời điểm nhận khung (time.monotonic()), mặc định lúc gọi.
+
+        Returns:
+            float: Độ lệch (giây) nếu đây là khung đồng bộ giữa pha và vượt ngưỡng, ngược lại None.
+        """
+        if now is None:
+            now = time.monotonic()
+        drift = None
+        # Chỉ so sánh khi pha không đổi: khung chuyển pha không có giá trị dự đoán để đối chiếu
+        if (self.synced_at is not None and not self.restarted
+                and m1_color == self.m1_color and m2_color == self.m2_color):
+            errors = []
+            if self.m1_end > now: # Pha đã hết hạn thì giá trị dự đoán đã bị chặn ở 0
+                errors.append((self.m1_end - now) - m1_ms / 1000)
+            if self.m2_end > now:
+                errors.append((self.m2_end - now) - m2_ms / 1000)
+            if errors:
+                self.drift = max(errors, key=abs)
+                if abs(self.drift) > self.max_drift:
+                    self.max_drift = abs(self.drift)
+                if abs(self.drift) > self.tolerance:
+                    self.drift_warnings += 1
+                    drift = self.drift
+        self.m1_color = m1_color
+        self.m2_color = m2_color
+        self.m1_end = now + m1_ms / 1000
+        self.m2_end = now + m2_ms / 1000
+        self.synced_at = now
+        self.syncs += 1
+        self.restarted = False
+        return drift
+
+    def restart(self):
+        """
+        Báo ESP32 vừa đặt lại chu kỳ (SET, NORMAL, tắt khẩn cấp): khung kế tiếp chỉ neo lại mô hình.
+        """
+        self.restarted = True
+
+    def hold(self, m1_color, m2_color, now=None):
+        """
+        Đặt màu đã biết mà không kèm thời gian (ví dụ thông báo khẩn cấp): cả hai mạch dừng ở 0
+        cho tới khung kế tiếp, không tính là khung đồng bộ.
+        """
+        if now is None:
+            now = time.monotonic()
+        self.m1_color = m1_color
+        self.m2_color = m2_color
+        self.m1_end = self.m2_end = now
+        self.restarted = True
+        if self.synced_at is None:
+            self.synced_at = now
+
+    def current(self, now=None):
+        """
+        Trạng thái nội suy tại thời điểm now.
+
+        Returns:
+            tuple: (màu M1, giây M1, màu M2, giây M2), hoặc None nếu chưa nhận khung nào.
+        """
+        if self.synced_at is None:
+            return None
+        if now is None:
+            now = time.monotonic()
+        m1_left = self.m1_end - now
+        m2_left = self.m2_end - now
+        return (self.m1_color, int(m1_left) if m1_left > 0 else 0,
+                self.m2_color, int(m2_left) if m2_left > 0 else 0)
+
+    def is_stale(self, now=None):
+        """
+        Quá hai chu kỳ đồng bộ mà không nhận được khung nào (mất liên lạc hoặc ESP32 đã khởi động lại).
+        """
+        if self.synced_at is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now - self.synced_at > 2 * self.sync_interval_ms / 1000
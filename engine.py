@@ -0,0 +1,306 @@
+from collections import namedtuple
+
+from countdown import CountdownModel
+from protocol import PROTO_ACK_PREFIX, StatusFrame
+
+VALID_COLORS = frozenset(("RED", "GREEN", "YELLOW"))
+MAX_UINT_DIGITS = 10 # unsigned long 32 bit của ESP32: tối đa 10 chữ số thập phân
+
+# Trạng thái tổng thể của hệ thống
+STATUS_NORMAL = "NORMAL"                       # Hoạt động bình thường
+STATUS_YELLOW_TRANSITION = "YELLOW_TRANSITION" # Đang có đèn vàng (chuyển pha / trước khẩn cấp)
+STATUS_EMERGENCY_1 = "EMERGENCY_1"             # Khẩn cấp Mạch 1 (ESP32 thông báo)
+STATUS_EMERGENCY_2 = "EMERGENCY_2"             # Khẩn cấp Mạch 2 (ESP32 thông báo)
+STATUS_SAFE = "SAFE"                           # An toàn, cả hai đỏ (ESP32 thông báo)
+STATUS_EMERGENCY_1_DETECTED = "EMERGENCY_1_DETECTED" # Khẩn cấp Mạch 1 suy ra từ khung "S,"
+STATUS_EMERGENCY_2_DETECTED = "EMERGENCY_2_DETECTED" # Khẩn cấp Mạch 2 suy ra từ khung "S,"
+STATUS_SAFE_DETECTED = "SAFE_DETECTED"         # Cả hai đỏ suy ra từ khung "S,"
+STATUS_UNKNOWN = "UNKNOWN"                     # Không xác định
+
+# Nhóm tin nhắn nhật ký
+LOG_EMERGENCY = "emergency" # Thông báo bật/tắt khẩn cấp
+LOG_WARNING = "warning"     # Cảnh báo từ ESP32
+LOG_ERROR = "error"         # Dữ liệu lỗi, không đúng định dạng
+LOG_INFO = "info"           # Thông tin (ví dụ: cập nhật thời gian pha)
+LOG_DEBUG = "debug"         # Các thông báo khác từ ESP32
+
+# Các sự kiện phát ra khi trạng thái thay đổi
+LightsChanged = namedtuple("LightsChanged", "m1_color m1_secs m2_color m2_secs")
+StatusChanged = namedtuple("StatusChanged", "status")
+EmergencyModeChanged = namedtuple("EmergencyModeChanged", "mode")
+PhaseTimesUpdated = namedtuple("PhaseTimesUpdated", "color seconds opposing_seconds")
+LogMessage = namedtuple("LogMessage", "category text")
+ProtocolChanged = namedtuple("ProtocolChanged", "mode interval_ms") # mode: "BIN", "TEXT" hoặc "SPARSE"
+
+# Định dạng khung trạng thái (phản hồi "PROTO_OK,<chế độ>") -> mô tả trong nhật ký
+PROTOCOL_NAMES = {
+    "TEXT": "khung văn bản",
+    "BIN": "khung nhị phân",
+    "SPARSE": "khung thưa (đếm ngược cục bộ)",
+}
+
+def parse_uint(text):
+    """
+    Đọc số nguyên không dấu do firmware in ra (Serial.print của unsigned long).
+    Chỉ chấp nhận chữ số ASCII: int() của Python còn nhận dấu, khoảng trắng, dấu gạch dưới
+    và chữ số Unicode, còn str.isdigit() nhận cả "²" mà int() không đọc được.
+
+    Returns:
+        int: Giá trị, hoặc None nếu không hợp lệ.
+    """
+    if text.isdigit() and text.isascii() and len(text) <= MAX_UINT_DIGITS:
+        return int(text)
+    return None
+
+
+# Thông báo khẩn cấp: chuỗi nhận diện -> (màu Mạch 1, màu Mạch 2, trạng thái, chế độ khẩn cấp)
+EMERGENCY_ANNOUNCEMENTS = (
+    ("MẠCH 1 XANH", "GREEN", "RED", STATUS_EMERGENCY_1, 1),
+    ("MẠCH 2 XANH", "RED", "GREEN", STATUS_EMERGENCY_2, 2),
+    ("CẢ HAI ĐỎ", "RED", "RED", STATUS_SAFE, 3),
+)
+
+
+class IntersectionState:
+    """
+    Bộ máy trạng thái của một ngã tư, không phụ thuộc Tkinter (headless).
+    Nhận từng dòng dữ liệu Serial của ESP32, cập nhật màu đèn, thời gian đếm ngược,
+    chế độ khẩn cấp, trạng thái hệ thống và phát sự kiện có kiểu khi có thay đổi.
+    Giao diện Tkinter đăng ký nhận sự kiện; bench.py đo hiệu năng trực tiếp trên lớp này.
+    """
+    def __init__(self):
+        self.m1_color = None
+        self.m1_secs = None
+        self.m2_color = None
+        self.m2_secs = None
+        self.status = None
+        self.emergency_mode = 0 # 0: bình thường, 1: E1, 2: E2, 3: E3
+        self.protocol = "TEXT" # Định dạng khung trạng thái ESP32 đang gửi: "TEXT", "BIN" hoặc "SPARSE"
+        # Mô hình đếm ngược cục bộ ở chế độ khung thưa (CountdownModel), None ở các chế độ khác
+        self.countdown = None
+        self.countdown_stale = False # Đã báo mất khung đồng bộ
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """
+        Đăng ký nhận sự kiện.
+
+        Args:
+            callback (callable): Hàm được gọi với từng sự kiện (LightsChanged, StatusChanged...).
+        """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Hủy đăng ký nhận sự kiện.
+        """
+        self.subscribers.remove(callback)
+
+    def emit(self, event):
+        for callback in self.subscribers:
+            callback(event)
+
+    def reset(self):
+        """
+        Xóa trạng thái đã biết (ví dụ sau khi kết nối lại) để khung tiếp theo được phát lại đầy đủ.
+        """
+        self.m1_color = self.m1_secs = self.m2_color = self.m2_secs = None
+        self.status = None
+        # ESP32 khởi động lại khi mở cổng và quay về khung "S," định kỳ cho tới khi thỏa thuận lại
+        self.protocol = "TEXT"
+        self.countdown = None
+
+    def set_lights(self, m1_color, m1_secs, m2_color, m2_secs):
+        """
+        Cập nhật màu đèn và thời gian; chỉ phát LightsChanged khi có thay đổi.
+        """
+        if (m1_color != self.m1_color or m1_secs != self.m1_secs
+                or m2_color != self.m2_color or m2_secs != self.m2_secs):
+            self.m1_color = m1_color
+            self.m1_secs = m1_secs
+            self.m2_color = m2_color
+            self.m2_secs = m2_secs
+            self.emit(LightsChanged(m1_color, m1_secs, m2_color, m2_secs))
+
+    def set_status(self, status):
+        """
+        Cập nhật trạng thái hệ thống; chỉ phát StatusChanged khi có thay đổi.
+        """
+        if status != self.status:
+            self.status = status
+            self.emit(StatusChanged(status))
+
+    def set_emergency_mode(self, mode):
+        """
+        Cập nhật chế độ khẩn cấp; chỉ phát EmergencyModeChanged khi có thay đổi.
+        """
+        if mode != self.emergency_mode:
+            self.emergency_mode = mode
+            self.emit(EmergencyModeChanged(mode))
+
+    def log(self, category, text):
+        self.emit(LogMessage(category, text))
+
+    def feed(self, line):
+        """
+        Phân tích cú pháp một dòng dữ liệu nhận được từ Serial và cập nhật trạng thái.
+
+        Args:
+            line (str | StatusFrame): Dòng dữ liệu từ Serial (đã loại bỏ khoảng trắng)
+                hoặc khung trạng thái nhị phân đã giải mã.
+        """
+        if line.__class__ is StatusFrame: # Khung nhị phân: không cần phân tích chuỗi
+            self.update_status(line.m1_color, line.m1_secs, line.m2_color, line.m2_secs)
+        elif line.startswith("S,"): # Dữ liệu trạng thái đèn
+            self.feed_status_line(line)
+        elif line.startswith(">>> KHẨN CẤP:"): # Thông báo chế độ khẩn cấp
+            for marker, m1_color, m2_color, status, mode in EMERGENCY_ANNOUNCEMENTS:
+                if marker in line:
+                    if self.countdown: # Không để đếm ngược nội suy ghi đè màu khẩn cấp
+                        self.countdown.hold(m1_color, m2_color)
+                    self.set_lights(m1_color, 0, m2_color, 0)
+                    self.set_status(status)
+                    self.set_emergency_mode(mode)
+                    break
+            self.log(LOG_EMERGENCY, line)
+        elif "TẮT KHẨN CẤP" in line: # Thông báo tắt chế độ khẩn cấp
+            if self.countdown:
+                self.countdown.restart()
+            self.set_status(STATUS_NORMAL)
+            self.set_emergency_mode(0)
+            self.log(LOG_EMERGENCY, line)
+        elif line.startswith("SET_UPDATED,"): # Phản hồi khi đặt thời gian pha
+            if self.countdown: # Chu kỳ được đặt lại: khung kế tiếp không phải khung đồng bộ
+                self.countdown.restart()
+            parts = line.split(",")
+            if len(parts) == 4:
+                _, color_type, val1, val2 = parts
+                self.log(LOG_INFO, f"Thời gian pha được cập nhật: Màu {color_type} = {val1}s, "
+                                   f"Đỏ đối diện = {val2}s. Chu kỳ được đặt lại.")
+                seconds = parse_uint(val1)
+                opposing_seconds = parse_uint(val2)
+                if seconds is not None and opposing_seconds is not None:
+                    self.emit(PhaseTimesUpdated(color_type, seconds, opposing_seconds))
+            else:
+                self.log(LOG_ERROR, f"Dữ liệu SET_UPDATED không đúng định dạng: {line}")
+        elif line.startswith(PROTO_ACK_PREFIX): # Xác nhận thỏa thuận định dạng khung
+            self.feed_protocol_ack(line)
+        elif line.startswith(">>> Cảnh báo:"): # Cảnh báo từ ESP32 (ví dụ: thời gian xanh tối thiểu)
+            self.log(LOG_WARNING, line)
+        else: # Các thông báo khác từ ESP32 (debug, v.v.)
+            self.log(LOG_DEBUG, f"ESP32: {line}")
+
+    def feed_protocol_ack(self, line):
+        """
+        Phân tích phản hồi "PROTO_OK,<BIN|TEXT|SPARSE>[,<chu kỳ ms>]" của ESP32.
+        """
+        parts = line.split(",")
+        mode = parts[1] if len(parts) > 1 else ""
+        if mode not in PROTOCOL_NAMES:
+            self.log(LOG_ERROR, f"Phản hồi PROTO_OK không đúng định dạng: {line}")
+            return
+        interval_ms = parse_uint(parts[2]) if len(parts) > 2 else None
+        self.protocol = mode
+        if mode == "SPARSE":
+            self.countdown = CountdownModel(interval_ms) if interval_ms else CountdownModel()
+            self.countdown_stale = False
+        else:
+            self.countdown = None
+        self.log(LOG_INFO, f"ESP32 chuyển sang {PROTOCOL_NAMES[mode]}"
+                           + (f", chu kỳ {interval_ms} ms" if interval_ms else ""))
+        self.emit(ProtocolChanged(mode, interval_ms))
+
+    def tick(self, now=None):
+        """
+        Cập nhật đếm ngược nội suy ở chế độ khung thưa (gọi định kỳ trên luồng GUI, ví dụ mỗi 10-50 ms).
+        Chỉ phát LightsChanged khi số giây hiển thị thay đổi; không làm gì ở các chế độ khác.
+
+        Args:
+            now (float): Thời điểm time.monotonic(), mặc định lúc gọi.
+        """
+        countdown = self.countdown
+        if countdown is None:
+            return
+        values = countdown.current(now)
+        if values is None:
+            return
+        m1_color, m1_secs, m2_color, m2_secs = values
+        if (m1_secs != self.m1_secs or m2_secs != self.m2_secs
+                or m1_color != self.m1_color or m2_color != self.m2_color):
+            self.update_status(m1_color, m1_secs, m2_color, m2_secs)
+        if countdown.is_stale(now):
+            if not self.countdown_stale:
+                self.countdown_stale = True
+                self.log(LOG_WARNING, f"Không nhận được khung đồng bộ trong "
+                                      f"{2 * countdown.sync_interval_ms / 1000:.0f}s – đếm ngược có thể sai")
+        else:
+            self.countdown_stale = False
+
+    def feed_status_line(self, line):
+        """
+        Phân tích khung trạng thái "S,<màu_m1>,<giây_m1>,<màu_m2>,<giây_m2>"
+        hoặc khung thưa "S,...,<ms_m1>,<ms_m2>" (kèm thời gian còn lại tính bằng mili giây).
+        """
+        parts = line.split(",")
+        if len(parts) == 7:
+            self.feed_sparse_frame(line, parts)
+            return
+        if len(parts) != 5:
+            self.log(LOG_ERROR, f"Dữ liệu Serial không đúng định dạng: {line}")
+            return
+        _, m1_color, m1_time, m2_color, m2_time = parts
+        if m1_color not in VALID_COLORS or m2_color not in VALID_COLORS:
+            self.log(LOG_ERROR, f"Dữ liệu màu không hợp lệ: {line}")
+            return
+        m1_secs = parse_uint(m1_time)
+        m2_secs = parse_uint(m2_time)
+        if m1_secs is None or m2_secs is None:
+            self.log(LOG_ERROR, f"Lỗi parse dữ liệu số trong dòng: {line}")
+            self.set_lights("NONE", 0, "NONE", 0) # Đặt đèn về trạng thái lỗi
+            return
+        self.update_status(m1_color, m1_secs, m2_color, m2_secs)
+
+    def feed_sparse_frame(self, line, parts):
+        """
+        Khung thưa: neo lại mô hình đếm ngược rồi áp dụng như khung thường.
+        Nếu chưa thỏa thuận (ví dụ kết nối lại khi ESP32 vẫn ở chế độ khung thưa), mô hình được tạo với chu kỳ mặc định.
+        """
+        _, m1_color, m1_time, m2_color, m2_time, m1_ms, m2_ms = parts
+        m1_secs = parse_uint(m1_time)
+        m2_secs = parse_uint(m2_time)
+        m1_ms = parse_uint(m1_ms)
+        m2_ms = parse_uint(m2_ms)
+        if (m1_color not in VALID_COLORS or m2_color not in VALID_COLORS or m1_secs is None
+                or m2_secs is None or m1_ms is None or m2_ms is None):
+            self.log(LOG_ERROR, f"Khung thưa không hợp lệ: {line}")
+            return
+        if self.countdown is None:
+            self.countdown = CountdownModel()
+            self.protocol = "SPARSE"
+        drift = self.countdown.sync(m1_color, m1_ms, m2_color, m2_ms)
+        if drift is not None:
+            self.log(LOG_WARNING, f"Đếm ngược cục bộ lệch {drift * 1000:+.0f} ms so với ESP32 – đã đồng bộ lại")
+        self.update_status(m1_color, m1_secs, m2_color, m2_secs)
+
+    def update_status(self, m1_color, m1_secs, m2_color, m2_secs):
+        """
+        Áp dụng một khung trạng thái đã giải mã: cập nhật đèn rồi suy ra trạng thái hệ thống.
+        Điều này đặc biệt quan trọng để nhận ra trạng thái khẩn cấp được kích hoạt từ ESP32.
+        """
+        self.set_lights(m1_color, m1_secs, m2_color, m2_secs)
+        # Nếu đang có đèn vàng ở một trong hai mạch, tức là đang trong pha chuyển tiếp
+        if m1_color == "YELLOW" or m2_color == "YELLOW":
+            self.set_status(STATUS_YELLOW_TRANSITION)
+        # Chỉ suy ra trạng thái nếu không ở chế độ khẩn cấp đã được kích hoạt từ nút nhấn/GUI
+        elif self.emergency_mode == 0:
+            if m1_secs == 0 and m2_secs == 0: # Thời gian về 0: chế độ khẩn cấp cứng
+                if m1_color == "RED" and m2_color == "RED":
+                    self.set_status(STATUS_SAFE_DETECTED)
+                elif m1_color == "GREEN" and m2_color == "RED":
+                    self.set_status(STATUS_EMERGENCY_1_DETECTED)
+                elif m2_color == "GREEN" and m1_color == "RED":
+                    self.set_status(STATUS_EMERGENCY_2_DETECTED)
+                else:
+                    self.set_status(STATUS_UNKNOWN)
+            else:
+                self.set_status(STATUS_NORMAL)
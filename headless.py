@@ -0,0 +1,233 @@
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+import engine
+from connection import STATE_CONNECTED, STATE_DISCONNECTED
+from command_writer import describe_result
+from pipeline import SerialPipeline
+
+
+def sd_notify(state):
+    """
+    Báo trạng thái cho systemd (Type=notify) qua $NOTIFY_SOCKET; không làm gì nếu không chạy dưới systemd.
+
+    Args:
+        state (str): Ví dụ "READY=1", "STOPPING=1", "STATUS=...".
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address[0] == "@": # Socket trừu tượng của Linux
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), address)
+    except OSError:
+        pass
+
+
+class HeadlessMonitor:
+    """
+    Chạy đường xử lý Serial của TrafficApp (SerialPipeline) không cần Tkinter, trên máy biên hoặc dịch vụ systemd:
+    một vòng lặp chính gọi SerialPipeline.process() ngay khi có dữ liệu hoặc sự kiện mới.
+    Sự kiện của bộ máy trạng thái được in ra dạng văn bản hoặc JSON (mỗi dòng một sự kiện).
+    """
+    def __init__(self, port, baudrate=115200, frame_protocol="text", frame_interval_ms=None,
+                 telemetry_dir=None, metrics=None, status_api=None, out=None, json_output=False, quiet=False,
+                 plan_table=None, adaptive=None, auto_e3=False):
+        """
+        Args:
+            port (str): Cổng Serial.
+            baudrate (int): Tốc độ baud.
+            frame_protocol (str): "text", "binary" hoặc "sparse".
+            frame_interval_ms (int): Chu kỳ khung nhị phân / khung đồng bộ (ms), None: mặc định firmware.
+            telemetry_dir (str): Thư mục ghi lịch sử pha đèn (None: không ghi).
+            metrics (MetricsRegistry): Đo hiệu năng (None: không đo).
+            status_api (StatusApi): API trạng thái HTTP/WebSocket (None: không bật).
+            out: Luồng xuất sự kiện (None: không in).
+            json_output (bool): In mỗi sự kiện thành một dòng JSON.
+            quiet (bool): Chỉ in kết nối, cảnh báo, lỗi và kết quả lệnh (bỏ thay đổi đèn).
+            plan_table (PlanTable): Bảng kế hoạch thời gian pha theo khung giờ (None: không dùng lịch).
+            adaptive (AdaptiveController): Điều khiển thời gian xanh thích ứng (None: không dùng).
+            auto_e3 (bool): Tự gửi E3 (cả hai đỏ) khi bộ giám sát an toàn phát hiện xung đột.
+        """
+        self.port = port
+        self.out = out
+        self.json_output = json_output
+        self.quiet = quiet
+        self.last_result = None # CommandResult gần nhất
+        self._wake = threading.Event() # Đánh thức vòng lặp chính khi có dữ liệu mới
+        self._stop_event = threading.Event()
+        self.pipeline = SerialPipeline(port, baudrate, frame_protocol=frame_protocol,
+                                       frame_interval_ms=frame_interval_ms, telemetry_dir=telemetry_dir,
+                                       metrics=metrics, status_api=status_api, plan_table=plan_table,
+                                       adaptive=adaptive, auto_e3=auto_e3,
+                                       on_connection_state=self.handle_connection_state,
+                                       on_command_result=self.handle_command_result,
+                                       on_safety_alarm=self.handle_safety_alarm,
+                                       report=self.report, wake=self._wake)
+        self.engine = self.pipeline.engine
+        self.engine.subscribe(self.on_engine_event)
+
+    @property
+    def connection_state(self):
+        return self.pipeline.connection_state
+
+    # ---- Vòng đời ----
+
+    def start(self):
+        """
+        Khởi động đường xử lý Serial: các luồng nền và kết nối Serial (không chặn).
+        """
+        self.pipeline.start()
+
+    def run(self, duration=None, tick=0.05):
+        """
+        Vòng lặp chính (chặn): xử lý dữ liệu ngay khi tới, tối đa mỗi tick giây khi rảnh
+        (để đếm ngược cục bộ của chế độ khung thưa và thỏa thuận định dạng khung vẫn chạy).
+
+        Args:
+            duration (float): Thời gian chạy (giây), None: tới khi stop().
+            tick (float): Thời gian chờ tối đa giữa hai nhịp xử lý.
+        """
+        deadline = time.monotonic() + duration if duration is not None else None
+        while not self._stop_event.is_set():
+            self._wake.wait(tick)
+            self._wake.clear()
+            self.process()
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+
+    def stop(self):
+        """
+        Yêu cầu vòng lặp chính dừng (an toàn luồng, dùng được trong trình xử lý tín hiệu).
+        """
+        self._stop_event.set()
+        self._wake.set()
+
+    def close(self):
+        """
+        Dừng mọi luồng nền, đóng cổng Serial và ghi nốt lịch sử còn chờ xuống đĩa.
+        """
+        self.pipeline.close()
+
+    # ---- Vòng lặp chính ----
+
+    def process(self):
+        """
+        Một nhịp xử lý của đường xử lý Serial (thay đổi kết nối, kết quả lệnh, cảnh báo an toàn, dữ liệu).
+        """
+        self.pipeline.process()
+
+    def handle_connection_state(self, event):
+        if event.state == STATE_CONNECTED:
+            self.report("system", f"Kết nối Serial thành công tại {self.port}")
+            sd_notify(f"STATUS=Đã kết nối {self.port}")
+        elif event.state == STATE_DISCONNECTED:
+            reason = f": {event.error}" if event.error else ""
+            self.report(engine.LOG_WARNING, f"Không có kết nối Serial tại {self.port}{reason}. "
+                                            f"Thử lại sau {event.retry_in:.1f}s")
+            sd_notify(f"STATUS=Mất kết nối {self.port}, thử lại sau {event.retry_in:.0f}s")
+
+    def handle_command_result(self, result):
+        self.last_result = result
+        described = describe_result(result)
+        if described:
+            self.report(*described)
+
+    def handle_safety_alarm(self, alarm):
+        if self.out is None:
+            return
+        if self.json_output:
+            self.write_json("SafetyAlarm", alarm._asdict())
+        else:
+            self.write_text(f"[{engine.LOG_ERROR if alarm.active else engine.LOG_WARNING}] AN TOÀN: {alarm.message}")
+
+    # ---- Gửi lệnh một lần ----
+
+    def wait_connected(self, timeout):
+        """
+        Xử lý dữ liệu tới khi ESP32 sẵn sàng (khung trạng thái hợp lệ đầu tiên) hoặc hết thời gian.
+
+        Returns:
+            bool: True nếu đã kết nối.
+        """
+        deadline = time.monotonic() + timeout
+        while self.connection_state != STATE_CONNECTED and not self._stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._wake.wait(min(remaining, 0.05))
+            self._wake.clear()
+            self.process()
+        return self.connection_state == STATE_CONNECTED
+
+    def execute(self, command, timeout):
+        """
+        Gửi một lệnh và chờ ESP32 xác nhận (vẫn xử lý dữ liệu nhận được trong lúc chờ).
+
+        Returns:
+            CommandResult: Kết quả, hoặc None nếu hết thời gian chờ.
+        """
+        self.last_result = None
+        if self.pipeline.command_writer.send(command):
+            self.report("system", f"Gửi lệnh: {command}")
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self._wake.wait(0.05)
+            self._wake.clear()
+            self.process()
+            result = self.last_result
+            if result is not None and result.command == command:
+                return result
+        return None
+
+    # ---- Xuất sự kiện ----
+
+    def on_engine_event(self, event):
+        if self.out is None:
+            return
+        kind = type(event)
+        if self.quiet and (kind is engine.LightsChanged or kind is engine.StatusChanged
+                           or (kind is engine.LogMessage and event.category in (engine.LOG_INFO, engine.LOG_DEBUG))):
+            return
+        if self.json_output:
+            self.write_json(kind.__name__, event._asdict())
+        elif kind is engine.LightsChanged:
+            self.write_text(f"M1 {event.m1_color} {event.m1_secs}s | M2 {event.m2_color} {event.m2_secs}s")
+        elif kind is engine.LogMessage:
+            self.write_text(f"[{event.category}] {event.text}")
+        elif kind is engine.StatusChanged:
+            self.write_text(f"Trạng thái: {event.status}")
+        elif kind is engine.EmergencyModeChanged:
+            self.write_text(f"Chế độ khẩn cấp: {event.mode or 'tắt'}")
+
+    def report(self, category, text):
+        """
+        In một thông báo của chính chương trình (kết nối, kết quả lệnh...).
+        """
+        if self.out is None or (self.quiet and category in (engine.LOG_INFO, "system")):
+            return
+        if self.json_output:
+            self.write_json("LogMessage", {"category": category, "text": text})
+        else:
+            self.write_text(f"[{category}] {text}")
+
+    def write_text(self, text):
+        self.write_line(f"{datetime.now().strftime('%H:%M:%S.%f')[:-3]} {text}")
+
+    def write_json(self, event, fields):
+        record = {"ts": round(time.time(), 3), "event": event}
+        record.update(fields)
+        self.write_line(json.dumps(record, ensure_ascii=False))
+
+    def write_line(self, line):
+        try:
+            print(line, file=self.out, flush=True)
+        except BrokenPipeError: # Nơi nhận đã đóng (ví dụ "| head"): ngừng in và dừng như khi nhận SIGTERM
+            self.out = None
+            self.stop()
@@ -0,0 +1,182 @@
+import tkinter as tk
+from collections import deque, namedtuple
+from datetime import datetime
+from itertools import islice
+
+import engine
+
+# Nhóm tin nhắn của ứng dụng (bổ sung cho các nhóm LOG_* của engine.py)
+CATEGORY_STATUS = "status" # Khung trạng thái "S,..." / khung nhị phân nhận được
+CATEGORY_SYSTEM = "system" # Kết nối, gửi lệnh và các thông báo khác của ứng dụng
+
+# Nhóm -> (nhãn bộ lọc, màu chữ)
+LOG_CATEGORIES = {
+    CATEGORY_STATUS: ("Khung trạng thái", "#64748b"),
+    engine.LOG_EMERGENCY: ("Khẩn cấp", "#f87171"),
+    engine.LOG_WARNING: ("Cảnh báo", "#fbbf24"),
+    engine.LOG_ERROR: ("Lỗi", "#fb923c"),
+    engine.LOG_INFO: ("Thông tin", "#4ade80"),
+    engine.LOG_DEBUG: ("ESP32 debug", "#94a3b8"),
+    CATEGORY_SYSTEM: ("Hệ thống", "#38bdf8"),
+}
+
+LogEntry = namedtuple("LogEntry", "timestamp category text")
+
+
+class LogBuffer:
+    """
+    Bộ đệm vòng (deque có maxlen) chứa toàn bộ nhật ký, kèm danh sách đã lọc theo nhóm.
+    Thêm một dòng là O(1); bộ lọc chỉ ẩn dòng khỏi danh sách hiển thị, không xóa khỏi bộ đệm.
+    """
+    def __init__(self, maxlen=5000, enabled=None):
+        """
+        Args:
+            maxlen (int): Số dòng tối đa được giữ lại.
+            enabled (iterable): Các nhóm được hiển thị (mặc định: tất cả).
+        """
+        self.entries = deque(maxlen=maxlen)
+        self.enabled = set(LOG_CATEGORIES if enabled is None else enabled)
+        self.visible = deque(maxlen=maxlen) # Các dòng thuộc nhóm đang bật, theo thứ tự thời gian
+        self.total = 0
+
+    def append(self, entry):
+        self.entries.append(entry)
+        self.total += 1
+        if entry.category in self.enabled:
+            self.visible.append(entry)
+
+    def set_enabled(self, category, enabled):
+        """
+        Bật/tắt hiển thị một nhóm và dựng lại danh sách đã lọc.
+        """
+        if enabled:
+            self.enabled.add(category)
+        else:
+            self.enabled.discard(category)
+        self.visible.clear()
+        self.visible.extend(entry for entry in self.entries if entry.category in self.enabled)
+
+    def window(self, first, count):
+        """
+        Các dòng đã lọc từ vị trí first, tối đa count dòng.
+        """
+        return list(islice(self.visible, first, first + count))
+
+
+class LogView(tk.Frame):
+    """
+    Khung nhật ký hệ thống ảo hóa: dữ liệu nằm trong LogBuffer, widget Text chỉ chứa
+    các dòng đang nhìn thấy và được vẽ lại tối đa mỗi refresh_ms mili giây
+    (thay cho việc chèn vào Text, cuộn và cắt bớt dòng ở mỗi tin nhắn).
+    Các ô chọn cho phép ẩn từng nhóm tin nhắn (ví dụ khung trạng thái 5 lần/giây) mà không làm mất dữ liệu.
+    """
+    def __init__(self, parent, height=6, maxlen=5000, refresh_ms=100, hidden=(), **kwargs):
+        """
+        Args:
+            parent: Widget cha.
+            height (int): Số dòng hiển thị ban đầu.
+            maxlen (int): Số dòng tối đa được giữ trong bộ đệm.
+            refresh_ms (int): Khoảng thời gian tối thiểu giữa hai lần vẽ lại.
+            hidden (iterable): Các nhóm bị ẩn ban đầu.
+        """
+        bg = kwargs.pop("bg", "#334155")
+        super().__init__(parent, bg=bg, **kwargs)
+        self.buffer = LogBuffer(maxlen, [category for category in LOG_CATEGORIES if category not in hidden])
+        self.refresh_ms = refresh_ms
+        self.rows = height
+        self.first = 0 # Vị trí dòng đầu tiên đang hiển thị trong danh sách đã lọc
+        self.follow = True # Tự cuộn theo dòng mới nhất (tắt khi người dùng cuộn lên)
+        self.refresh_pending = False
+
+        filter_frame = tk.Frame(self, bg=bg)
+        filter_frame.pack(side="top", fill="x")
+        self.filter_vars = {}
+        for category, (label, color) in LOG_CATEGORIES.items():
+            var = tk.BooleanVar(value=category in self.buffer.enabled)
+            tk.Checkbutton(filter_frame, text=label, variable=var, bg=bg, fg=color, selectcolor="#0f172a",
+                           activebackground=bg, font=("Arial", 8),
+                           command=lambda c=category, v=var: self.set_filter(c, v.get())).pack(side="left")
+            self.filter_vars[category] = var
+
+        self.text = tk.Text(self, height=height, bg="#0f172a", fg="#94a3b8", font=("Consolas", 9), wrap="none")
+        for category, (_, color) in LOG_CATEGORIES.items():
+            self.text.tag_configure(category, foreground=color)
+        self.scrollbar = tk.Scrollbar(self, command=self.on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+        self.text.pack(side="left", fill="both", expand=True)
+        # Cuộn do người dùng được xử lý trên danh sách ảo, không phải nội dung của Text
+        self.text.bind("<MouseWheel>", self.on_mousewheel)
+        self.text.bind("<Button-4>", lambda event: self.scroll_lines(-3) or "break")
+        self.text.bind("<Button-5>", lambda event: self.scroll_lines(3) or "break")
+        self.text.bind("<Configure>", self.on_resize)
+
+    def add(self, message, category=CATEGORY_SYSTEM):
+        """
+        Thêm một tin nhắn (O(1)); việc vẽ lại được gom lại và thực hiện sau tối đa refresh_ms.
+        """
+        self.buffer.append(LogEntry(datetime.now().strftime("[%H:%M:%S]"), category, message))
+        self.schedule_refresh()
+
+    def schedule_refresh(self):
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            self.after(self.refresh_ms, self.refresh)
+
+    def set_filter(self, category, enabled):
+        self.buffer.set_enabled(category, enabled)
+        self.follow = True
+        self.schedule_refresh()
+
+    def refresh(self):
+        """
+        Vẽ lại đúng các dòng đang nhìn thấy bằng một lần xóa và một lần chèn.
+        """
+        self.refresh_pending = False
+        total = len(self.buffer.visible)
+        if self.follow:
+            self.first = max(total - self.rows, 0)
+        else:
+            self.first = max(min(self.first, total - self.rows), 0)
+        chunks = []
+        for entry in self.buffer.window(self.first, self.rows):
+            chunks.append(f"{entry.timestamp} {entry.text}\n")
+            chunks.append(entry.category)
+        self.text.delete("1.0", tk.END)
+        if chunks:
+            self.text.insert("1.0", *chunks)
+        if total:
+            self.scrollbar.set(self.first / total, min((self.first + self.rows) / total, 1.0))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll_lines(self, delta):
+        total = len(self.buffer.visible)
+        self.first = max(min(self.first + delta, total - self.rows), 0)
+        self.follow = self.first >= total - self.rows
+        self.schedule_refresh()
+
+    def on_mousewheel(self, event):
+        self.scroll_lines(-3 if event.delta > 0 else 3)
+        return "break"
+
+    def on_scrollbar(self, action, *args):
+        """
+        Xử lý thanh cuộn trên danh sách ảo ("moveto" khi kéo, "scroll" khi bấm mũi tên/vùng trống).
+        """
+        total = len(self.buffer.visible)
+        if action == "moveto":
+            self.first = int(float(args[0]) * total)
+            self.scroll_lines(0)
+        elif action == "scroll":
+            amount = int(args[0])
+            self.scroll_lines(amount * self.rows if args[1] == "pages" else amount)
+
+    def on_resize(self, event):
+        """
+        Tính lại số dòng nhìn thấy khi khung nhật ký đổi kích thước.
+        """
+        line_height = self.text.tk.call("font", "metrics", self.text.cget("font"), "-linespace")
+        rows = max(int(event.height) // max(int(line_height), 1), 1)
+        if rows != self.rows:
+            self.rows = rows
+            self.schedule_refresh()
@@ -1,24 +1,86 @@
 import tkinter as tk
 from tkinter import messagebox
-import serial
-import threading
-import time
+import argparse
 from datetime import datetime
 import sys
 import os
+import secrets
+from time import perf_counter
+
+import engine
+import protocol
+from command_writer import describe_result
+from pipeline import SerialPipeline
+from log_view import LogView, CATEGORY_STATUS, CATEGORY_SYSTEM
+from metrics import MetricsExporter, MetricsRegistry
+from metrics_overlay import MetricsOverlay
+from status_api import StatusApi
+from scheduler import load_plan_table
+from adaptive import AdaptiveController
+from connection import STATE_CONNECTING, STATE_WAITING_READY, STATE_CONNECTED, STATE_DISCONNECTED
 
 # Cấu hình mã hóa console để hiển thị tiếng Việt đúng cách
 os.environ["PYTHONIOENCODING"] = "utf-8"
 sys.stdout.reconfigure(encoding='utf-8')
 
+# Màu tối (tắt) của từng bóng đèn
+LAMP_OFF_COLORS = {"red": "#4a0000", "yellow": "#4a4a00", "green": "#004a00"}
+# Kiểu hiển thị cho từng màu: (bóng đèn được bật, màu khi bật, nội dung nhãn trạng thái, màu chữ)
+LIGHT_STYLES = {
+    "RED": ("red", "#ff0000", "🔴 ĐÈN ĐỎ", "#ff4444"),
+    "YELLOW": ("yellow", "#ffff00", "🟡 ĐÈN VÀNG", "#ffaa00"),
+    "GREEN": ("green", "#00ff00", "🟢 ĐÈN XANH", "#44ff44"),
+}
+ERROR_LIGHT_STYLE = (None, None, "⚠️ LỖI DỮ LIỆU", "#ef4444") # Trạng thái không xác định hoặc lỗi
+# Chuỗi đếm ngược "MM:SS" tính sẵn cho 0..599 giây để không phải định dạng chuỗi mỗi khung
+COUNTDOWN_TEXTS = tuple(f"{secs // 60:02d}:{secs % 60:02d}" for secs in range(600))
+
+
+def countdown_text(time_remaining):
+    """
+    Trả về chuỗi đếm ngược "MM:SS" cho số giây còn lại (giá trị âm hiển thị "00:00").
+    """
+    if time_remaining < 0:
+        return COUNTDOWN_TEXTS[0]
+    if time_remaining < len(COUNTDOWN_TEXTS):
+        return COUNTDOWN_TEXTS[time_remaining]
+    return f"{time_remaining // 60:02d}:{time_remaining % 60:02d}"
+
+
 class TrafficLight(tk.Frame):
     """
     Lớp TrafficLight tạo một widget tùy chỉnh để hiển thị trạng thái của một đèn giao thông.
     Bao gồm các đèn (đỏ, vàng, xanh) và nhãn hiển thị trạng thái, thời gian đếm ngược.
     """
-    def __init__(self, parent, title, **kwargs):
+    def __init__(self, parent, title, compact=False, **kwargs):
+        """
+        Args:
+            parent: Widget cha.
+            title (str): Tiêu đề của đèn.
+            compact (bool): Dạng thu gọn (một canvas nhỏ chứa cả ba đèn xếp ngang),
+                dùng cho lưới nhiều ngã tư trong supervisor.py.
+        """
         super().__init__(parent, **kwargs)
         self.title = title
+        # Trạng thái đã vẽ lần trước, dùng để chỉ vẽ lại phần thay đổi
+        self.current_color = None
+        self.current_time = None
+        self.lit_lamp = None # Bóng đèn đang sáng ("red", "yellow", "green" hoặc None)
+        self.skipped_redraws = 0 # Số lần update_light() bỏ qua vì không có gì thay đổi
+        if compact:
+            self.build_compact(title)
+        else:
+            self.build_full(title)
+        self.lamps = {
+            "red": (self.red_light, self.red_circle),
+            "yellow": (self.yellow_light, self.yellow_circle),
+            "green": (self.green_light, self.green_circle),
+        }
+
+    def build_full(self, title):
+        """
+        Xây dựng dạng đầy đủ: ba canvas đèn xếp dọc, nhãn trạng thái và nhãn đếm ngược lớn.
+        """
 
         # Nhãn tiêu đề cho đèn giao thông cụ thể
         title_label = tk.Label(self, text=title, font=("Arial", 14, "bold"),
@@ -55,110 +117,284 @@ class TrafficLight(tk.Frame):
                                    relief="sunken", bd=2)
         self.time_label.pack(pady=5, padx=10, fill="x")
 
+    def build_compact(self, title):
+        """
+        Xây dựng dạng thu gọn: ba đèn nằm trên cùng một canvas để giảm số widget khi có nhiều ngã tư.
+        Các thuộc tính red_light/yellow_light/green_light đều trỏ tới canvas chung này
+        nên update_light() hoạt động như ở dạng đầy đủ.
+        """
+        tk.Label(self, text=title, font=("Arial", 9, "bold"), fg="white", bg="#334155").pack()
+
+        canvas = tk.Canvas(self, width=78, height=26, bg="#2c2c2c", highlightthickness=0)
+        canvas.pack(pady=2)
+        self.red_light = self.yellow_light = self.green_light = canvas
+        self.red_circle = canvas.create_oval(4, 3, 24, 23, fill="#4a0000", outline="#666")
+        self.yellow_circle = canvas.create_oval(29, 3, 49, 23, fill="#4a4a00", outline="#666")
+        self.green_circle = canvas.create_oval(54, 3, 74, 23, fill="#004a00", outline="#666")
+
+        self.status_label = tk.Label(self, text="Chưa có dữ liệu",
+                                     font=("Arial", 8, "bold"), fg="white", bg="#334155")
+        self.status_label.pack()
+
+        self.time_label = tk.Label(self, text="--:--",
+                                   font=("Courier", 11, "bold"), fg="#00ff00", bg="#000000")
+        self.time_label.pack(padx=4, pady=2, fill="x")
+
     def update_light(self, color, time_remaining):
         """
         Cập nhật trạng thái màu sắc của đèn và thời gian đếm ngược.
+        Chỉ thực hiện các lệnh Tk cần thiết cho phần thay đổi so với lần vẽ trước;
+        nếu không có gì thay đổi thì bỏ qua và tăng bộ đếm skipped_redraws.
 
         Args:
             color (str): Màu của đèn hiện tại ("RED", "YELLOW", "GREEN", hoặc "NONE" cho lỗi).
             time_remaining (int): Thời gian còn lại của pha đèn (tính bằng giây).
         """
-        # Đặt lại tất cả đèn về màu tối (tắt)
-        self.red_light.itemconfig(self.red_circle, fill="#4a0000")
-        self.yellow_light.itemconfig(self.yellow_circle, fill="#4a4a00")
-        self.green_light.itemconfig(self.green_circle, fill="#004a00")
-
-        # Cập nhật màu đèn và nhãn trạng thái dựa trên màu sắc được truyền vào
-        if color == "RED":
-            self.red_light.itemconfig(self.red_circle, fill="#ff0000") # Bật đèn đỏ
-            self.status_label.config(text="🔴 ĐÈN ĐỎ", fg="#ff4444")
-            self.time_label.config(fg="#ff4444")
-        elif color == "YELLOW":
-            self.yellow_light.itemconfig(self.yellow_circle, fill="#ffff00") # Bật đèn vàng
-            self.status_label.config(text="🟡 ĐÈN VÀNG", fg="#ffaa00")
-            self.time_label.config(fg="#ffaa00")
-        elif color == "GREEN":
-            self.green_light.itemconfig(self.green_circle, fill="#00ff00") # Bật đèn xanh
-            self.status_label.config(text="🟢 ĐÈN XANH", fg="#44ff44")
-            self.time_label.config(fg="#44ff44")
-        else: # Trạng thái không xác định hoặc lỗi
-            self.status_label.config(text="⚠️ LỖI DỮ LIỆU", fg="#ef4444")
-            self.time_label.config(fg="#ef4444")
-
-        # Cập nhật nhãn thời gian đếm ngược
-        if time_remaining >= 0:
-            minutes = time_remaining // 60
-            seconds = time_remaining % 60
-            self.time_label.config(text=f"{minutes:02d}:{seconds:02d}")
+        if color == self.current_color and time_remaining == self.current_time:
+            self.skipped_redraws += 1
+            return
+
+        time_options = {}
+        if time_remaining != self.current_time:
+            time_options["text"] = countdown_text(time_remaining) # Chuỗi đếm ngược đã tính sẵn
+            self.current_time = time_remaining
+
+        if color != self.current_color:
+            lamp, on_fill, status_text, fg = LIGHT_STYLES.get(color, ERROR_LIGHT_STYLE)
+            if lamp != self.lit_lamp:
+                if self.lit_lamp is not None: # Tắt bóng đèn đang sáng
+                    canvas, circle = self.lamps[self.lit_lamp]
+                    canvas.itemconfig(circle, fill=LAMP_OFF_COLORS[self.lit_lamp])
+                if lamp is not None: # Bật bóng đèn mới
+                    canvas, circle = self.lamps[lamp]
+                    canvas.itemconfig(circle, fill=on_fill)
+                self.lit_lamp = lamp
+            self.status_label.config(text=status_text, fg=fg)
+            time_options["fg"] = fg
+            self.current_color = color
+
+        # Gộp thay đổi nội dung và màu chữ của nhãn thời gian vào một lệnh
+        self.time_label.config(**time_options)
+
+
+# Nội dung và màu của nhãn trạng thái hệ thống cho từng trạng thái của IntersectionState
+STATUS_STYLES = {
+    engine.STATUS_NORMAL: ("✅ Trạng thái: HOẠT ĐỘNG BÌNH THƯỜNG", "#22c55e"),
+    engine.STATUS_YELLOW_TRANSITION: ("⚠️ ĐANG CHUYỂN VÀNG TRƯỚC KHẨN CẤP", "#facc15"),
+    engine.STATUS_EMERGENCY_1: ("🚨 Trạng thái: KHẨN CẤP – MẠCH 1", "#ef4444"),
+    engine.STATUS_EMERGENCY_2: ("🚨 Trạng thái: KHẨN CẤP – MẠCH 2", "#ef4444"),
+    engine.STATUS_SAFE: ("🔒 Trạng thái: AN TOÀN – CẢ HAI ĐỎ", "#38bdf8"),
+    engine.STATUS_EMERGENCY_1_DETECTED: ("🚨 Trạng thái: KHẨN CẤP – MẠCH 1 (Từ ESP32)", "#ef4444"),
+    engine.STATUS_EMERGENCY_2_DETECTED: ("🚨 Trạng thái: KHẨN CẤP – MẠCH 2 (Từ ESP32)", "#ef4444"),
+    engine.STATUS_SAFE_DETECTED: ("🔒 Trạng thái: AN TOÀN – CẢ HAI ĐỎ (Từ ESP32)", "#38bdf8"),
+    engine.STATUS_UNKNOWN: ("⚠️ Trạng thái: KHÔNG XÁC ĐỊNH", "#fbbf24"),
+}
+
+
+class IntersectionDisplay:
+    """
+    Lớp trộn (mixin) nối bộ máy trạng thái IntersectionState (engine.py) với các widget của một ngã tư.
+    Lớp sử dụng cần cung cấp: traffic_light_1, traffic_light_2, status_label và phương thức
+    log_message(), rồi gọi init_engine(). Được dùng chung bởi TrafficApp (một ngã tư)
+    và IntersectionTile trong supervisor.py (nhiều ngã tư).
+    """
+    pipeline_metrics = None # PipelineMetrics khi bật đo hiệu năng
+
+    def init_engine(self, state=None):
+        """
+        Tạo bộ máy trạng thái (hoặc dùng bộ máy của SerialPipeline) và đăng ký nhận sự kiện của nó.
+
+        Args:
+            state (IntersectionState): Bộ máy trạng thái có sẵn, None để tạo mới.
+        """
+        self.engine = state if state is not None else engine.IntersectionState()
+        self.engine.subscribe(self.on_engine_event)
+        self.event_handlers = {
+            engine.LightsChanged: self.on_lights_changed,
+            engine.StatusChanged: self.on_status_changed,
+            engine.LogMessage: self.on_log_message,
+        }
+
+    @property
+    def emergency_mode(self):
+        """
+        Chế độ khẩn cấp hiện tại (0: bình thường, 1: E1, 2: E2, 3: E3).
+        """
+        return self.engine.emergency_mode
+
+    def parse_serial(self, line):
+        """
+        Chuyển một dòng dữ liệu nhận được từ Serial cho bộ máy trạng thái.
+        GUI được cập nhật qua các sự kiện mà bộ máy phát ra.
+
+        Args:
+            line (str): Dòng dữ liệu từ Serial.
+        """
+        metrics = self.pipeline_metrics
+        if metrics:
+            start = perf_counter()
+            self.engine.feed(line)
+            metrics.parse_seconds.observe(perf_counter() - start)
         else:
-            self.time_label.config(text="00:00")
+            self.engine.feed(line)
+
+    def on_engine_event(self, event):
+        """
+        Chuyển sự kiện từ bộ máy trạng thái tới hàm cập nhật widget tương ứng.
+        """
+        handler = self.event_handlers.get(type(event))
+        if handler:
+            handler(event)
 
-class TrafficApp:
+    def on_lights_changed(self, event):
+        """
+        Cập nhật hai đèn giao thông.
+        """
+        metrics = self.pipeline_metrics
+        if metrics:
+            start = perf_counter()
+        self.traffic_light_1.update_light(event.m1_color, event.m1_secs)
+        self.traffic_light_2.update_light(event.m2_color, event.m2_secs)
+        if metrics:
+            metrics.redraw_seconds.observe(perf_counter() - start)
+
+    def on_status_changed(self, event):
+        """
+        Cập nhật nhãn trạng thái tổng thể của hệ thống.
+        """
+        text, color = STATUS_STYLES[event.status]
+        self.status_label.config(text=text, fg=color)
+
+    def on_log_message(self, event):
+        """
+        Ghi tin nhắn của bộ máy trạng thái vào nhật ký, kèm nhóm để lọc hiển thị.
+        """
+        self.log_message(event.text, event.category)
+
+
+class TrafficApp(IntersectionDisplay):
     """
     Lớp TrafficApp quản lý toàn bộ ứng dụng GUI đèn giao thông.
     Bao gồm kết nối Serial, xử lý dữ liệu, điều khiển GUI và quản lý các chế độ khẩn cấp.
     """
-    def __init__(self, root, port='COM5', baudrate=115200):
+    def __init__(self, root, port='COM5', baudrate=115200, reader_mode="auto",
+                 frame_protocol="text", frame_interval_ms=None, telemetry_dir=None, metrics=None,
+                 status_api=None, plan_table=None, adaptive=None, auto_e3=False):
         self.root = root
         self.root.title("🚦 Hệ thống điều khiển đèn giao thông ESP32")
         self.root.geometry("1000x700")
         self.root.configure(bg="#1e293b") # Màu nền chính của ứng dụng
 
         self.port = port
-        self.baudrate = baudrate
-        self.ser = None # Đối tượng Serial connection
-        self.emergency_mode = 0 # Trạng thái chế độ khẩn cấp (0: bình thường, 1: E1, 2: E2, 3: E3)
-        
+        # Đường xử lý Serial dùng chung với HeadlessMonitor: kết nối (luồng nền, tự kết nối lại), giám sát an toàn,
+        # luồng ghi lệnh, telemetry, thỏa thuận định dạng khung ("text", "binary" hoặc "sparse"), API trạng thái,
+        # lịch kế hoạch / điều khiển thích ứng; mọi sự kiện được xử lý trên luồng Tkinter trong process_serial_queue()
+        self.pipeline = SerialPipeline(port, baudrate, reader_mode, frame_protocol, frame_interval_ms,
+                                       telemetry_dir, metrics, status_api, plan_table, adaptive, auto_e3,
+                                       on_connection_state=self.on_connection_state,
+                                       on_command_result=self.on_command_result,
+                                       on_safety_alarm=self.on_safety_alarm,
+                                       on_item=self.on_received, report=self.report)
+        self.command_writer = self.pipeline.command_writer
+        # Đo hiệu năng đường xử lý (None khi không bật)
+        self.pipeline_metrics = self.pipeline.pipeline_metrics
+        if self.pipeline_metrics:
+            metrics.gauge_function("redraws_skipped_total",
+                                   lambda: self.traffic_light_1.skipped_redraws + self.traffic_light_2.skipped_redraws,
+                                   "Số lần cập nhật đèn không cần vẽ lại", kind="counter")
+        self.tick_due = None # Thời điểm (perf_counter) nhịp xử lý hàng đợi kế tiếp lẽ ra phải chạy
+
         self.build_ui() # Xây dựng giao diện người dùng
-        self.connect_serial() # Kết nối với cổng Serial
+        if self.pipeline_metrics: # Bảng số liệu hiệu năng, bật/tắt bằng F12
+            self.metrics_overlay = MetricsOverlay(self.root, self.pipeline_metrics)
+        self.init_engine(self.pipeline.engine) # Bộ máy trạng thái ngã tư, cập nhật GUI qua sự kiện
+        self.enable_controls(False) # Chỉ bật các nút điều khiển khi ESP32 sẵn sàng
+        self.pipeline.start() # Kết nối với cổng Serial (không chặn, tự kết nối lại)
         self.update_clock() # Bắt đầu cập nhật đồng hồ thời gian thực
 
-        self.serial_data_queue = [] # Hàng đợi để lưu trữ dữ liệu Serial đọc được
-        # Khởi tạo luồng để đọc dữ liệu Serial liên tục
-        self.read_serial_thread = threading.Thread(target=self.read_serial, daemon=True)
-        self.read_serial_thread.start()
         # Bắt đầu xử lý hàng đợi dữ liệu Serial trên luồng chính của Tkinter
         self.process_serial_queue()
 
-    def connect_serial(self):
+    def on_connection_state(self, event):
         """
-        Thiết lập kết nối với cổng Serial được chỉ định.
-        Cập nhật nhãn trạng thái và bật/tắt các nút điều khiển.
+        Cập nhật GUI khi trạng thái kết nối thay đổi (gọi trên luồng chính).
+
+        Args:
+            event (ConnectionState): Trạng thái kết nối mới.
         """
-        try:
-            self.ser = serial.Serial(self.port, self.baudrate, timeout=1)
-            time.sleep(2) # Đợi một chút để kết nối Serial ổn định
+        if event.state == STATE_CONNECTING:
+            self.status_label.config(text=f"⚡ Trạng thái: ĐANG KẾT NỐI {self.port}...", fg="#38bdf8")
+        elif event.state == STATE_WAITING_READY:
+            self.log_message(f"Đã mở cổng {self.port}, chờ dữ liệu từ ESP32...")
+            self.status_label.config(text="⏳ Trạng thái: CHỜ DỮ LIỆU TỪ ESP32", fg="#38bdf8")
+        elif event.state == STATE_CONNECTED:
             self.log_message(f"Kết nối Serial thành công tại {self.port}")
             self.status_label.config(text="✅ Trạng thái: KẾT NỐI THÀNH CÔNG", fg="#22c55e")
-            # Kích hoạt các nút điều khiển sau khi kết nối thành công
-            for widget in self.control_frame.winfo_children():
-                for btn in widget.winfo_children():
-                    btn.config(state="normal")
-            self.enable_time_setting_controls(True) # Kích hoạt các điều khiển đặt thời gian
-        except serial.SerialException:
-            messagebox.showerror("Lỗi", f"Không thể kết nối Serial tại {self.port}")
-            self.log_message(f"Không thể kết nối Serial tại {self.port}")
-            self.status_label.config(text="⚠️ Trạng thái: KHÔNG KẾT NỐI", fg="#ef4444")
-            self.ser = None # Đặt lại ser về None nếu kết nối thất bại
-            # Vô hiệu hóa các nút điều khiển nếu kết nối thất bại
-            for widget in self.control_frame.winfo_children():
-                for btn in widget.winfo_children():
-                    btn.config(state="disabled")
-            self.enable_time_setting_controls(False) # Vô hiệu hóa các điều khiển đặt thời gian
+            self.enable_controls(True) # Kích hoạt các nút điều khiển sau khi kết nối thành công
+        elif event.state == STATE_DISCONNECTED:
+            reason = f": {event.error}" if event.error else ""
+            self.log_message(f"Không có kết nối Serial tại {self.port}{reason}. "
+                             f"Thử lại sau {event.retry_in:.1f}s")
+            self.status_label.config(text=f"⚠️ Trạng thái: KHÔNG KẾT NỐI – THỬ LẠI SAU {event.retry_in:.0f}s",
+                                     fg="#ef4444")
+            self.enable_controls(False) # Vô hiệu hóa các nút điều khiển khi mất kết nối
+
+    def enable_controls(self, enable=True):
+        """
+        Bật hoặc tắt các nút điều khiển khẩn cấp và các điều khiển đặt thời gian.
+        """
+        state = "normal" if enable else "disabled"
+        for widget in self.control_frame.winfo_children():
+            for btn in widget.winfo_children():
+                btn.config(state=state)
+        self.enable_time_setting_controls(enable)
 
     def send_command(self, cmd):
         """
-        Gửi một lệnh tới ESP32 qua kết nối Serial.
+        Gửi một lệnh tới ESP32 qua hàng đợi lệnh (ghi trên luồng riêng, không chặn GUI).
+        Kết quả xác nhận được báo lại trong on_command_result().
 
         Args:
             cmd (str): Chuỗi lệnh cần gửi.
         """
-        if self.ser and self.ser.is_open:
-            self.ser.write((cmd + "\n").encode()) # Mã hóa lệnh thành bytes và gửi
-            self.ser.flush() # Đảm bảo dữ liệu được gửi đi ngay lập tức
+        if self.command_writer.send(cmd):
             self.log_message(f"Gửi lệnh: {cmd}")
+
+    def on_command_result(self, result):
+        """
+        Ghi nhật ký kết quả của một lệnh (gọi trên luồng chính).
+
+        Args:
+            result (CommandResult): Kết quả từ CommandWriter.
+        """
+        described = describe_result(result, self.command_writer.latency_summary(result.kind))
+        if described:
+            category, message = described
+            self.log_message(message, category)
+
+    def on_safety_alarm(self, alarm):
+        """
+        Báo cảnh báo an toàn trong nhật ký (gọi trên luồng chính; API trạng thái do SerialPipeline cập nhật).
+
+        Args:
+            alarm (SafetyAlarm): Cảnh báo từ bộ giám sát an toàn.
+        """
+        self.log_message(f"AN TOÀN: {alarm.message}", engine.LOG_ERROR if alarm.active else engine.LOG_WARNING)
+
+    def on_received(self, item):
+        """
+        Ghi vào nhật ký là đã nhận một dòng/khung (gọi ngay trước khi bộ máy trạng thái phân tích nó).
+        """
+        if item.__class__ is protocol.StatusFrame: # Khung nhị phân đã được giải mã trên luồng đọc
+            self.log_message(f"Nhận: {protocol.format_status_frame(item)}", CATEGORY_STATUS)
         else:
-            self.log_message(f"Lỗi: Không có kết nối Serial để gửi lệnh '{cmd}'")
+            self.log_message(f"Nhận: {item}", CATEGORY_STATUS if item.startswith("S,") else engine.LOG_DEBUG)
+
+    def report(self, category, text):
+        """
+        Ghi thông báo của đường xử lý Serial (API trạng thái, hàng đợi đầy, mất khung, thỏa thuận định dạng khung).
+        """
+        self.log_message(text, category)
 
     def build_ui(self):
         """
@@ -271,14 +507,9 @@ class TrafficApp:
                                    bg="#334155", fg="white", font=("Arial", 10))
         log_frame.pack(fill="both", expand=True, padx=20, pady=(0, 20))
 
-        # Text widget để hiển thị nhật ký
-        self.log = tk.Text(log_frame, height=6, bg="#0f172a", fg="#94a3b8",
-                            font=("Consolas", 9), wrap="word")
-        # Thanh cuộn cho nhật ký
-        scrollbar = tk.Scrollbar(log_frame, command=self.log.yview)
-        self.log.config(yscrollcommand=scrollbar.set)
-        scrollbar.pack(side="right", fill="y")
-        self.log.pack(side="left", fill="both", expand=True)
+        # Nhật ký ảo hóa: bộ đệm vòng, chỉ vẽ các dòng nhìn thấy, lọc theo nhóm tin nhắn
+        self.log_view = LogView(log_frame, height=6, bg="#334155")
+        self.log_view.pack(fill="both", expand=True)
 
     def enable_time_setting_controls(self, enable=True):
         """
@@ -297,139 +528,35 @@ class TrafficApp:
         self.clock_label.config(text=f"🕒 {now.strftime('%H:%M:%S')} - {now.strftime('%d/%m/%Y')}")
         self.root.after(1000, self.update_clock) # Lên lịch gọi lại sau 1 giây
 
-    def log_message(self, message):
+    def log_message(self, message, category=CATEGORY_SYSTEM):
         """
-        Thêm một tin nhắn vào hộp nhật ký hệ thống.
+        Thêm một tin nhắn vào nhật ký hệ thống (vẽ lại được gom lại, tối đa mỗi 100ms).
 
         Args:
             message (str): Tin nhắn cần ghi.
+            category (str): Nhóm tin nhắn (engine.LOG_*, CATEGORY_STATUS hoặc CATEGORY_SYSTEM).
         """
-        timestamp = datetime.now().strftime("[%H:%M:%S]")
-        self.log.insert(tk.END, f"{timestamp} {message}\n")
-        self.log.see(tk.END) # Cuộn xuống cuối để hiển thị tin nhắn mới nhất
-        # Giới hạn số lượng dòng trong nhật ký để tránh tràn bộ nhớ
-        current_lines = int(float(self.log.index('end')))
-        if current_lines > 200: # Nếu quá 200 dòng, xóa 150 dòng đầu tiên
-            self.log.delete("1.0", f"{current_lines - 150}.0")
+        self.log_view.add(message, category)
 
-    def parse_serial(self, line):
+    def close(self):
         """
-        Phân tích cú pháp một dòng dữ liệu nhận được từ Serial và cập nhật GUI.
-
-        Args:
-            line (str): Dòng dữ liệu từ Serial.
+        Dừng đường xử lý Serial: luồng ghi lệnh, giám sát an toàn, luồng quản lý kết nối (kèm luồng đọc),
+        telemetry, API trạng thái, luồng lịch kế hoạch / điều khiển thích ứng (nếu có).
         """
-        valid_colors = ["RED", "GREEN", "YELLOW"]
-        if line.startswith("S,"): # Dữ liệu trạng thái đèn
-            parts = line.split(",")
-            if len(parts) == 5:
-                try:
-                    # Tách các phần: _, màu_m1, thời_gian_m1, màu_m2, thời_gian_m2
-                    _, m1_color, m1_time, m2_color, m2_time = parts
-                    
-                    # Kiểm tra màu hợp lệ
-                    if m1_color not in valid_colors or m2_color not in valid_colors:
-                        self.log_message(f"Dữ liệu màu không hợp lệ: {line}")
-                        return
-
-                    m1_secs = int(m1_time)
-                    m2_secs = int(m2_time)
-
-                    # Cập nhật trạng thái cho từng đèn giao thông
-                    self.traffic_light_1.update_light(m1_color, m1_secs)
-                    self.traffic_light_2.update_light(m2_color, m2_secs)
-                    # Cập nhật trạng thái tổng thể của hệ thống
-                    self.update_system_status(m1_color, m1_secs, m2_color, m2_secs)
-
-                except ValueError as e:
-                    self.log_message(f"Lỗi parse dữ liệu số: {e} trong dòng: {line}")
-                    # Đặt đèn về trạng thái lỗi nếu có lỗi parse
-                    self.traffic_light_1.update_light("NONE", 0)
-                    self.traffic_light_2.update_light("NONE", 0)
-            else:
-                self.log_message(f"Dữ liệu Serial không đúng định dạng: {line}")
-        elif line.startswith(">>> KHẨN CẤP:"): # Thông báo chế độ khẩn cấp
-            if "MẠCH 1 XANH" in line:
-                self.traffic_light_1.update_light("GREEN", 0) # Đặt ngay Mạch 1 xanh, Mạch 2 đỏ
-                self.traffic_light_2.update_light("RED", 0)
-                self.status_label.config(text="🚨 Trạng thái: KHẨN CẤP – MẠCH 1", fg="#ef4444")
-                self.emergency_mode = 1
-            elif "MẠCH 2 XANH" in line:
-                self.traffic_light_1.update_light("RED", 0) # Đặt ngay Mạch 1 đỏ, Mạch 2 xanh
-                self.traffic_light_2.update_light("GREEN", 0)
-                self.status_label.config(text="🚨 Trạng thái: KHẨN CẤP – MẠCH 2", fg="#ef4444")
-                self.emergency_mode = 2
-            elif "CẢ HAI ĐỎ" in line:
-                self.traffic_light_1.update_light("RED", 0) # Đặt ngay cả hai đỏ
-                self.traffic_light_2.update_light("RED", 0)
-                self.status_label.config(text="🔒 Trạng thái: AN TOÀN – CẢ HAI ĐỎ", fg="#38bdf8")
-                self.emergency_mode = 3
-            self.log_message(line)
-        elif "TẮT KHẨN CẤP" in line: # Thông báo tắt chế độ khẩn cấp
-            self.status_label.config(text="✅ Trạng thái: HOẠT ĐỘNG BÌNH THƯỜNG", fg="#22c55e")
-            self.emergency_mode = 0
-            self.log_message(line)
-        elif line.startswith("SET_UPDATED,"): # Phản hồi khi đặt thời gian pha
-            parts = line.split(",")
-            if len(parts) == 4:
-                _, color_type, val1, val2 = parts
-                self.log_message(f"Thời gian pha được cập nhật: Màu {color_type} = {val1}s, Đỏ đối diện = {val2}s. Chu kỳ được đặt lại.")
-            else:
-                self.log_message(f"Dữ liệu SET_UPDATED không đúng định dạng: {line}")
-        elif line.startswith(">>> Cảnh báo:"): # Cảnh báo từ ESP32 (ví dụ: thời gian xanh tối thiểu)
-            self.log_message(line)
-        else: # Các thông báo khác từ ESP32 (debug, v.v.)
-            self.log_message(f"ESP32: {line}")
-
-    def update_system_status(self, m1_color, m1_secs, m2_color, m2_secs):
-        """
-        Cập nhật nhãn trạng thái tổng thể của ứng dụng dựa trên trạng thái đèn hiện tại.
-        Điều này đặc biệt quan trọng để hiển thị trạng thái khẩn cấp được kích hoạt từ ESP32.
-        """
-        # Nếu đang có đèn vàng ở một trong hai mạch, tức là đang trong pha chuyển tiếp khẩn cấp
-        if m1_color == "YELLOW" or m2_color == "YELLOW":
-            self.status_label.config(text="⚠️ ĐANG CHUYỂN VÀNG TRƯỚC KHẨN CẤP", fg="#facc15")
-        # Kiểm tra các trường hợp đặc biệt khi thời gian đếm ngược về 0 (chế độ khẩn cấp cứng)
-        # Chỉ cập nhật trạng thái nếu không ở chế độ khẩn cấp đã được kích hoạt từ nút nhấn/GUI
-        elif self.emergency_mode == 0: # Chỉ cập nhật nếu không ở chế độ khẩn cấp đã được kích hoạt
-            if m1_secs == 0 and m2_secs == 0:
-                if m1_color == "RED" and m2_color == "RED":
-                    self.status_label.config(text="🔒 Trạng thái: AN TOÀN – CẢ HAI ĐỎ (Từ ESP32)", fg="#38bdf8")
-                elif m1_color == "GREEN" and m2_color == "RED":
-                    self.status_label.config(text="🚨 Trạng thái: KHẨN CẤP – MẠCH 1 (Từ ESP32)", fg="#ef4444")
-                elif m2_color == "GREEN" and m1_color == "RED":
-                    self.status_label.config(text="🚨 Trạng thái: KHẨN CẤP – MẠCH 2 (Từ ESP32)", fg="#ef4444")
-                else: # Trạng thái không xác định khác khi thời gian về 0
-                    self.status_label.config(text="⚠️ Trạng thái: KHÔNG XÁC ĐỊNH", fg="#fbbf24")
-            else: # Trạng thái hoạt động bình thường
-                self.status_label.config(text="✅ Trạng thái: HOẠT ĐỘNG BÌNH THƯỜNG", fg="#22c55e")
-                self.emergency_mode = 0 # Đảm bảo emergency_mode là 0 nếu phát hiện hoạt động bình thường
-
-    def read_serial(self):
-        """
-        Hàm được chạy trong một luồng riêng để đọc dữ liệu từ cổng Serial liên tục.
-        Dữ liệu đọc được sẽ được thêm vào hàng đợi để xử lý trên luồng chính.
-        """
-        while True:
-            if self.ser and self.ser.is_open and self.ser.in_waiting: # Kiểm tra xem có dữ liệu trong bộ đệm nhận không
-                try:
-                    # Đọc một dòng, giải mã bằng UTF-8 (bỏ qua lỗi) và loại bỏ khoảng trắng
-                    line = self.ser.readline().decode('utf-8', errors='ignore').strip()
-                    if line:
-                        self.serial_data_queue.append(line) # Thêm dòng dữ liệu vào hàng đợi
-                except Exception as e:
-                    self.log_message(f"Lỗi đọc Serial: {e}")
-            time.sleep(0.01) # Tạm dừng 10ms để tránh chiếm dụng CPU quá mức
+        self.pipeline.close()
 
     def process_serial_queue(self):
         """
-        Xử lý các mục trong hàng đợi dữ liệu Serial.
-        Hàm này được gọi định kỳ trên luồng chính của Tkinter.
+        Một nhịp của đường xử lý Serial trên luồng chính của Tkinter (mỗi 10ms): thay đổi trạng thái kết nối,
+        kết quả lệnh, cảnh báo an toàn và tối đa 200 mục dữ liệu; các khung trạng thái "S," cũ trong lô
+        đã được gộp nên chỉ khung mới nhất được hiển thị.
         """
-        if self.serial_data_queue:
-            line = self.serial_data_queue.pop(0) # Lấy dòng đầu tiên từ hàng đợi
-            self.log_message(f"Nhận: {line}") # Ghi vào nhật ký là đã nhận dữ liệu
-            self.parse_serial(line) # Phân tích và cập nhật GUI
+        metrics = self.pipeline_metrics
+        if metrics and self.tick_due is not None:
+            metrics.tick_lateness.observe(max(perf_counter() - self.tick_due, 0.0))
+        self.pipeline.process(200)
+        if metrics:
+            self.tick_due = perf_counter() + 0.010
         self.root.after(10, self.process_serial_queue) # Lên lịch gọi lại sau 10ms
 
     def set_light_duration(self):
@@ -456,20 +583,81 @@ class TrafficApp:
             messagebox.showerror("Lỗi nhập liệu", "Thời gian phải là số nguyên.")
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    """
+    Chạy ứng dụng GUI một ngã tư (dùng chung cho "python main.py" và "trafficctl gui").
+    """
+    parser = argparse.ArgumentParser(description="Hệ thống điều khiển đèn giao thông ESP32")
+    # Cổng mặc định COM5, có thể truyền cổng khác (ví dụ ESP32 ảo: python main.py /tmp/esp32-0)
+    parser.add_argument("port", nargs="?", default="COM5", help="Cổng Serial (mặc định COM5)")
+    parser.add_argument("--metrics", help='Bật đo hiệu năng, xuất định kỳ ra file ("-": stdout)')
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="Chu kỳ xuất số liệu (giây)")
+    parser.add_argument("--overlay", action="store_true", help="Bật đo hiệu năng và hiện bảng số liệu (F12)")
+    parser.add_argument("--protocol", choices=("text", "binary", "sparse"), default="text",
+                        help="Định dạng khung trạng thái (sparse: chỉ khung chuyển pha/đồng bộ, đếm ngược cục bộ)")
+    parser.add_argument("--frame-interval-ms", type=int,
+                        help="Chu kỳ khung nhị phân hoặc khung đồng bộ của chế độ sparse (ms)")
+    parser.add_argument("--api-port", type=int, help="Bật API trạng thái HTTP/WebSocket tại cổng này")
+    parser.add_argument("--api-host", default="127.0.0.1", help="Địa chỉ lắng nghe của API (mặc định 127.0.0.1)")
+    parser.add_argument("--api-token", help="Token cho phép gửi lệnh qua API (mặc định: sinh ngẫu nhiên)")
+    parser.add_argument("--telemetry", metavar="DIR", help="Ghi lịch sử pha đèn vào thư mục này (mặc định: không ghi)")
+    timing = parser.add_mutually_exclusive_group()
+    timing.add_argument("--plans", help="File JSON bảng kế hoạch thời gian pha theo khung giờ")
+    timing.add_argument("--adaptive", metavar="SOURCE",
+                        help='Thời gian xanh thích ứng theo số xe: file, "udp:<cổng>" hoặc "sim:<xe/h M1>,<xe/h M2>"')
+    parser.add_argument("--auto-e3", action="store_true",
+                        help="Tự gửi E3 (cả hai đỏ) khi phát hiện hai hướng cùng xanh/vàng")
+    args = parser.parse_args(argv)
+
+    plan_table = None
+    if args.plans:
+        try:
+            plan_table = load_plan_table(args.plans)
+        except (OSError, ValueError) as e:
+            parser.error(f"Không đọc được bảng kế hoạch {args.plans}: {e}")
+    adaptive = None
+    if args.adaptive:
+        try:
+            adaptive = AdaptiveController(args.adaptive)
+        except (OSError, ValueError) as e:
+            parser.error(f"Không mở được nguồn số xe {args.adaptive}: {e}")
+
+    registry = MetricsRegistry() if args.metrics or args.overlay else None
+    exporter = MetricsExporter(registry, args.metrics, args.metrics_interval) if args.metrics else None
+    if exporter:
+        exporter.start()
+
+    status_api = None
+    if args.api_port is not None:
+        api_token = args.api_token or secrets.token_urlsafe(24)
+        if not args.api_token:
+            print(f"Token gửi lệnh qua API: {api_token}")
+        status_api = StatusApi(args.api_host, args.api_port, token=api_token)
+
     root = tk.Tk()
-    app = TrafficApp(root, port="COM5", baudrate=115200) # Khởi tạo ứng dụng với cổng COM5
+    app = TrafficApp(root, port=args.port, baudrate=115200, frame_protocol=args.protocol,
+                     frame_interval_ms=args.frame_interval_ms, telemetry_dir=args.telemetry, metrics=registry,
+                     status_api=status_api, plan_table=plan_table,
+                     adaptive=adaptive, auto_e3=args.auto_e3)
+    if args.overlay:
+        app.metrics_overlay.toggle()
 
     def on_close():
         """
         Xử lý sự kiện khi người dùng đóng cửa sổ ứng dụng.
-        Hỏi xác nhận và đóng kết nối Serial trước khi thoát.
+        Hỏi xác nhận, dừng luồng đọc và đóng kết nối Serial trước khi thoát.
         """
         if messagebox.askokcancel("Thoát", "Bạn có chắc muốn thoát ứng dụng?"):
-            if app.ser and app.ser.is_open:
-                app.ser.close() # Đóng kết nối Serial nếu đang mở
+            app.close() # Dừng luồng đọc và đóng kết nối Serial
+            if exporter:
+                exporter.stop()
+                exporter.join(timeout=2)
             root.destroy() # Đóng cửa sổ Tkinter
 
     # Đăng ký hàm on_close để được gọi khi cửa sổ bị đóng
     root.protocol("WM_DELETE_WINDOW", on_close)
     root.mainloop() # Bắt đầu vòng lặp sự kiện chính của Tkinter
+
+
+if __name__ == "__main__":
+    main()
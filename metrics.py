@@ -0,0 +1,282 @@
+import os
+import sys
+import threading
+from bisect import bisect_left
+
+# Ngưỡng các ô của biểu đồ độ trễ (giây), giống quy ước histogram của Prometheus
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Ngưỡng mịn hơn cho các đoạn mã nóng (phân tích một dòng, vẽ lại: cỡ micro giây)
+FAST_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class LatencyHistogram:
+    """
+    Biểu đồ phân bố độ trễ với các ô cố định: ghi nhận O(log số ô), bộ nhớ cố định.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            buckets (tuple): Các ngưỡng trên (giây) tăng dần; ô cuối cùng (+Inf) được thêm tự động.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """
+        Ghi nhận một giá trị độ trễ (giây).
+        """
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Ước lượng phân vị từ các ô (trả về ngưỡng trên của ô chứa phân vị).
+
+        Args:
+            fraction (float): Phân vị cần tính, ví dụ 0.5 hoặc 0.99.
+
+        Returns:
+            float: Độ trễ (giây), 0.0 nếu chưa có dữ liệu.
+        """
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= target and bucket_count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def summary(self):
+        """
+        Chuỗi tóm tắt ngắn: số mẫu, trung bình, p50, p99 và lớn nhất (mili giây).
+        """
+        return (f"n={self.count}, tb={self.mean * 1000:.0f} ms, p50≤{self.percentile(0.5) * 1000:.0f} ms, "
+                f"p99≤{self.percentile(0.99) * 1000:.0f} ms, max={self.max * 1000:.0f} ms")
+
+
+class Counter:
+    """
+    Bộ đếm tăng dần.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """
+    Giá trị tức thời (ví dụ độ sâu hàng đợi), kèm giá trị lớn nhất từng thấy.
+    """
+    def __init__(self):
+        self.value = 0
+        self.max = 0
+
+    def set(self, value):
+        self.value = value
+        if value > self.max:
+            self.max = value
+
+
+class NullMetric:
+    """
+    Đối tượng đo không làm gì, được trả về khi bộ đo bị tắt.
+    """
+    value = 0
+    max = 0
+    count = 0
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, seconds):
+        pass
+
+    def summary(self):
+        return ""
+
+
+NULL_METRIC = NullMetric()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Tập hợp các bộ đếm, giá trị tức thời và biểu đồ độ trễ của tiến trình,
+    xuất ra dạng văn bản của Prometheus để công cụ thu thập đọc được.
+
+    Mỗi bộ đo chỉ được cập nhật từ một luồng (luồng đọc hoặc luồng Tkinter), nên không cần khóa.
+    Khi enabled=False mọi bộ đo là NULL_METRIC; đoạn mã nóng nên kiểm tra cờ trước khi
+    gọi perf_counter() để chi phí khi tắt gần như bằng 0.
+    """
+    def __init__(self, enabled=True, prefix="traffic_"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.metrics = {} # (tên, nhãn) -> (kiểu, mô tả, bộ đo)
+        self.functions = {} # (tên, nhãn) -> (kiểu, mô tả, hàm trả về giá trị khi xuất)
+
+    def _register(self, kind, name, help_text, labels, factory):
+        if not self.enabled:
+            return NULL_METRIC
+        key = (self.prefix + name, tuple(sorted((labels or {}).items())))
+        entry = self.metrics.get(key)
+        if entry is None:
+            entry = self.metrics[key] = (kind, help_text, factory())
+        return entry[2]
+
+    def counter(self, name, help_text="", labels=None):
+        return self._register("counter", name, help_text, labels, Counter)
+
+    def gauge(self, name, help_text="", labels=None):
+        return self._register("gauge", name, help_text, labels, Gauge)
+
+    def histogram(self, name, help_text="", labels=None, buckets=DEFAULT_BUCKETS):
+        return self._register("histogram", name, help_text, labels, lambda: LatencyHistogram(buckets))
+
+    def gauge_function(self, name, function, help_text="", labels=None, kind="gauge"):
+        """
+        Đăng ký một giá trị được đọc lúc xuất (ví dụ số dòng bị bỏ của hàng đợi),
+        không tốn chi phí trên đường nóng.
+        """
+        if self.enabled:
+            key = (self.prefix + name, tuple(sorted((labels or {}).items())))
+            self.functions[key] = (kind, help_text, function)
+
+    def render_text(self):
+        """
+        Xuất mọi bộ đo theo định dạng văn bản của Prometheus.
+
+        Returns:
+            str: Nội dung có thể ghi ra file hoặc trả về qua HTTP.
+        """
+        lines = []
+        described = set()
+        entries = [(key, kind, help_text, metric, False) for key, (kind, help_text, metric) in self.metrics.items()]
+        entries += [(key, kind, help_text, function, True)
+                    for key, (kind, help_text, function) in self.functions.items()]
+        for (name, labels), kind, help_text, metric, is_function in sorted(entries, key=lambda e: e[0]):
+            if is_function:
+                try:
+                    value = metric()
+                except Exception: # Nguồn chưa sẵn sàng (ví dụ chưa kết nối): bỏ qua lần xuất này
+                    continue
+            if name not in described:
+                described.add(name)
+                if help_text:
+                    lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            if is_function:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+            elif kind == "histogram":
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + ("+Inf",), metric.counts):
+                    cumulative += bucket_count
+                    le = bound if bound == "+Inf" else repr(float(bound))
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(metric.sum)}")
+                lines.append(f"{name}_count{format_labels(labels)} {metric.count}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {format_value(metric.value)}")
+        return "\n".join(lines) + "\n"
+
+
+class PipelineMetrics:
+    """
+    Các bộ đo của đường xử lý Serial -> hàng đợi -> bộ máy trạng thái -> vẽ Tkinter.
+    Tên bộ đo được đặt cố định ở đây để file xuất của mọi tiến trình giống nhau.
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        # Luồng đọc: chi phí tách dòng và chuyển tiếp mỗi lần đọc, số byte/dòng
+        self.read_seconds = registry.histogram("serial_read_chunk_seconds",
+                                               "Thời gian tách dòng và chuyển tiếp một lần đọc Serial",
+                                               buckets=FAST_BUCKETS)
+        self.read_bytes = registry.counter("serial_read_bytes_total", "Số byte đọc từ Serial")
+        self.read_lines = registry.counter("serial_read_lines_total", "Số dòng/khung tách được")
+        # Luồng Tkinter: độ sâu hàng đợi, chi phí phân tích, chi phí vẽ, độ trễ của after()
+        self.queue_depth = registry.gauge("serial_queue_depth", "Số mục trong hàng đợi khi bắt đầu một nhịp")
+        self.parse_seconds = registry.histogram("parse_line_seconds", "Thời gian phân tích một dòng",
+                                                buckets=FAST_BUCKETS)
+        self.redraw_seconds = registry.histogram("redraw_seconds", "Thời gian vẽ lại hai đèn khi trạng thái đổi",
+                                                 buckets=FAST_BUCKETS)
+        self.tick_lateness = registry.histogram("tick_lateness_seconds",
+                                                "Độ trễ của nhịp root.after() so với lịch")
+        self.tick_seconds = registry.histogram("tick_seconds", "Thời gian xử lý một nhịp hàng đợi",
+                                               buckets=FAST_BUCKETS)
+
+
+class MetricsExporter:
+    """
+    Luồng nền ghi định kỳ nội dung render_text() ra file (thay thế nguyên tử) hoặc stdout.
+    """
+    def __init__(self, registry, path="-", interval=10.0):
+        """
+        Args:
+            registry (MetricsRegistry): Nguồn dữ liệu.
+            path (str): Đường dẫn file, "-" để in ra stdout.
+            interval (float): Chu kỳ xuất (giây).
+        """
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def export(self):
+        text = self.registry.render_text()
+        if self.path == "-":
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            return
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temporary, self.path)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.export()
+            except OSError:
+                pass
+        try:
+            self.export() # Lần xuất cuối khi dừng
+        except OSError:
+            pass
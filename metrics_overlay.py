@@ -0,0 +1,58 @@
+import tkinter as tk
+import time
+
+
+class MetricsOverlay:
+    """
+    Bảng số liệu hiệu năng nổi ở góc trên bên phải cửa sổ, bật/tắt bằng phím F12.
+    Chỉ đọc các bộ đo của PipelineMetrics mỗi refresh_ms (mặc định 500 ms), không chạm vào đường nóng.
+    """
+    def __init__(self, root, pipeline, refresh_ms=500, visible=False):
+        """
+        Args:
+            root (tk.Tk): Cửa sổ chính.
+            pipeline (PipelineMetrics): Các bộ đo cần hiển thị.
+            refresh_ms (int): Chu kỳ cập nhật bảng (ms).
+            visible (bool): Hiển thị ngay khi khởi động.
+        """
+        self.root = root
+        self.pipeline = pipeline
+        self.refresh_ms = refresh_ms
+        self.visible = False
+        self.after_id = None
+        self.last_lines = pipeline.read_lines.value
+        self.last_time = time.monotonic()
+        self.label = tk.Label(root, justify="left", anchor="nw", font=("Consolas", 8),
+                              bg="#020617", fg="#a3e635", padx=6, pady=4)
+        root.bind("<F12>", lambda event: self.toggle())
+        if visible:
+            self.toggle()
+
+    def toggle(self):
+        self.visible = not self.visible
+        if self.visible:
+            self.label.place(relx=1.0, x=-8, y=8, anchor="ne")
+            self.label.lift()
+            self.refresh()
+        else:
+            self.label.place_forget()
+            if self.after_id:
+                self.root.after_cancel(self.after_id)
+                self.after_id = None
+
+    def refresh(self):
+        p = self.pipeline
+        now = time.monotonic()
+        lines = p.read_lines.value
+        rate = (lines - self.last_lines) / max(now - self.last_time, 1e-9)
+        self.last_lines, self.last_time = lines, now
+        self.label.config(text="\n".join((
+            f"Serial   {rate:8.0f} dòng/s  {p.read_bytes.value:,} B",
+            f"Đọc      p99≤{p.read_seconds.percentile(0.99) * 1e6:7.0f} µs/lần",
+            f"Hàng đợi {p.queue_depth.value:5d} (max {p.queue_depth.max})",
+            f"Phân tích p50≤{p.parse_seconds.percentile(0.5) * 1e6:6.1f} p99≤{p.parse_seconds.percentile(0.99) * 1e6:6.1f} µs",
+            f"Vẽ lại   p50≤{p.redraw_seconds.percentile(0.5) * 1e6:6.0f} p99≤{p.redraw_seconds.percentile(0.99) * 1e6:6.0f} µs",
+            f"Nhịp     p99≤{p.tick_seconds.percentile(0.99) * 1e3:6.2f} ms, trễ p99≤"
+            f"{p.tick_lateness.percentile(0.99) * 1e3:.0f} ms",
+        )))
+        self.after_id = self.root.after(self.refresh_ms, self.refresh)
@@ -0,0 +1,337 @@
+import queue
+import time
+
+import engine
+from command_writer import CommandWriter
+from connection import SerialConnection, STATE_CONNECTING, STATE_CONNECTED, STATE_DISCONNECTED
+from metrics import PipelineMetrics
+from protocol import FRAME_PROTOCOL_COMMANDS, NEGOTIATION_TIMEOUT
+from safety import SafetyMonitor
+from scheduler import PhaseApplier, PlanScheduler
+from serial_queue import SerialLineQueue
+from telemetry import TelemetryWriter
+
+
+class SerialPipeline:
+    """
+    Đường xử lý Serial của một ngã tư, không phụ thuộc Tkinter, dùng chung cho TrafficApp (GUI)
+    và HeadlessMonitor (dịch vụ nền):
+    SerialConnection (luồng nền, tự kết nối lại) -> giám sát an toàn, xác nhận lệnh, telemetry (trên luồng đọc)
+    -> SerialLineQueue -> IntersectionState, cùng luồng ghi lệnh, thỏa thuận định dạng khung,
+    API trạng thái và lịch kế hoạch / điều khiển thời gian xanh thích ứng.
+
+    Thay đổi kết nối, kết quả lệnh và cảnh báo an toàn từ luồng nền được đưa qua hàng đợi; chúng và
+    dữ liệu Serial chỉ được xử lý trong process(), trên luồng của nơi sở hữu (luồng Tkinter hoặc vòng lặp chính),
+    rồi mới chuyển cho các hàm on_* của nơi sở hữu.
+    """
+    def __init__(self, port, baudrate=115200, reader_mode="auto", frame_protocol="text", frame_interval_ms=None,
+                 telemetry_dir=None, metrics=None, status_api=None, plan_table=None, adaptive=None, auto_e3=False,
+                 on_connection_state=None, on_command_result=None, on_safety_alarm=None, on_item=None,
+                 report=None, wake=None):
+        """
+        Args:
+            port (str): Cổng Serial.
+            baudrate (int): Tốc độ baud.
+            reader_mode (str): Chế độ đọc Serial: "auto", "blocking" hoặc "selector".
+            frame_protocol (str): "text", "binary" hoặc "sparse" (thỏa thuận khi ESP32 sẵn sàng).
+            frame_interval_ms (int): Chu kỳ khung nhị phân / khung đồng bộ (ms), None: mặc định firmware.
+            telemetry_dir (str): Thư mục ghi lịch sử pha đèn (None: không ghi).
+            metrics (MetricsRegistry): Đo hiệu năng (None hoặc đã tắt: không đo).
+            status_api (StatusApi): API trạng thái HTTP/WebSocket (None: không bật).
+            plan_table (PlanTable): Bảng kế hoạch thời gian pha theo khung giờ (None: không dùng lịch).
+            adaptive (AdaptiveController): Điều khiển thời gian xanh thích ứng (None: không dùng).
+            auto_e3 (bool): Tự gửi E3 (cả hai đỏ) khi bộ giám sát an toàn phát hiện xung đột.
+            on_connection_state (callable): Nhận ConnectionState (trong process()).
+            on_command_result (callable): Nhận CommandResult (trong process()).
+            on_safety_alarm (callable): Nhận SafetyAlarm (trong process()).
+            on_item (callable): Nhận mỗi dòng/khung ngay trước khi đưa vào bộ máy trạng thái (trong process()).
+            report (callable): report(category, text) cho thông báo của chính đường xử lý
+                (category: engine.LOG_* hoặc "system").
+            wake (threading.Event): Được đặt mỗi khi có dữ liệu hoặc sự kiện mới chờ process().
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.reader_mode = reader_mode
+        self.frame_protocol = frame_protocol
+        self.frame_interval_ms = frame_interval_ms
+        self.on_connection_state = on_connection_state
+        self.on_command_result = on_command_result
+        self.on_safety_alarm = on_safety_alarm
+        self.on_item = on_item
+        self.report = report or (lambda category, text: None)
+        self.wake = wake
+        self.connection = None # SerialConnection, tạo trong start()
+        self.connection_state = None
+        self.connection_events = queue.SimpleQueue()
+        self.command_results = queue.SimpleQueue()
+        self.safety_alarms = queue.SimpleQueue()
+        # Lệnh gửi đi được ghi trên luồng riêng, ghép với dòng xác nhận và đo độ trễ khứ hồi
+        self.command_writer = CommandWriter(lambda: self.ser, on_result=self._on_command_result)
+        # Hàng đợi có giới hạn, an toàn luồng; các khung trạng thái cũ trong một lô được gộp
+        self.serial_data_queue = SerialLineQueue(maxlen=2000)
+        self.reported_dropped = 0 # Số dòng bị bỏ đã được báo
+        self.reported_frames_lost = 0 # Số khung nhị phân bị mất đã được báo
+        self.negotiation_deadline = None # Thời điểm kiểm tra kết quả thỏa thuận định dạng khung
+        # Lịch sử mọi khung trạng thái được ghi xuống đĩa trên luồng nền (None: không ghi)
+        self.telemetry = TelemetryWriter(telemetry_dir) if telemetry_dir else None
+        self.telemetry_channel = self.telemetry.channel(port) if self.telemetry else None
+        self.metrics = metrics
+        self.pipeline_metrics = PipelineMetrics(metrics) if metrics and metrics.enabled else None
+        if self.pipeline_metrics:
+            self.register_metric_functions()
+        self.status_api = status_api
+        self.engine = engine.IntersectionState()
+        # Kiểm tra bất biến an toàn trên luồng đọc, trước hàng đợi hiển thị
+        self.safety = SafetyMonitor(self._on_safety_alarm)
+        self.watchdog = self.safety.channel(port, self.command_writer.send_urgent, auto_e3)
+        # Lệnh SET của lịch kế hoạch / điều khiển thích ứng được gửi lúc chuyển chu kỳ, xác nhận bằng SET_UPDATED
+        self.phase_applier = None
+        self.plan_scheduler = None
+        self.adaptive = adaptive
+        if plan_table or adaptive:
+            self.phase_applier = PhaseApplier(port, self.engine, self.command_writer.send)
+        if plan_table:
+            self.plan_scheduler = PlanScheduler(plan_table, {port: self.phase_applier})
+        if adaptive:
+            adaptive.attach(port, self.phase_applier)
+
+    @property
+    def ser(self):
+        """
+        Đối tượng Serial connection hiện tại (None khi chưa kết nối).
+        """
+        return self.connection.ser if self.connection else None
+
+    def register_metric_functions(self):
+        """
+        Các giá trị chỉ được đọc lúc xuất số liệu (không tốn chi phí trên đường nóng).
+        """
+        registry = self.metrics
+        queue_ = self.serial_data_queue
+        registry.gauge_function("serial_queue_dropped_total", lambda: queue_.dropped,
+                                "Số mục bị bỏ do hàng đợi đầy", kind="counter")
+        registry.gauge_function("serial_queue_coalesced_total", lambda: queue_.coalesced,
+                                "Số khung trạng thái cũ bị gộp", kind="counter")
+        registry.gauge_function("binary_frames_lost_total", self.frames_lost,
+                                "Số khung nhị phân bị mất (theo số thứ tự)", kind="counter")
+        registry.gauge_function("commands_sent_total", lambda: self.command_writer.sent,
+                                "Số lệnh đã ghi xuống Serial", kind="counter")
+        registry.gauge_function("commands_failed_total", lambda: self.command_writer.failed,
+                                "Số lệnh thất bại", kind="counter")
+
+    def frames_lost(self):
+        """
+        Số khung nhị phân bị mất (theo số thứ tự) của kết nối hiện tại.
+        """
+        reader = self.connection.reader if self.connection else None
+        return reader.splitter.frames_lost if reader else 0
+
+    # ---- Vòng đời ----
+
+    def start(self):
+        """
+        Khởi động luồng ghi lệnh, giám sát an toàn, lịch kế hoạch / điều khiển thích ứng, telemetry,
+        API trạng thái và kết nối Serial (không chặn).
+        """
+        self.command_writer.start()
+        self.safety.start()
+        if self.plan_scheduler:
+            self.plan_scheduler.start()
+        if self.adaptive:
+            self.adaptive.start()
+        if self.telemetry:
+            self.telemetry.start()
+        if self.status_api:
+            self.start_status_api()
+        self.connection = SerialConnection(self.port, self.baudrate, self.on_serial_item, self.on_connection_event,
+                                           reader_mode=self.reader_mode, metrics=self.pipeline_metrics)
+        self.connection.start()
+
+    def start_status_api(self):
+        """
+        Nối API trạng thái với bộ máy trạng thái và luồng ghi lệnh rồi khởi động máy chủ.
+        Lệnh nhận qua API đi thẳng vào hàng đợi của CommandWriter (an toàn luồng).
+        """
+        api = self.status_api
+        api.send_command = self.command_writer.send
+        if api.metrics is None:
+            api.metrics = self.metrics
+        self.engine.subscribe(api.publish)
+        if api.start():
+            self.report("system", f"API trạng thái: http://{api.host}:{api.port}/state (WebSocket: /ws)")
+        else:
+            self.report(engine.LOG_ERROR, f"Không khởi động được API trạng thái tại {api.host}:{api.port}: "
+                                          f"{api.error}")
+            self.status_api = None
+
+    def close(self):
+        """
+        Dừng mọi luồng nền, đóng cổng Serial và ghi nốt lịch sử còn chờ xuống đĩa.
+        """
+        if self.plan_scheduler:
+            self.plan_scheduler.stop()
+            self.plan_scheduler.join(timeout=2)
+        if self.adaptive:
+            self.adaptive.stop()
+            self.adaptive.join(timeout=2)
+        self.command_writer.stop()
+        self.command_writer.join(timeout=2)
+        self.safety.stop()
+        self.safety.join(timeout=2)
+        if self.connection:
+            self.connection.stop()
+            self.connection.join(timeout=3)
+            self.connection = None
+        if self.telemetry:
+            self.telemetry.stop()
+            self.telemetry.join(timeout=3)
+        if self.status_api:
+            self.status_api.stop()
+            self.status_api.join(timeout=3)
+
+    # ---- Luồng nền ----
+
+    def on_serial_item(self, item):
+        """
+        Được gọi trên luồng đọc cho mỗi dòng/khung: kiểm tra an toàn và xác nhận lệnh ngay khi dòng tới
+        (để cảnh báo sớm và đo độ trễ chính xác), ghi lịch sử rồi đưa vào hàng đợi.
+        """
+        self.watchdog.on_item(item)
+        self.command_writer.on_line(item)
+        if self.telemetry_channel:
+            self.telemetry_channel.on_item(item)
+        self.serial_data_queue.put(item)
+        wake = self.wake
+        if wake is not None and not wake.is_set():
+            wake.set()
+
+    def on_connection_event(self, event):
+        """
+        Được gọi trên luồng quản lý kết nối: đặt lại bộ giám sát an toàn trước khi luồng đọc mới bắt đầu
+        (ESP32 khởi động lại khi mở cổng), rồi chuyển sự kiện cho process().
+        """
+        if event.state in (STATE_CONNECTING, STATE_DISCONNECTED):
+            self.watchdog.reset()
+        self.connection_events.put(event)
+        self._wake()
+
+    def _on_command_result(self, result):
+        self.command_results.put(result)
+        self._wake()
+
+    def _on_safety_alarm(self, alarm):
+        self.safety_alarms.put(alarm)
+        self._wake()
+
+    def _wake(self):
+        if self.wake is not None:
+            self.wake.set()
+
+    # ---- Luồng của nơi sở hữu ----
+
+    def process(self, max_items=None):
+        """
+        Một nhịp xử lý: thay đổi kết nối, kết quả lệnh, cảnh báo an toàn, một lô dữ liệu Serial
+        (các khung trạng thái cũ trong lô đã được gộp), đếm ngược cục bộ của chế độ khung thưa
+        và kết quả thỏa thuận định dạng khung.
+
+        Args:
+            max_items (int): Số mục Serial tối đa xử lý trong nhịp này, None để lấy hết.
+        """
+        metrics = self.pipeline_metrics
+        if metrics:
+            tick_start = time.perf_counter()
+            metrics.queue_depth.set(len(self.serial_data_queue))
+        while True:
+            try:
+                event = self.connection_events.get_nowait()
+            except queue.Empty:
+                break
+            self.handle_connection_state(event)
+        while True:
+            try:
+                result = self.command_results.get_nowait()
+            except queue.Empty:
+                break
+            if self.on_command_result:
+                self.on_command_result(result)
+        while True:
+            try:
+                alarm = self.safety_alarms.get_nowait()
+            except queue.Empty:
+                break
+            self.handle_safety_alarm(alarm)
+        feed = self.engine.feed
+        on_item = self.on_item
+        for item in self.serial_data_queue.drain(max_items):
+            if on_item:
+                on_item(item)
+            if metrics:
+                start = time.perf_counter()
+                feed(item)
+                metrics.parse_seconds.observe(time.perf_counter() - start)
+            else:
+                feed(item)
+        self.engine.tick() # Khung thưa: đếm ngược cục bộ giữa các khung (không làm gì ở chế độ khác)
+        self.check_losses()
+        if self.negotiation_deadline is not None and time.monotonic() >= self.negotiation_deadline:
+            self.negotiation_deadline = None
+            _, mode = FRAME_PROTOCOL_COMMANDS[self.frame_protocol]
+            if self.engine.protocol != mode:
+                self.report(engine.LOG_WARNING, f"ESP32 không xác nhận {engine.PROTOCOL_NAMES[mode]} – "
+                                                f"tiếp tục dùng khung văn bản")
+        if metrics:
+            metrics.tick_seconds.observe(time.perf_counter() - tick_start)
+
+    def check_losses(self):
+        """
+        Báo khi hàng đợi đầy phải bỏ bớt dữ liệu hoặc khi phát hiện mất khung nhị phân (qua số thứ tự).
+        """
+        dropped = self.serial_data_queue.dropped
+        if dropped != self.reported_dropped:
+            self.report(engine.LOG_WARNING, f"Hàng đợi Serial đầy, đã bỏ {dropped - self.reported_dropped} dòng "
+                                            f"(tổng bỏ: {dropped}, đã gộp: {self.serial_data_queue.coalesced})")
+            self.reported_dropped = dropped
+        reader = self.connection.reader if self.connection else None
+        if reader:
+            frames_lost = reader.splitter.frames_lost
+            if frames_lost > self.reported_frames_lost:
+                self.report(engine.LOG_WARNING, f"Mất {frames_lost - self.reported_frames_lost} khung trạng thái "
+                                                f"(tổng mất: {frames_lost}, khung hỏng: {reader.splitter.bad_frames})")
+                self.reported_frames_lost = frames_lost
+
+    def handle_connection_state(self, event):
+        """
+        Xử lý thay đổi kết nối: đặt lại trạng thái khi mở lại cổng, thỏa thuận định dạng khung khi ESP32 sẵn sàng.
+        """
+        self.connection_state = event.state
+        if self.status_api:
+            self.status_api.publish({"connection": event.state, "alarms": self.watchdog.active_alarms()})
+        if event.state == STATE_CONNECTING:
+            self.engine.reset() # Khung đầu tiên sau khi kết nối lại sẽ được phát lại đầy đủ
+            self.reported_frames_lost = 0
+            self.negotiation_deadline = None
+            if self.phase_applier: # ESP32 khởi động lại với thời gian mặc định khi mở lại cổng
+                self.phase_applier.reset()
+        if self.on_connection_state:
+            self.on_connection_state(event)
+        if event.state == STATE_CONNECTED and self.frame_protocol in FRAME_PROTOCOL_COMMANDS:
+            self.negotiate_frame_protocol()
+
+    def negotiate_frame_protocol(self):
+        """
+        Yêu cầu ESP32 gửi khung trạng thái nhị phân ("PROTO,BIN") hoặc khung thưa ("PROTO,SPARSE").
+        Nếu sau NEGOTIATION_TIMEOUT giây chưa nhận được "PROTO_OK,..." (firmware cũ bỏ qua lệnh lạ),
+        đường xử lý tiếp tục dùng khung văn bản "S,".
+        """
+        make_command, _ = FRAME_PROTOCOL_COMMANDS[self.frame_protocol]
+        command = make_command(self.frame_interval_ms)
+        if self.command_writer.send(command):
+            self.report("system", f"Gửi lệnh: {command}")
+            self.negotiation_deadline = time.monotonic() + NEGOTIATION_TIMEOUT
+
+    def handle_safety_alarm(self, alarm):
+        if self.status_api:
+            self.status_api.publish({"alarms": self.watchdog.active_alarms(), "last_alarm": alarm.message})
+        if self.on_safety_alarm:
+            self.on_safety_alarm(alarm)
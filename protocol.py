@@ -0,0 +1,116 @@
+import struct
+from collections import namedtuple
+
+# Khung trạng thái nhị phân (8 byte), được ESP32 gửi sau khi thỏa thuận "PROTO,BIN":
+#   [0] 0xA5 byte đồng bộ      [1] số thứ tự (uint8, quay vòng)
+#   [2] màu Mạch 1 (mã màu)    [3] giây còn lại Mạch 1 (uint8)
+#   [4] màu Mạch 2 (mã màu)    [5] giây còn lại Mạch 2 (uint8)
+#   [6] cờ: bit 0-1 chế độ khẩn cấp, bit 2 đang vàng chuyển tiếp
+#   [7] CRC-8 (đa thức 0x07) của byte 1..6
+FRAME_SYNC = 0xA5
+FRAME_SIZE = 8
+FRAME_STRUCT = struct.Struct("<BBBBBBBB")
+COLOR_NAMES = ("RED", "YELLOW", "GREEN") # Mã màu 0, 1, 2
+COLOR_CODES = {name: code for code, name in enumerate(COLOR_NAMES)}
+FLAG_YELLOW_TRANSITION = 0x04
+
+# Lệnh thỏa thuận và phản hồi của firmware
+PROTO_BINARY_COMMAND = "PROTO,BIN"
+PROTO_TEXT_COMMAND = "PROTO,TEXT"
+PROTO_SPARSE_COMMAND = "PROTO,SPARSE" # Khung thưa: chỉ gửi khi chuyển pha và khung đồng bộ định kỳ
+PROTO_ACK_PREFIX = "PROTO_OK,"
+
+StatusFrame = namedtuple("StatusFrame", "seq m1_color m1_secs m2_color m2_secs emergency_mode")
+
+
+def _build_crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+CRC8_TABLE = _build_crc8_table()
+
+
+def crc8(data):
+    """
+    Tính CRC-8 (đa thức 0x07, giá trị đầu 0) như hàm crc8() trong firmware.
+
+    Args:
+        data: bytes, bytearray hoặc memoryview.
+    """
+    crc = 0
+    table = CRC8_TABLE
+    for byte in data:
+        crc = table[crc ^ byte]
+    return crc
+
+
+def encode_status_frame(seq, m1_color, m1_secs, m2_color, m2_secs, emergency_mode=0, yellow_transition=False):
+    """
+    Đóng gói một khung trạng thái nhị phân (dùng cho bộ mô phỏng và kiểm thử).
+
+    Returns:
+        bytes: Khung 8 byte.
+    """
+    flags = (emergency_mode & 0x03) | (FLAG_YELLOW_TRANSITION if yellow_transition else 0)
+    body = bytes((seq & 0xFF, COLOR_CODES[m1_color], min(max(m1_secs, 0), 255),
+                  COLOR_CODES[m2_color], min(max(m2_secs, 0), 255), flags))
+    return bytes((FRAME_SYNC,)) + body + bytes((crc8(body),))
+
+
+def decode_status_frame(view, offset=0):
+    """
+    Giải mã một khung trạng thái nhị phân trực tiếp từ bộ đệm, không tạo chuỗi trung gian.
+
+    Args:
+        view (memoryview): Bộ đệm chứa ít nhất FRAME_SIZE byte tính từ offset.
+        offset (int): Vị trí byte đồng bộ.
+
+    Returns:
+        StatusFrame: Khung đã giải mã, hoặc None nếu sai CRC hoặc mã màu không hợp lệ.
+    """
+    sync, seq, m1_code, m1_secs, m2_code, m2_secs, flags, crc = FRAME_STRUCT.unpack_from(view, offset)
+    if sync != FRAME_SYNC or crc8(view[offset + 1:offset + 7]) != crc:
+        return None
+    if m1_code >= len(COLOR_NAMES) or m2_code >= len(COLOR_NAMES):
+        return None
+    return StatusFrame(seq, COLOR_NAMES[m1_code], m1_secs, COLOR_NAMES[m2_code], m2_secs, flags & 0x03)
+
+
+def format_status_frame(frame):
+    """
+    Chuỗi hiển thị của khung nhị phân theo dạng khung văn bản "S,..." (dùng cho nhật ký).
+    """
+    return f"S,{frame.m1_color},{frame.m1_secs},{frame.m2_color},{frame.m2_secs} [#{frame.seq}]"
+
+
+def binary_command(interval_ms=None):
+    """
+    Lệnh yêu cầu ESP32 chuyển sang khung nhị phân, tùy chọn kèm chu kỳ gửi (mili giây).
+    """
+    if interval_ms is None:
+        return PROTO_BINARY_COMMAND
+    return f"{PROTO_BINARY_COMMAND},{int(interval_ms)}"
+
+
+def sparse_command(sync_interval_ms=None):
+    """
+    Lệnh yêu cầu ESP32 chuyển sang khung thưa "S,<màu>,<giây>,<màu>,<giây>,<ms_m1>,<ms_m2>"
+    (chỉ gửi khi chuyển pha và mỗi sync_interval_ms), tùy chọn kèm chu kỳ đồng bộ (mili giây).
+    """
+    if sync_interval_ms is None:
+        return PROTO_SPARSE_COMMAND
+    return f"{PROTO_SPARSE_COMMAND},{int(sync_interval_ms)}"
+
+
+# Định dạng khung được thỏa thuận khi kết nối -> (hàm tạo lệnh PROTO, chế độ trong phản hồi PROTO_OK)
+FRAME_PROTOCOL_COMMANDS = {
+    "binary": (binary_command, "BIN"),
+    "sparse": (sparse_command, "SPARSE"),
+}
+NEGOTIATION_TIMEOUT = 2.0 # Thời gian (giây) chờ "PROTO_OK,..." trước khi quay về khung văn bản
@@ -0,0 +1,266 @@
+import threading
+import time
+from collections import namedtuple
+
+from engine import VALID_COLORS, parse_uint
+from protocol import PROTO_ACK_PREFIX, StatusFrame
+
+# Loại cảnh báo an toàn
+ALARM_CONFLICT = "conflict"             # Hai hướng cùng xanh/vàng
+ALARM_SKIPPED_YELLOW = "skipped_yellow" # Một hướng chuyển thẳng xanh -> đỏ, không qua vàng
+ALARM_STUCK = "stuck"                   # Đếm ngược không giảm
+ALARM_FRAME_TIMEOUT = "frame_timeout"   # Không nhận được khung trạng thái
+
+# Cảnh báo: tên ngã tư, loại, đang xảy ra (False: đã hết), mô tả, màu hai mạch lúc phát hiện
+SafetyAlarm = namedtuple("SafetyAlarm", "name kind active message m1_color m2_color")
+
+TEXT_FRAME_INTERVAL = 0.2 # Chu kỳ khung văn bản mặc định của firmware (giây)
+SPARSE_SYNC_INTERVAL = 5.0 # Chu kỳ khung đồng bộ mặc định của chế độ khung thưa (giây)
+MIN_FRAME_TIMEOUT = 1.0 # Thời gian chờ khung tối thiểu (giây)
+STUCK_SECONDS = 3.0 # Số giây đếm ngược đứng yên (ngoài chu kỳ khung) trước khi cảnh báo
+YELLOW_SECONDS = 2.0 # Thời gian đèn vàng của firmware: hai khung cách nhau lâu hơn có thể bỏ lỡ pha vàng
+
+# Dòng cho biết ESP32 vừa đặt lại chu kỳ (SET, NORMAL, tắt khẩn cấp): khung kế tiếp được phép nhảy pha
+RESTART_PREFIXES = ("SET_UPDATED,", "SET_ERROR")
+RESTART_MARKER = "TẮT KHẨN CẤP"
+E3_ACTIVE_MARKER = "CẢ HAI ĐỎ" # Thông báo bật E3 (hoặc đang chuyển vàng trước E3)
+
+COLORS = ("RED", "YELLOW", "GREEN")
+
+
+def _build_tables():
+    """
+    Bảng tính sẵn cho mọi cặp màu (M1, M2) và mọi bước chuyển giữa hai cặp màu,
+    để mỗi khung chỉ cần một phép tra từ điển.
+
+    Returns:
+        tuple: (frozenset các cặp xung đột, dict (cặp trước, cặp sau) -> hướng bỏ qua vàng hoặc None).
+    """
+    pairs = [(m1, m2) for m1 in COLORS for m2 in COLORS]
+    conflicts = frozenset(pair for pair in pairs if pair[0] != "RED" and pair[1] != "RED")
+    skipped = {}
+    for before in pairs:
+        for after in pairs:
+            directions = [f"Mạch {index + 1}" for index in range(2)
+                          if before[index] == "GREEN" and after[index] == "RED"]
+            skipped[before, after] = " và ".join(directions) or None
+    return conflicts, skipped
+
+
+CONFLICTING_PAIRS, SKIPPED_YELLOW = _build_tables()
+
+
+class IntersectionWatchdog:
+    """
+    Kiểm tra bất biến an toàn của một ngã tư trên luồng đọc Serial, trước hàng đợi hiển thị:
+    mỗi khung trạng thái chỉ tốn một lần tách chuỗi và vài phép tra bảng tính sẵn.
+    Theo dõi riêng (không dùng bộ máy trạng thái của GUI) chế độ E3 và định dạng khung đã thỏa thuận
+    từ chính các dòng nhận được. Tạo bằng SafetyMonitor.channel().
+    """
+    def __init__(self, name, monitor, send=None, auto_e3=False):
+        """
+        Args:
+            name (str): Tên ngã tư.
+            monitor (SafetyMonitor): Bộ giám sát chung (nhận cảnh báo, kiểm tra hết thời gian chờ khung).
+            send (callable): Hàm gửi lệnh an toàn luồng (ví dụ CommandWriter.send_urgent), cần cho auto_e3.
+            auto_e3 (bool): Tự gửi E3 (cả hai đỏ) khi phát hiện xung đột.
+        """
+        self.name = name
+        self.monitor = monitor
+        self.send = send
+        self.auto_e3 = auto_e3 and send is not None
+        self.e3_sent = 0 # Số lần đã tự gửi E3
+        self.reset()
+
+    def reset(self):
+        """
+        Quên trạng thái đã biết (gọi khi mở lại cổng: ESP32 khởi động lại với khung văn bản).
+        """
+        self.pair = None # Cặp màu của khung gần nhất
+        self.m1_secs = self.m2_secs = None
+        self.progress_at = None # Thời điểm đếm ngược thay đổi gần nhất
+        self.frame_at = None # Thời điểm nhận khung gần nhất
+        self.deadline = None # Thời điểm phải nhận khung kế tiếp (None: chưa nhận khung nào)
+        self.restarted = False # ESP32 vừa đặt lại chu kỳ
+        self.e3_active = False # ESP32 đang ở E3 hoặc đang chuyển vàng trước E3
+        self.conflict = self.stuck = self.timed_out = False # Cảnh báo đang bật
+        self.set_frame_interval(TEXT_FRAME_INTERVAL)
+
+    def set_frame_interval(self, interval, sparse=False, now=None):
+        """
+        Tính lại thời gian chờ khung và ngưỡng đếm ngược đứng yên theo chu kỳ khung (giây);
+        hạn chờ khung kế tiếp được tính lại theo chu kỳ mới.
+        """
+        self.sparse = sparse
+        self.frame_at = None # Khung trước đó thuộc định dạng cũ: không suy ra được pha vàng đã bị bỏ qua
+        if sparse: # Chỉ có khung chuyển pha và khung đồng bộ
+            self.frame_timeout = 2 * interval + MIN_FRAME_TIMEOUT
+        else:
+            self.frame_timeout = max(5 * interval, MIN_FRAME_TIMEOUT)
+        self.stuck_timeout = interval + STUCK_SECONDS
+        if self.deadline is not None:
+            self.deadline = (time.monotonic() if now is None else now) + self.frame_timeout
+
+    def on_item(self, item, now=None):
+        """
+        Kiểm tra một mục nhận được (gọi trên luồng đọc).
+
+        Args:
+            item (str | StatusFrame): Dòng văn bản hoặc khung nhị phân đã giải mã.
+            now (float): Thời điểm nhận (time.monotonic()), mặc định lúc gọi.
+        """
+        if item.__class__ is StatusFrame:
+            self.on_frame(item.m1_color, item.m1_secs, item.m2_color, item.m2_secs, now)
+        elif item.startswith("S,"):
+            parts = item.split(",")
+            if len(parts) in (5, 7) and parts[1] in VALID_COLORS and parts[3] in VALID_COLORS:
+                m1_secs = parse_uint(parts[2])
+                m2_secs = parse_uint(parts[4])
+                if m1_secs is not None and m2_secs is not None:
+                    self.on_frame(parts[1], m1_secs, parts[3], m2_secs, now)
+        elif item.startswith(RESTART_PREFIXES):
+            self.restarted = True
+        elif item.startswith(">>>"):
+            if RESTART_MARKER in item:
+                self.restarted = True
+                self.e3_active = False
+            elif E3_ACTIVE_MARKER in item:
+                self.e3_active = True
+            elif "KHẨN CẤP" in item: # Chuyển sang E1/E2 (hoặc đang chuyển vàng trước E1/E2)
+                self.e3_active = False
+        elif item.startswith(PROTO_ACK_PREFIX):
+            self.on_protocol_ack(item, now)
+
+    def on_protocol_ack(self, line, now=None):
+        parts = line.split(",")
+        interval_ms = parse_uint(parts[2]) if len(parts) > 2 else None
+        if len(parts) > 1 and parts[1] == "SPARSE":
+            self.set_frame_interval(interval_ms / 1000 if interval_ms else SPARSE_SYNC_INTERVAL, True, now)
+        elif len(parts) > 1 and parts[1] in ("BIN", "TEXT"):
+            self.set_frame_interval(interval_ms / 1000 if interval_ms else TEXT_FRAME_INTERVAL, False, now)
+
+    def on_frame(self, m1_color, m1_secs, m2_color, m2_secs, now=None):
+        if now is None:
+            now = time.monotonic()
+        pair = (m1_color, m2_color)
+        previous = self.pair
+        restarted = self.restarted
+        self.restarted = False
+        # Khung thưa luôn gửi khi chuyển pha; khung đều chỉ thấy được pha vàng khi hai khung đủ gần nhau
+        yellow_visible = self.frame_at is not None and (self.sparse or now - self.frame_at < YELLOW_SECONDS)
+        self.frame_at = now
+        self.deadline = now + self.frame_timeout
+        if self.timed_out:
+            self.timed_out = False
+            self.raise_alarm(ALARM_FRAME_TIMEOUT, False, "Đã nhận lại khung trạng thái", pair)
+
+        # 1. Xung đột: hai hướng cùng không đỏ
+        if pair in CONFLICTING_PAIRS:
+            if not self.conflict:
+                self.conflict = True
+                self.raise_alarm(ALARM_CONFLICT, True, f"XUNG ĐỘT: Mạch 1 {m1_color}, Mạch 2 {m2_color}", pair)
+                if self.auto_e3 and not self.e3_active:
+                    self.e3_active = True # E3 là lệnh bật/tắt: không gửi lại khi ESP32 đã (hoặc sắp) ở E3
+                    self.e3_sent += 1
+                    self.send("E3")
+        elif self.conflict:
+            self.conflict = False
+            self.raise_alarm(ALARM_CONFLICT, False, f"Hết xung đột: Mạch 1 {m1_color}, Mạch 2 {m2_color}", pair)
+
+        # 2. Bỏ qua pha vàng (trừ khi ESP32 vừa đặt lại chu kỳ theo lệnh)
+        if previous is not None and previous != pair and yellow_visible:
+            directions = SKIPPED_YELLOW[previous, pair]
+            if directions is not None and not restarted:
+                self.raise_alarm(ALARM_SKIPPED_YELLOW, True, f"{directions} chuyển thẳng từ xanh sang đỏ", pair)
+
+        # 3. Đếm ngược đứng yên (khung khẩn cấp luôn có thời gian 0; chu kỳ vừa đặt lại cũng tính là chạy)
+        if restarted or pair != previous or m1_secs != self.m1_secs or m2_secs != self.m2_secs or not (m1_secs or m2_secs):
+            self.progress_at = now
+            if self.stuck:
+                self.stuck = False
+                self.raise_alarm(ALARM_STUCK, False, "Đếm ngược chạy lại", pair)
+        elif not self.stuck and now - self.progress_at > self.stuck_timeout:
+            self.stuck = True
+            self.raise_alarm(ALARM_STUCK, True, f"Đếm ngược đứng yên {now - self.progress_at:.1f}s "
+                                                f"(Mạch 1 {m1_secs}s, Mạch 2 {m2_secs}s)", pair)
+        self.pair = pair
+        self.m1_secs = m1_secs
+        self.m2_secs = m2_secs
+
+    def check_timeout(self, now):
+        """
+        Gọi định kỳ từ luồng của SafetyMonitor: cảnh báo khi quá hạn mà không có khung nào.
+        """
+        deadline = self.deadline
+        if deadline is not None and not self.timed_out and now > deadline:
+            self.timed_out = True
+            self.raise_alarm(ALARM_FRAME_TIMEOUT, True, f"Không nhận được khung trạng thái trong "
+                                                        f"{self.frame_timeout:.1f}s", self.pair or (None, None))
+
+    def active_alarms(self):
+        """
+        Returns:
+            list: Các loại cảnh báo đang bật (bỏ qua pha vàng là cảnh báo một lần, không nằm ở đây).
+        """
+        return [kind for kind, active in ((ALARM_CONFLICT, self.conflict), (ALARM_STUCK, self.stuck),
+                                          (ALARM_FRAME_TIMEOUT, self.timed_out)) if active]
+
+    def raise_alarm(self, kind, active, message, pair):
+        self.monitor.on_alarm(SafetyAlarm(self.name, kind, active, message, pair[0], pair[1]))
+
+
+class SafetyMonitor:
+    """
+    Giám sát an toàn cho một hoặc nhiều ngã tư: mỗi ngã tư có một IntersectionWatchdog chạy trên luồng đọc,
+    còn việc phát hiện mất khung dùng một luồng hẹn giờ chung (mỗi tick duyệt mọi ngã tư một lần).
+    Cảnh báo được chuyển cho on_alarm trên luồng phát hiện ra nó (luồng đọc hoặc luồng hẹn giờ);
+    nơi nhận đưa chúng về luồng giao diện qua hàng đợi, nên đường hiển thị không phải chờ.
+    """
+    def __init__(self, on_alarm, tick=0.1, clock=time.monotonic):
+        """
+        Args:
+            on_alarm (callable): Hàm nhận SafetyAlarm (phải an toàn luồng, ví dụ SimpleQueue.put).
+            tick (float): Chu kỳ kiểm tra mất khung (giây).
+            clock (callable): Đồng hồ đơn điệu.
+        """
+        self.on_alarm_callback = on_alarm
+        self.tick = tick
+        self.clock = clock
+        self.channels = {} # Tên ngã tư -> IntersectionWatchdog
+        self.alarms = 0 # Số cảnh báo đã phát
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="safety-monitor", daemon=True)
+
+    def channel(self, name, send=None, auto_e3=False):
+        """
+        Tạo bộ kiểm tra cho một ngã tư (gọi trước start()).
+
+        Returns:
+            IntersectionWatchdog: Bộ kiểm tra, gọi on_item() với mọi mục đọc được.
+        """
+        watchdog = IntersectionWatchdog(name, self, send, auto_e3)
+        self.channels[name] = watchdog
+        return watchdog
+
+    def on_alarm(self, alarm):
+        if alarm.active:
+            self.alarms += 1
+        self.on_alarm_callback(alarm)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _run(self):
+        channels = list(self.channels.values())
+        while not self._stop_event.wait(self.tick):
+            now = self.clock()
+            for watchdog in channels:
+                watchdog.check_timeout(now)
@@ -0,0 +1,346 @@
+import json
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import engine
+from command_writer import MAX_PHASE_SECONDS
+
+YELLOW_SECONDS = 2 # Pha vàng cố định của firmware: đỏ đối diện luôn bằng xanh + 2 giây
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+MAX_SLEEP = 300.0 # Ngủ tối đa (giây) trước khi tính lại, phòng khi đồng hồ hệ thống bị chỉnh (NTP, giờ mùa hè)
+
+# Một kế hoạch thời gian pha: thời gian xanh/đỏ (giây) và lệnh SET tương ứng
+PhasePlan = namedtuple("PhasePlan", "name green red command")
+# Một mốc trong lịch: phút trong ngày, các ngày áp dụng (frozenset chỉ số thứ, None: mọi ngày), kế hoạch
+ScheduleEntry = namedtuple("ScheduleEntry", "minute days plan")
+
+
+def parse_plan(name, spec):
+    """
+    Kiểm tra một kế hoạch {"green": giây} hoặc {"red": giây} (hoặc cả hai, với đỏ = xanh + 2).
+
+    Returns:
+        PhasePlan: Kế hoạch đã chuẩn hóa theo thời gian xanh.
+
+    Raises:
+        ValueError: Kế hoạch không hợp lệ.
+    """
+    green = spec.get("green")
+    red = spec.get("red")
+    if green is None and red is None:
+        raise ValueError(f"Kế hoạch '{name}' cần 'green' hoặc 'red'")
+    if green is None:
+        green = red - YELLOW_SECONDS if isinstance(red, int) else red
+    if not isinstance(green, int) or not 1 <= green <= MAX_PHASE_SECONDS - YELLOW_SECONDS:
+        raise ValueError(f"Kế hoạch '{name}': thời gian xanh phải từ 1 đến {MAX_PHASE_SECONDS - YELLOW_SECONDS}s "
+                         f"(đỏ từ {1 + YELLOW_SECONDS}s)")
+    if red is not None and red != green + YELLOW_SECONDS:
+        raise ValueError(f"Kế hoạch '{name}': firmware luôn đặt đỏ = xanh + {YELLOW_SECONDS}s")
+    return PhasePlan(name, green, green + YELLOW_SECONDS, f"SET,GREEN,{green}")
+
+
+def parse_schedule(items, plans):
+    """
+    Kiểm tra danh sách mốc [{"at": "HH:MM", "plan": tên, "days": ["mon", ...]}, ...].
+
+    Returns:
+        list: Các ScheduleEntry sắp theo giờ.
+    """
+    entries = []
+    for item in items:
+        try:
+            hours, minutes = item["at"].split(":")
+            minute = int(hours) * 60 + int(minutes)
+        except (KeyError, ValueError, AttributeError):
+            raise ValueError(f"Mốc lịch cần 'at' dạng HH:MM: {item}") from None
+        if not 0 <= minute < 24 * 60:
+            raise ValueError(f"Giờ không hợp lệ: {item['at']}")
+        if item.get("plan") not in plans:
+            raise ValueError(f"Mốc {item['at']} dùng kế hoạch không tồn tại: {item.get('plan')}")
+        days = item.get("days")
+        if days is not None:
+            try:
+                days = frozenset(WEEKDAYS.index(day.lower()[:3]) for day in days)
+            except (ValueError, AttributeError):
+                raise ValueError(f"Ngày không hợp lệ (mon..sun): {days}") from None
+        entries.append(ScheduleEntry(minute, days, plans[item["plan"]]))
+    entries.sort(key=lambda entry: entry.minute)
+    return entries
+
+
+class PlanTable:
+    """
+    Bảng kế hoạch thời gian pha theo khung giờ (giờ cao điểm/thấp điểm...), dùng chung một lịch
+    mặc định và có thể ghi đè lịch riêng cho từng ngã tư.
+    """
+    def __init__(self, plans, default=(), intersections=None):
+        """
+        Args:
+            plans (dict): Tên -> PhasePlan.
+            default (list): Lịch mặc định (các ScheduleEntry).
+            intersections (dict): Tên ngã tư (hoặc cổng) -> lịch riêng.
+        """
+        self.plans = plans
+        self.default = list(default)
+        self.intersections = intersections or {}
+
+    def schedule_for(self, name):
+        return self.intersections.get(name, self.default)
+
+
+def load_plan_table(path):
+    """
+    Đọc file bảng kế hoạch JSON.
+
+    Định dạng:
+        {
+            "plans": {"peak": {"green": 20}, "offpeak": {"green": 8}, "night": {"red": 7}},
+            "schedule": [
+                {"at": "06:30", "plan": "peak", "days": ["mon", "tue", "wed", "thu", "fri"]},
+                {"at": "09:00", "plan": "offpeak"},
+                {"at": "22:00", "plan": "night"}
+            ],
+            "intersections": {"Ngã tư A": [{"at": "00:00", "plan": "offpeak"}]}
+        }
+
+    Args:
+        path (str): Đường dẫn tới file.
+
+    Returns:
+        PlanTable: Bảng đã kiểm tra.
+
+    Raises:
+        ValueError: Nội dung không hợp lệ.
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    plans = {name: parse_plan(name, spec) for name, spec in config.get("plans", {}).items()}
+    if not plans:
+        raise ValueError("Bảng kế hoạch không có kế hoạch nào (khóa 'plans')")
+    default = parse_schedule(config.get("schedule", []), plans)
+    intersections = {name: parse_schedule(items, plans)
+                     for name, items in config.get("intersections", {}).items()}
+    return PlanTable(plans, default, intersections)
+
+
+def active_plan(entries, when):
+    """
+    Kế hoạch đang có hiệu lực tại thời điểm when: mốc gần nhất đã qua (xét lùi tối đa một tuần).
+
+    Returns:
+        PhasePlan: Kế hoạch, hoặc None nếu lịch trống.
+    """
+    minute = when.hour * 60 + when.minute
+    for offset in range(8):
+        weekday = (when.weekday() - offset) % 7
+        for entry in reversed(entries):
+            if (offset or entry.minute <= minute) and (entry.days is None or weekday in entry.days):
+                return entry.plan
+    return None
+
+
+def next_change(entries, when):
+    """
+    Thời điểm của mốc kế tiếp sau when (xét tối đa 8 ngày), None nếu lịch trống.
+    """
+    midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    for offset in range(8):
+        day = midnight + timedelta(days=offset)
+        for entry in entries:
+            at = day + timedelta(minutes=entry.minute)
+            if at > when and (entry.days is None or day.weekday() in entry.days):
+                return at
+    return None
+
+
+class PhaseApplier:
+    """
+    Áp dụng kế hoạch cho một ngã tư đúng lúc chuyển pha, không làm gián đoạn giao thông.
+    Firmware đặt lại chu kỳ (cycleStartTime) khi nhận SET nên lệnh chỉ được gửi ngay khi chu kỳ tự bắt đầu lại
+    (Mạch 1 vàng -> đỏ, Mạch 2 đỏ -> xanh): chu kỳ mới chỉ dài thêm đúng độ trễ của đường truyền.
+    Mỗi lệnh được xác nhận qua "SET_UPDATED" (sự kiện PhaseTimesUpdated); yêu cầu mới thay thế yêu cầu
+    chưa áp dụng và kế hoạch trùng với thời gian đang chạy không được gửi lại.
+    Chạy trên luồng của bộ máy trạng thái (luồng GUI hoặc vòng lặp headless); request() an toàn luồng:
+    kế hoạch yêu cầu (plan, desired, attempts) được đọc và ghi dưới khóa ở cả hai phía.
+    """
+    def __init__(self, name, state, send, verify_timeout=5.0, max_attempts=3):
+        """
+        Args:
+            name (str): Tên ngã tư (dùng trong nhật ký).
+            state (IntersectionState): Bộ máy trạng thái của ngã tư.
+            send (callable): Hàm gửi một lệnh, trả về False nếu bị từ chối (ví dụ CommandWriter.send).
+            verify_timeout (float): Thời gian chờ SET_UPDATED (giây) trước khi coi là thất bại.
+            max_attempts (int): Số lần gửi tối đa cho cùng một kế hoạch.
+        """
+        self.name = name
+        self.state = state
+        self.send = send
+        self.verify_timeout = verify_timeout
+        self.max_attempts = max_attempts
+        self.plan = None # Kế hoạch lịch đang yêu cầu
+        self.desired = None # Kế hoạch còn phải áp dụng (None: đã áp dụng hoặc bị đặt tay)
+        self.applied_green = None # Thời gian xanh ESP32 đã xác nhận (None: chưa biết)
+        self.in_flight = None # (kế hoạch, thời điểm gửi) đang chờ SET_UPDATED
+        self.attempts = 0 # Số lần đã gửi kế hoạch desired hiện tại
+        self.sent = 0
+        self.verified = 0
+        self.failed = 0
+        self.coalesced = 0 # Yêu cầu bị thay thế trước khi kịp áp dụng
+        self.skipped = 0 # Yêu cầu trùng với thời gian đang chạy, không gửi
+        self.last_colors = None
+        self._lock = threading.Lock() # Bảo vệ plan/desired/attempts (request() đến từ luồng lịch / thích ứng)
+        state.subscribe(self.on_event)
+
+    def request(self, plan):
+        """
+        Đặt kế hoạch cần áp dụng ở lần chuyển chu kỳ kế tiếp (gọi từ luồng bất kỳ; yêu cầu mới nhất thắng).
+        """
+        with self._lock:
+            pending = self.desired
+            if pending is not None and pending is not plan and pending.green != self.applied_green:
+                self.coalesced += 1
+            self.plan = plan
+            self.desired = plan
+            self.attempts = 0
+
+    def reset(self):
+        """
+        Gọi khi kết nối lại: ESP32 khởi động lại với thời gian mặc định nên kế hoạch hiện tại phải được áp dụng lại.
+        """
+        self.applied_green = None
+        self.in_flight = None
+        self.last_colors = None
+        with self._lock:
+            self.desired = self.plan
+            self.attempts = 0
+
+    def on_event(self, event):
+        kind = type(event)
+        if kind is engine.LightsChanged:
+            colors = (event.m1_color, event.m2_color)
+            if colors != self.last_colors:
+                previous, self.last_colors = self.last_colors, colors
+                self.check_timeout()
+                # Chu kỳ tự bắt đầu lại: Mạch 1 hết vàng sang đỏ, Mạch 2 sang xanh
+                if previous == ("YELLOW", "RED") and colors == ("RED", "GREEN") and not self.state.emergency_mode:
+                    self.apply()
+        elif kind is engine.PhaseTimesUpdated:
+            self.on_phase_times(event)
+
+    def apply(self):
+        if self.in_flight is not None:
+            return
+        with self._lock:
+            desired = self.desired
+            if desired is None:
+                return
+            if desired.green == self.applied_green:
+                self.skipped += 1
+                self.desired = None
+                return
+            if self.attempts >= self.max_attempts:
+                return
+            self.attempts += 1
+        if not self.send(desired.command):
+            return
+        self.sent += 1
+        self.in_flight = (desired, time.monotonic())
+        self.state.log(engine.LOG_INFO, f"[{self.name}] Áp dụng kế hoạch '{desired.name}' lúc chuyển chu kỳ: "
+                                        f"xanh {desired.green}s, đỏ {desired.red}s")
+
+    def on_phase_times(self, event):
+        """
+        Phản hồi SET_UPDATED: xác nhận lệnh đang chờ, hoặc ghi nhận thay đổi thủ công (từ GUI/API).
+        """
+        green = event.seconds if event.color == "GREEN" else event.opposing_seconds
+        self.applied_green = green
+        in_flight = self.in_flight
+        if in_flight is None: # Người vận hành đặt tay: giữ nguyên tới mốc lịch kế tiếp
+            with self._lock:
+                desired = self.desired
+                if desired is not None and desired.green != green:
+                    self.desired = None
+                else:
+                    desired = None
+            if desired is not None:
+                self.state.log(engine.LOG_INFO, f"[{self.name}] Thời gian pha được đặt thủ công – "
+                                                f"tạm dừng kế hoạch '{desired.name}' tới mốc lịch kế tiếp")
+            return
+        plan, _ = in_flight
+        self.in_flight = None
+        if green == plan.green:
+            self.verified += 1
+            with self._lock:
+                if self.desired is plan:
+                    self.desired = None
+        else:
+            self.failed += 1
+            self.state.log(engine.LOG_WARNING, f"[{self.name}] ESP32 xác nhận xanh {green}s thay vì {plan.green}s "
+                                               f"(kế hoạch '{plan.name}') – thử lại ở chu kỳ sau")
+
+    def check_timeout(self):
+        in_flight = self.in_flight
+        if in_flight is not None and time.monotonic() - in_flight[1] > self.verify_timeout:
+            self.in_flight = None
+            self.failed += 1
+            self.state.log(engine.LOG_WARNING, f"[{self.name}] Không nhận được SET_UPDATED cho kế hoạch "
+                                               f"'{in_flight[0].name}' – thử lại ở chu kỳ sau")
+
+
+class PlanScheduler:
+    """
+    Luồng lịch duy nhất cho mọi ngã tư: tính trước mốc lịch kế tiếp và ngủ tới đúng lúc đó
+    (một lần chờ, không thăm dò), rồi đặt kế hoạch mới cho các PhaseApplier có kế hoạch thay đổi.
+    """
+    def __init__(self, table, appliers, clock=datetime.now):
+        """
+        Args:
+            table (PlanTable): Bảng kế hoạch.
+            appliers (dict): Tên ngã tư -> PhaseApplier.
+            clock (callable): Hàm trả về giờ địa phương hiện tại.
+        """
+        self.table = table
+        self.appliers = appliers
+        self.clock = clock
+        self.requested = {} # Tên ngã tư -> kế hoạch đã yêu cầu gần nhất
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="plan-scheduler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def update(self, now):
+        """
+        Yêu cầu kế hoạch đang có hiệu lực cho mọi ngã tư có kế hoạch thay đổi.
+
+        Returns:
+            datetime: Mốc lịch kế tiếp, None nếu không có.
+        """
+        upcoming = None
+        for name, applier in self.appliers.items():
+            entries = self.table.schedule_for(name)
+            plan = active_plan(entries, now)
+            if plan is not None and plan is not self.requested.get(name):
+                self.requested[name] = plan
+                applier.request(plan)
+            at = next_change(entries, now)
+            if at is not None and (upcoming is None or at < upcoming):
+                upcoming = at
+        return upcoming
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            now = self.clock()
+            upcoming = self.update(now)
+            delay = MAX_SLEEP if upcoming is None else min((upcoming - now).total_seconds(), MAX_SLEEP)
+            self._stop_event.wait(max(delay, 0.0))
@@ -0,0 +1,92 @@
+import threading
+from collections import deque
+
+from protocol import StatusFrame
+
+
+def is_status_line(item):
+    """
+    Kiểm tra một mục trong hàng đợi có phải khung trạng thái đèn hay không:
+    dòng văn bản "S,..." hoặc StatusFrame giải mã từ khung nhị phân.
+    """
+    if isinstance(item, str):
+        return item.startswith("S,")
+    return isinstance(item, StatusFrame)
+
+
+class SerialLineQueue:
+    """
+    Hàng đợi an toàn luồng (thread-safe) có giới hạn, nối luồng đọc Serial với luồng Tkinter.
+    Luồng đọc gọi put() cho từng dòng; luồng chính gọi drain() mỗi nhịp để lấy cả lô.
+    Trong một lô, các khung trạng thái "S," cũ được gộp lại: chỉ khung mới nhất được giữ,
+    tại đúng vị trí của nó so với các thông báo khác (khẩn cấp, cảnh báo...).
+    """
+    def __init__(self, maxlen=2000, is_status=is_status_line):
+        """
+        Args:
+            maxlen (int): Số mục tối đa trong hàng đợi. Khi đầy, mục cũ nhất bị bỏ.
+            is_status (callable): Hàm nhận một mục, trả về True nếu đó là khung trạng thái có thể gộp.
+        """
+        self.maxlen = maxlen
+        self.is_status = is_status
+        self._items = deque()
+        self._lock = threading.Lock()
+        self.dropped = 0   # Số mục bị bỏ do hàng đợi đầy
+        self.coalesced = 0 # Số khung trạng thái cũ bị gộp (không hiển thị)
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """
+        Thêm một mục vào hàng đợi (gọi từ luồng đọc Serial).
+
+        Args:
+            item: Dòng dữ liệu (hoặc khung đã giải mã) nhận được.
+        """
+        with self._lock:
+            if len(self._items) >= self.maxlen:
+                self._items.popleft() # Bỏ mục cũ nhất để luôn giữ dữ liệu mới
+                self.dropped += 1
+            self._items.append(item)
+
+    def drain(self, max_items=None):
+        """
+        Lấy ra một lô mục (gọi từ luồng chính), đã gộp các khung trạng thái cũ.
+
+        Args:
+            max_items (int): Số mục tối đa lấy ra trong một lần, None để lấy hết.
+
+        Returns:
+            list: Các mục theo đúng thứ tự nhận, chỉ còn khung trạng thái mới nhất của lô.
+        """
+        with self._lock:
+            if not self._items:
+                return []
+            if max_items is None or max_items >= len(self._items):
+                batch = self._items
+                self._items = deque()
+            else:
+                popleft = self._items.popleft
+                batch = [popleft() for _ in range(max_items)]
+        return self._coalesce(batch)
+
+    def _coalesce(self, batch):
+        """
+        Duyệt ngược lô để giữ lại khung trạng thái mới nhất, bỏ các khung trạng thái cũ hơn.
+        """
+        is_status = self.is_status
+        result = []
+        seen_status = False
+        skipped = 0
+        for item in reversed(batch):
+            if is_status(item):
+                if seen_status:
+                    skipped += 1
+                    continue
+                seen_status = True
+            result.append(item)
+        if skipped:
+            self.coalesced += skipped
+        result.reverse()
+        return result
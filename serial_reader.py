@@ -0,0 +1,425 @@
+import os
+import selectors
+import threading
+from time import perf_counter
+
+from protocol import FRAME_SIZE, FRAME_SYNC, decode_status_frame
+
+FRAME_SYNC_BYTE = bytes((FRAME_SYNC,))
+
+
+def port_fileno(ser):
+    """
+    Trả về file descriptor của cổng Serial nếu có thể dùng với selector (chỉ POSIX), ngược lại None.
+    """
+    if os.name != "posix":
+        return None
+    try:
+        fd = ser.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return fd if fd is not None and fd >= 0 else None
+
+
+class LineSplitter:
+    """
+    Tách các dòng hoàn chỉnh từ luồng byte nhận được qua Serial.
+    Dùng một bytearray tái sử dụng làm bộ đệm; phần dòng chưa kết thúc được giữ lại cho lần sau.
+    Ở đầu mỗi dòng, nếu gặp byte đồng bộ 0xA5 thì đó là khung trạng thái nhị phân (protocol.py):
+    khung được giải mã thẳng từ bộ đệm thành StatusFrame, không qua chuỗi trung gian.
+    """
+    def __init__(self, max_line=4096):
+        """
+        Args:
+            max_line (int): Độ dài tối đa (byte) của một dòng chưa kết thúc trước khi bị bỏ.
+        """
+        self.max_line = max_line
+        self.buffer = bytearray()
+        self.last_seq = None # Số thứ tự của khung nhị phân gần nhất
+        self.frames_received = 0 # Số khung nhị phân hợp lệ
+        self.frames_lost = 0 # Số khung nhị phân bị mất (phát hiện qua số thứ tự)
+        self.bad_frames = 0 # Số khung nhị phân sai CRC hoặc sai mã màu
+
+    def feed(self, data):
+        """
+        Nạp thêm dữ liệu và trả về các mục hoàn chỉnh.
+
+        Args:
+            data (bytes): Dữ liệu vừa đọc được.
+
+        Returns:
+            list: Các dòng đã giải mã UTF-8 (bỏ qua lỗi), đã loại bỏ khoảng trắng, không rỗng,
+                và các StatusFrame giải mã từ khung nhị phân, theo đúng thứ tự nhận.
+        """
+        buf = self.buffer
+        buf += data
+        items = []
+        start = 0
+        size = len(buf)
+        view = None
+        while start < size:
+            if buf[start] == FRAME_SYNC: # Khung nhị phân ở đầu dòng
+                if size - start < FRAME_SIZE:
+                    break # Chưa nhận đủ khung, chờ lần sau
+                if view is None:
+                    view = memoryview(buf)
+                frame = decode_status_frame(view, start)
+                if frame is not None:
+                    self._track_sequence(frame.seq)
+                    items.append(frame)
+                    start += FRAME_SIZE
+                    continue
+                # Khung hỏng: bỏ tới byte đồng bộ tiếp theo nếu nó đến trước ký tự xuống dòng
+                next_sync = buf.find(FRAME_SYNC_BYTE, start + 1)
+                end = buf.find(b"\n", start + 1)
+                if next_sync >= 0 and (end < 0 or next_sync < end):
+                    self.bad_frames += 1
+                    start = next_sync
+                    continue
+                if end < 0:
+                    break
+                self.bad_frames += 1
+            else:
+                end = buf.find(b"\n", start)
+                if end < 0:
+                    break
+            line = buf[start:end].decode("utf-8", errors="ignore").strip()
+            if line:
+                items.append(line)
+            start = end + 1
+        if view is not None:
+            view.release() # Phải giải phóng trước khi thay đổi kích thước bộ đệm
+        if start:
+            del buf[:start] # Xóa phần đã xử lý một lần duy nhất
+        if len(buf) > self.max_line: # Dòng quá dài không có ký tự xuống dòng: coi là rác
+            buf.clear()
+        return items
+
+    def _track_sequence(self, seq):
+        """
+        Đếm khung hợp lệ và khung bị mất dựa trên số thứ tự quay vòng 8 bit.
+        """
+        if self.last_seq is not None:
+            self.frames_lost += (seq - self.last_seq - 1) & 0xFF
+        self.last_seq = seq
+        self.frames_received += 1
+
+
+class SerialLineReader:
+    """
+    Luồng đọc Serial hướng sự kiện, thay cho vòng lặp kiểm tra in_waiting + sleep.
+    Luồng chỉ thức dậy khi có dữ liệu: hoặc chặn (block) trên read() của cổng,
+    hoặc chờ trên selector với file descriptor của cổng (chỉ POSIX).
+    Mỗi lần đọc lấy hết số byte đang có, tách dòng rồi chuyển cho hàm xử lý.
+    """
+    def __init__(self, ser, on_line, on_error=None, mode="auto", metrics=None):
+        """
+        Args:
+            ser (serial.Serial): Kết nối Serial đã mở.
+            on_line (callable): Hàm được gọi (trên luồng đọc) cho mỗi dòng hoàn chỉnh.
+            on_error (callable): Hàm được gọi với ngoại lệ khi đọc lỗi; luồng sẽ dừng sau đó.
+            mode (str): "blocking", "selector" hoặc "auto" (selector nếu cổng có fileno()).
+            metrics (PipelineMetrics): Bộ đo của đường xử lý (None: không đo).
+        """
+        self.ser = ser
+        self.on_line = on_line
+        self.on_error = on_error
+        self.metrics = metrics
+        self.mode = self._resolve_mode(mode)
+        self.splitter = LineSplitter()
+        self._stop_event = threading.Event()
+        self._wakeup_r = self._wakeup_w = None # Ống (pipe) để đánh thức selector khi dừng
+        self._thread = threading.Thread(target=self._run, name="serial-reader", daemon=True)
+
+    def _resolve_mode(self, mode):
+        """
+        Chọn chế độ đọc thực tế: selector chỉ dùng được trên POSIX khi cổng có fileno().
+        """
+        if mode == "blocking":
+            return mode
+        has_fd = port_fileno(self.ser) is not None
+        if mode == "selector" and not has_fd:
+            raise ValueError("Chế độ selector cần cổng Serial có fileno() (chỉ POSIX)")
+        return "selector" if has_fd else "blocking"
+
+    def start(self):
+        """
+        Bắt đầu luồng đọc.
+        """
+        if self.mode == "selector":
+            self._wakeup_r, self._wakeup_w = os.pipe()
+        self._thread.start()
+
+    def stop(self):
+        """
+        Gửi tín hiệu dừng và đánh thức luồng đọc nếu nó đang chờ dữ liệu.
+        """
+        self._stop_event.set()
+        if self._wakeup_w is not None:
+            try:
+                os.write(self._wakeup_w, b"\0")
+            except OSError:
+                pass
+        elif hasattr(self.ser, "cancel_read"):
+            try:
+                self.ser.cancel_read() # Hủy read() đang chặn
+            except Exception:
+                pass
+
+    def join(self, timeout=None):
+        """
+        Chờ luồng đọc kết thúc và giải phóng tài nguyên.
+
+        Returns:
+            bool: True nếu luồng đã dừng.
+        """
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        stopped = not self._thread.is_alive()
+        if stopped:
+            for fd in (self._wakeup_r, self._wakeup_w):
+                if fd is not None:
+                    os.close(fd)
+            self._wakeup_r = self._wakeup_w = None
+        return stopped
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def _dispatch(self, data):
+        """
+        Tách dòng từ dữ liệu vừa đọc và chuyển từng dòng cho hàm xử lý.
+        """
+        if data:
+            metrics = self.metrics
+            if metrics:
+                start = perf_counter()
+            on_line = self.on_line
+            lines = self.splitter.feed(data)
+            for line in lines:
+                on_line(line)
+            if metrics:
+                metrics.read_seconds.observe(perf_counter() - start)
+                metrics.read_bytes.inc(len(data))
+                metrics.read_lines.inc(len(lines))
+
+    def _run(self):
+        try:
+            if self.mode == "selector":
+                self._run_selector()
+            else:
+                self._run_blocking()
+        except Exception as e:
+            if not self._stop_event.is_set() and self.on_error:
+                self.on_error(e)
+
+    def _run_blocking(self):
+        """
+        Chặn trên read(): đọc ít nhất 1 byte (chờ tới khi có dữ liệu hoặc hết timeout của cổng),
+        sau đó lấy luôn toàn bộ byte đang có trong bộ đệm nhận.
+        """
+        ser = self.ser
+        stop_event = self._stop_event
+        while not stop_event.is_set():
+            self._dispatch(ser.read(ser.in_waiting or 1))
+
+    def _run_selector(self):
+        """
+        Chờ trên selector với file descriptor của cổng và ống đánh thức.
+        """
+        ser = self.ser
+        stop_event = self._stop_event
+        with selectors.DefaultSelector() as selector:
+            selector.register(ser.fileno(), selectors.EVENT_READ)
+            selector.register(self._wakeup_r, selectors.EVENT_READ)
+            while not stop_event.is_set():
+                events = selector.select()
+                if stop_event.is_set():
+                    break
+                if events:
+                    self._dispatch(ser.read(ser.in_waiting or 1))
+
+
+class MultiSerialReader:
+    """
+    Một luồng duy nhất đọc nhiều cổng Serial cùng lúc (dùng cho supervisor nhiều ngã tư).
+    Trên POSIX, mọi cổng được đăng ký vào một selector; nếu có cổng không hỗ trợ fileno()
+    (ví dụ cổng COM trên Windows), luồng chuyển sang quét lần lượt các cổng có dữ liệu.
+    Mỗi cổng có bộ tách dòng và hàm xử lý riêng, được nhận diện bằng một khóa (key).
+    """
+    def __init__(self, on_error=None, poll_interval=0.01):
+        """
+        Args:
+            on_error (callable): Hàm on_error(key, error) khi đọc một cổng lỗi hoặc hàm xử lý
+                của cổng đó ném ngoại lệ; cổng đó bị gỡ khỏi luồng.
+            poll_interval (float): Thời gian chờ (giây) giữa các lần quét ở chế độ quét.
+        """
+        self.on_error = on_error
+        self.poll_interval = poll_interval
+        self.ports = {} # key -> (ser, splitter, on_line)
+        self._fds = {} # key -> file descriptor đã đăng ký với selector
+        self._pending = [] # Các thay đổi (thêm/gỡ cổng) chờ luồng đọc áp dụng
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._wakeup_r = self._wakeup_w = None
+        self.mode = None # "selector" hoặc "polling", được chọn khi start()
+        self._thread = threading.Thread(target=self._run, name="multi-serial-reader", daemon=True)
+
+    def add(self, key, ser, on_line):
+        """
+        Thêm một cổng đã mở vào luồng đọc (có thể gọi trước hoặc sau start(), từ luồng bất kỳ).
+        Thêm lại cùng khóa (ví dụ sau khi mở lại cổng bị lỗi) thay cổng cũ, với bộ tách dòng mới.
+
+        Args:
+            key: Khóa nhận diện cổng (ví dụ tên ngã tư).
+            ser (serial.Serial): Kết nối Serial đã mở.
+            on_line (callable): Hàm được gọi (trên luồng đọc) cho mỗi dòng của cổng này.
+        """
+        with self._lock:
+            self._pending.append((key, (ser, LineSplitter(), on_line)))
+        self._wakeup()
+
+    def remove(self, key):
+        """
+        Gỡ một cổng khỏi luồng đọc (không đóng cổng; không làm gì nếu cổng đã bị gỡ do lỗi).
+        """
+        with self._lock:
+            self._pending.append((key, None))
+        self._wakeup()
+
+    def start(self, mode="auto"):
+        """
+        Bắt đầu luồng đọc.
+
+        Args:
+            mode (str): "selector", "polling" hoặc "auto" (selector nếu mọi cổng đã thêm có fileno()).
+        """
+        if mode == "auto":
+            with self._lock:
+                sers = [entry[0] for _, entry in self._pending if entry]
+            usable = os.name == "posix" and all(port_fileno(ser) is not None for ser in sers)
+            mode = "selector" if usable else "polling"
+        self.mode = mode
+        if mode == "selector":
+            self._wakeup_r, self._wakeup_w = os.pipe()
+        self._thread.start()
+
+    def stop(self):
+        """
+        Gửi tín hiệu dừng và đánh thức luồng đọc.
+        """
+        self._stop_event.set()
+        self._wakeup()
+
+    def join(self, timeout=None):
+        """
+        Chờ luồng đọc kết thúc và giải phóng tài nguyên.
+
+        Returns:
+            bool: True nếu luồng đã dừng.
+        """
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        stopped = not self._thread.is_alive()
+        if stopped:
+            for fd in (self._wakeup_r, self._wakeup_w):
+                if fd is not None:
+                    os.close(fd)
+            self._wakeup_r = self._wakeup_w = None
+        return stopped
+
+    def _wakeup(self):
+        if self._wakeup_w is not None:
+            try:
+                os.write(self._wakeup_w, b"\0")
+            except OSError:
+                pass
+
+    def _apply_pending(self, selector=None):
+        """
+        Áp dụng các thay đổi thêm/gỡ cổng trên chính luồng đọc.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for key, entry in pending:
+            self.ports.pop(key, None)
+            fd = self._fds.pop(key, None)
+            if fd is not None:
+                try:
+                    selector.unregister(fd)
+                except (KeyError, ValueError, OSError):
+                    pass
+            if entry:
+                if selector:
+                    fd = port_fileno(entry[0])
+                    if fd is None: # Cổng thêm sau không dùng được với selector
+                        if self.on_error:
+                            self.on_error(key, ValueError("Cổng không có fileno() để dùng với selector"))
+                        continue
+                    selector.register(fd, selectors.EVENT_READ, key)
+                    self._fds[key] = fd
+                self.ports[key] = entry
+
+    def _read_port(self, key):
+        """
+        Đọc toàn bộ byte đang có của một cổng và chuyển các dòng hoàn chỉnh cho hàm xử lý.
+        Lỗi đọc hoặc lỗi trong hàm xử lý của cổng chỉ gỡ cổng đó, luồng đọc chung vẫn chạy cho các cổng khác.
+        """
+        ser, splitter, on_line = self.ports[key]
+        try:
+            data = ser.read(ser.in_waiting or 1)
+            for line in splitter.feed(data):
+                on_line(line)
+        except Exception as e:
+            self.ports.pop(key, None)
+            if self.on_error:
+                self.on_error(key, e)
+            return False
+        return bool(data)
+
+    def _run(self):
+        if self.mode == "selector":
+            self._run_selector()
+        else:
+            self._run_polling()
+
+    def _run_selector(self):
+        stop_event = self._stop_event
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+            self._apply_pending(selector)
+            while not stop_event.is_set():
+                for selector_key, _ in selector.select():
+                    key = selector_key.data
+                    if key is None: # Ống đánh thức: có thay đổi cổng hoặc yêu cầu dừng
+                        os.read(self._wakeup_r, 512)
+                        self._apply_pending(selector)
+                    elif key in self.ports:
+                        self._read_port(key)
+                        if key in self.ports:
+                            continue
+                        # Cổng lỗi đã bị gỡ trong _read_port(): hủy đăng ký khỏi selector
+                        self._fds.pop(key, None)
+                        try:
+                            selector.unregister(selector_key.fd)
+                        except (KeyError, ValueError):
+                            pass
+
+    def _run_polling(self):
+        stop_event = self._stop_event
+        while not stop_event.is_set():
+            self._apply_pending()
+            busy = False
+            for key in list(self.ports):
+                ser = self.ports[key][0]
+                try:
+                    waiting = ser.in_waiting
+                except Exception as e:
+                    self.ports.pop(key, None)
+                    if self.on_error:
+                        self.on_error(key, e)
+                    continue
+                if waiting:
+                    busy = self._read_port(key) or busy
+            if not busy:
+                stop_event.wait(self.poll_interval)
@@ -0,0 +1,584 @@
+import argparse
+import os
+import random
+import selectors
+import sys
+import time
+
+import protocol
+
+# Hằng số giống firmware trafficlight.ino
+DEFAULT_GREEN_DURATION_MS = 5000
+YELLOW_DURATION_MS = 2000
+SERIAL_UPDATE_INTERVAL = 200
+MIN_SERIAL_UPDATE_INTERVAL = 20
+SPARSE_SYNC_INTERVAL = 5000
+MIN_SPARSE_SYNC_INTERVAL = 1000
+DEBOUNCE_DELAY = 200
+ULONG_MASK = 0xFFFFFFFF # unsigned long 32 bit của ESP32
+
+
+class FirmwareModel:
+    """
+    Mô hình phần mềm của firmware trafficlight.ino (không cần phần cứng):
+    chu kỳ xanh/vàng/đỏ, lệnh SET/E1/E2/E3/NORMAL/PROTO, pha vàng chuyển tiếp trước khẩn cấp
+    và khung trạng thái "S,...", khung nhị phân hoặc khung thưa. Thời gian là tham số (mili giây),
+    nên mô hình chạy được theo đồng hồ thật (simulator) hoặc đồng hồ giả lập (kiểm thử, đo hiệu năng).
+    """
+    def __init__(self, now_ms=0, status_interval_ms=SERIAL_UPDATE_INTERVAL):
+        """
+        Args:
+            now_ms (int): Thời điểm khởi động (tương đương millis() trong setup()).
+            status_interval_ms (int): Chu kỳ gửi trạng thái mặc định (firmware: 200 ms).
+        """
+        self.default_interval = status_interval_ms
+        self.min_interval = min(MIN_SERIAL_UPDATE_INTERVAL, status_interval_ms)
+        self.serial_update_interval = status_interval_ms
+        self.green_ms = DEFAULT_GREEN_DURATION_MS
+        self.red_ms = self.green_ms + YELLOW_DURATION_MS
+        self.cycle_ms = self.green_ms + YELLOW_DURATION_MS + self.red_ms
+        self.cycle_start = now_ms
+        self.emergency_mode = 0
+        self.pending_mode = 0
+        self.yellow_phase = False
+        self.yellow_start = 0
+        self.last_interrupt = None
+        self.last_serial_update = now_ms
+        self.binary_frames = False
+        self.frame_seq = 0
+        # Khung thưa ("PROTO,SPARSE"): chỉ gửi khi đổi màu/chế độ khẩn cấp, sau lệnh và theo chu kỳ đồng bộ
+        self.sparse_frames = False
+        self.sparse_sync_interval = SPARSE_SYNC_INTERVAL
+        self.force_status = False
+        self.last_sent = None # (màu M1, màu M2, chế độ khẩn cấp) của khung thưa gần nhất
+        # Màu đèn đang bật của từng mạch (tương đương digitalRead() các chân đèn)
+        self.m1_lamp = None
+        self.m2_lamp = None
+
+    # ---- Lệnh từ Serial ----
+
+    def handle_command(self, command, now_ms):
+        """
+        Xử lý một lệnh (đã bỏ ký tự xuống dòng) như nhánh Serial.available() trong loop().
+
+        Returns:
+            list: Các dòng phản hồi (str).
+        """
+        command = command.strip()
+        out = []
+        if command == "E1":
+            self.toggle_emergency(1, now_ms, out)
+        elif command == "E2":
+            self.toggle_emergency(2, now_ms, out)
+        elif command == "E3":
+            self.toggle_emergency(3, now_ms, out)
+        elif command == "NORMAL":
+            self.emergency_mode = 0
+            self.yellow_phase = False
+            self.cycle_start = now_ms
+            out.append(">>> TẮT KHẨN CẤP - QUAY LẠI BÌNH THƯỜNG <<<")
+        elif command.startswith("PROTO,BIN"):
+            self.binary_frames = True
+            self.sparse_frames = False
+            self.serial_update_interval = self.default_interval
+            parts = command.split(",", 2)
+            if len(parts) == 3:
+                self.serial_update_interval = max(arduino_to_int(parts[2]), self.min_interval)
+            out.append(f"PROTO_OK,BIN,{self.serial_update_interval}")
+        elif command.startswith("PROTO,SPARSE"):
+            self.sparse_frames = True
+            self.binary_frames = False
+            self.sparse_sync_interval = SPARSE_SYNC_INTERVAL
+            parts = command.split(",", 2)
+            if len(parts) == 3:
+                self.sparse_sync_interval = max(arduino_to_int(parts[2]), MIN_SPARSE_SYNC_INTERVAL)
+            out.append(f"PROTO_OK,SPARSE,{self.sparse_sync_interval}")
+        elif command == "PROTO,TEXT":
+            self.binary_frames = False
+            self.sparse_frames = False
+            self.serial_update_interval = self.default_interval
+            out.append(f"PROTO_OK,TEXT,{self.serial_update_interval}")
+        elif command.startswith("SET,"):
+            self.handle_set(command, now_ms, out)
+        self.force_status = True # Như firmware: mọi lệnh làm khung thưa kế tiếp được gửi ngay
+        return out
+
+    def handle_set(self, command, now_ms, out):
+        parts = command.split(",", 2)
+        color_type = parts[1]
+        seconds = arduino_to_int(parts[2]) if len(parts) == 3 else 0
+        new_duration = (seconds * 1000) & ULONG_MASK
+        if color_type == "GREEN":
+            self.green_ms = new_duration
+            self.red_ms = (self.green_ms + YELLOW_DURATION_MS) & ULONG_MASK
+            out.append(f"SET_UPDATED,GREEN,{self.green_ms // 1000},{self.red_ms // 1000}")
+        elif color_type == "RED":
+            self.red_ms = new_duration
+            # Giống firmware: so sánh trước khi trừ để phép trừ unsigned long không tràn khi đỏ < 2s
+            self.green_ms = self.red_ms - YELLOW_DURATION_MS if self.red_ms >= YELLOW_DURATION_MS else 0
+            if self.green_ms < 1000:
+                self.green_ms = 1000
+                self.red_ms = self.green_ms + YELLOW_DURATION_MS
+                out.append(">>> Cảnh báo: Thời gian đỏ quá ngắn. Đèn xanh tối thiểu 1s. Đã điều chỉnh. <<<")
+            out.append(f"SET_UPDATED,RED,{self.red_ms // 1000},{self.green_ms // 1000}")
+        else:
+            out.append("SET_ERROR: Màu không hợp lệ (chỉ GREEN/RED)")
+        self.cycle_ms = (self.green_ms + YELLOW_DURATION_MS + self.red_ms) & ULONG_MASK
+        self.cycle_start = now_ms
+
+    def toggle_emergency(self, mode, now_ms, out):
+        """
+        Tương đương toggleEmergency1/2/3() (nút nhấn hoặc lệnh E1/E2/E3), có chống dội 200 ms.
+        """
+        if self.last_interrupt is not None and now_ms - self.last_interrupt <= DEBOUNCE_DELAY:
+            return
+        if self.emergency_mode == mode: # Đang ở chế độ này: tắt
+            self.emergency_mode = 0
+            if mode == 1: # Đồng bộ lại chu kỳ để Mạch 1 xanh ngay
+                self.cycle_start = now_ms - self.red_ms
+                out.append(">>> TẮT KHẨN CẤP - MẠCH 1 TIẾP TỤC BÌNH THƯỜNG <<<")
+            elif mode == 2:
+                self.cycle_start = now_ms
+                out.append(">>> TẮT KHẨN CẤP - MẠCH 2 TIẾP TỤC BÌNH THƯỜNG <<<")
+            else:
+                self.cycle_start = now_ms
+                out.append(">>> TẮT KHẨN CẤP - QUAY LẠI BÌNH THƯỜNG <<<")
+        else:
+            if mode == 1:
+                busy = self.m2_lamp in ("GREEN", "YELLOW")
+                notice = ">>> Mạch 2 đang xanh/vàng – chuyển vàng 2s rồi KHẨN CẤP mạch 1 <<<"
+            elif mode == 2:
+                busy = self.m1_lamp in ("GREEN", "YELLOW")
+                notice = ">>> Mạch 1 đang xanh/vàng – chuyển vàng 2s rồi KHẨN CẤP mạch 2 <<<"
+            else:
+                busy = self.m1_lamp in ("GREEN", "YELLOW") or self.m2_lamp in ("GREEN", "YELLOW")
+                notice = ">>> Có đèn xanh/vàng – chuyển vàng 2s rồi KHẨN CẤP: CẢ HAI ĐỎ <<<"
+            if busy:
+                self.pending_mode = mode
+                self.yellow_phase = True
+                self.yellow_start = now_ms
+                out.append(notice)
+            else:
+                self.emergency_mode = mode
+                if mode == 3:
+                    self.m1_lamp = self.m2_lamp = "RED"
+                out.append(EMERGENCY_NOTICES[mode])
+        self.last_interrupt = now_ms
+
+    # ---- Vòng lặp chính ----
+
+    def tick(self, now_ms):
+        """
+        Một lần chạy loop() (không tính phần đọc lệnh): gửi trạng thái theo chu kỳ,
+        kết thúc pha vàng chuyển tiếp và cập nhật đèn.
+
+        Returns:
+            list: Các mục gửi đi: str (một dòng) hoặc bytes (khung nhị phân).
+        """
+        out = []
+        if self.sparse_frames:
+            frame = self.sparse_output(now_ms)
+            if frame:
+                out.append(frame)
+        elif now_ms - self.last_serial_update >= self.serial_update_interval:
+            out.append(self.status_output(now_ms))
+            self.last_serial_update = now_ms
+
+        if self.yellow_phase:
+            if now_ms - self.yellow_start >= YELLOW_DURATION_MS:
+                self.emergency_mode = self.pending_mode
+                self.yellow_phase = False
+                if self.pending_mode == 3:
+                    self.m1_lamp = self.m2_lamp = "RED"
+                out.append(EMERGENCY_NOTICES[self.pending_mode])
+            else:
+                if self.pending_mode == 1:
+                    self.m1_lamp, self.m2_lamp = "RED", "YELLOW"
+                elif self.pending_mode == 2:
+                    self.m1_lamp, self.m2_lamp = "YELLOW", "RED"
+                else: # Đèn đang xanh hoặc vàng giữ vàng suốt pha chuyển tiếp
+                    self.m1_lamp = "YELLOW" if self.m1_lamp in ("GREEN", "YELLOW") else "RED"
+                    self.m2_lamp = "YELLOW" if self.m2_lamp in ("GREEN", "YELLOW") else "RED"
+                return out
+
+        if self.emergency_mode:
+            self.m1_lamp, self.m2_lamp = EMERGENCY_LAMPS[self.emergency_mode]
+            return out
+        self.m1_lamp, _, self.m2_lamp, _ = self.normal_status(now_ms)
+        return out
+
+    def normal_status(self, now_ms):
+        """
+        Màu và thời gian còn lại (mili giây) của chu kỳ bình thường tại thời điểm now_ms.
+        """
+        cycle_time = (now_ms - self.cycle_start) % self.cycle_ms
+        if cycle_time < self.red_ms: # Pha 1: Mạch 1 đỏ, Mạch 2 xanh rồi vàng
+            m1_ms = self.red_ms - cycle_time
+            if cycle_time < self.green_ms:
+                return "RED", m1_ms, "GREEN", self.green_ms - cycle_time
+            return "RED", m1_ms, "YELLOW", self.red_ms - cycle_time
+        phase2_time = cycle_time - self.red_ms # Pha 2: Mạch 1 xanh rồi vàng, Mạch 2 đỏ
+        m2_ms = self.cycle_ms - cycle_time
+        if phase2_time < self.green_ms:
+            return "GREEN", self.green_ms - phase2_time, "RED", m2_ms
+        return "YELLOW", self.cycle_ms - cycle_time, "RED", m2_ms
+
+    def status_ms(self, now_ms):
+        """
+        Trạng thái hiện tại như computeStatus(): (màu M1, ms còn lại M1, màu M2, ms còn lại M2).
+        """
+        if self.yellow_phase:
+            left = max(YELLOW_DURATION_MS - (now_ms - self.yellow_start), 0)
+            if self.pending_mode == 1:
+                return "RED", left, "YELLOW", left
+            if self.pending_mode == 2:
+                return "YELLOW", left, "RED", left
+            return ("YELLOW" if self.m1_lamp in ("GREEN", "YELLOW") else "RED", left,
+                    "YELLOW" if self.m2_lamp in ("GREEN", "YELLOW") else "RED", left)
+        if self.emergency_mode:
+            m1_color, m2_color = EMERGENCY_LAMPS[self.emergency_mode]
+            return m1_color, 0, m2_color, 0
+        return self.normal_status(now_ms)
+
+    def status(self, now_ms):
+        """
+        Trạng thái hiện tại như sendSerialStatus(): (màu M1, giây M1, màu M2, giây M2).
+        """
+        m1_color, m1_ms, m2_color, m2_ms = self.status_ms(now_ms)
+        return m1_color, m1_ms // 1000, m2_color, m2_ms // 1000
+
+    def sparse_output(self, now_ms):
+        """
+        Khung thưa như sendSparseStatus(): "S,<màu>,<giây>,<màu>,<giây>,<ms>,<ms>" khi đổi màu,
+        đổi chế độ khẩn cấp, sau một lệnh hoặc tới chu kỳ đồng bộ; None nếu chưa cần gửi.
+        """
+        m1_color, m1_ms, m2_color, m2_ms = self.status_ms(now_ms)
+        key = (m1_color, m2_color, self.emergency_mode)
+        if (not self.force_status and key == self.last_sent
+                and now_ms - self.last_serial_update < self.sparse_sync_interval):
+            return None
+        self.force_status = False
+        self.last_sent = key
+        self.last_serial_update = now_ms
+        return f"S,{m1_color},{m1_ms // 1000},{m2_color},{m2_ms // 1000},{m1_ms},{m2_ms}"
+
+    def next_status_due(self, now_ms):
+        """
+        Thời điểm (ms) cần chạy tick() tiếp theo để gửi khung trạng thái đúng hạn:
+        theo chu kỳ gửi, hoặc ở chế độ khung thưa là lần chuyển pha hay khung đồng bộ gần nhất.
+        """
+        if not self.sparse_frames:
+            return self.last_serial_update + self.serial_update_interval
+        if self.force_status:
+            return now_ms
+        due = self.last_serial_update + self.sparse_sync_interval
+        _, m1_ms, _, m2_ms = self.status_ms(now_ms)
+        for left in (m1_ms, m2_ms):
+            if left:
+                due = min(due, now_ms + left)
+        return due
+
+    def status_output(self, now_ms):
+        """
+        Khung trạng thái sẽ gửi: dòng "S,..." hoặc khung nhị phân 8 byte (sau "PROTO,BIN").
+        """
+        m1_color, m1_time, m2_color, m2_time = self.status(now_ms)
+        if self.binary_frames:
+            frame = protocol.encode_status_frame(self.frame_seq, m1_color, m1_time, m2_color, m2_time,
+                                                 self.emergency_mode, self.yellow_phase)
+            self.frame_seq = (self.frame_seq + 1) & 0xFF
+            return frame
+        return f"S,{m1_color},{m1_time},{m2_color},{m2_time}"
+
+
+EMERGENCY_NOTICES = {
+    1: ">>> KHẨN CẤP: MẠCH 1 XANH <<<",
+    2: ">>> KHẨN CẤP: MẠCH 2 XANH <<<",
+    3: ">>> KHẨN CẤP: CẢ HAI ĐỎ <<<",
+}
+EMERGENCY_LAMPS = {1: ("GREEN", "RED"), 2: ("RED", "GREEN"), 3: ("RED", "RED")}
+
+
+def arduino_to_int(text):
+    """
+    Giống String.toInt() của Arduino: đọc số nguyên ở đầu chuỗi, trả về 0 nếu không có.
+    """
+    text = text.strip()
+    end = 1 if text[:1] in ("-", "+") else 0
+    while end < len(text) and text[end].isdigit():
+        end += 1
+    try:
+        return int(text[:end])
+    except ValueError:
+        return 0
+
+
+def encode_output(item):
+    """
+    Chuyển một mục đầu ra của FirmwareModel thành byte gửi qua Serial.
+    """
+    if item.__class__ is bytes:
+        return item
+    return (item + "\r\n").encode() # Serial.println() kết thúc bằng CRLF
+
+
+class FaultInjector:
+    """
+    Tiêm lỗi vào luồng dữ liệu gửi đi: dòng bị hỏng, loạt dữ liệu dồn dập, ngắt kết nối.
+    """
+    def __init__(self, garble=0.0, burst_size=0, burst_every=0.0, disconnect_every=0.0,
+                 disconnect_for=2.0, seed=None):
+        """
+        Args:
+            garble (float): Xác suất một dòng/khung bị làm hỏng (0..1).
+            burst_size (int): Số khung trạng thái gửi dồn trong một loạt.
+            burst_every (float): Chu kỳ (giây) giữa các loạt, 0 để tắt.
+            disconnect_every (float): Chu kỳ (giây) giữa các lần ngắt kết nối, 0 để tắt.
+            disconnect_for (float): Thời gian (giây) mỗi lần ngắt kết nối.
+            seed (int): Hạt giống ngẫu nhiên (None: ngẫu nhiên).
+        """
+        self.garble = garble
+        self.burst_size = burst_size
+        self.burst_every = burst_every
+        self.disconnect_every = disconnect_every
+        self.disconnect_for = disconnect_for
+        self.random = random.Random(seed)
+        self.garbled = 0
+        self.bursts = 0
+        self.disconnects = 0
+
+    def corrupt(self, data):
+        """
+        Làm hỏng ngẫu nhiên một đoạn dữ liệu (theo xác suất garble).
+        """
+        if not self.garble or self.random.random() >= self.garble:
+            return data
+        self.garbled += 1
+        rnd = self.random
+        kind = rnd.randrange(4)
+        if kind == 0: # Cắt cụt, mất ký tự xuống dòng (dính vào dòng sau)
+            return data[:rnd.randrange(len(data))]
+        if kind == 1: # Lật một byte
+            index = rnd.randrange(len(data))
+            return data[:index] + bytes((data[index] ^ (1 << rnd.randrange(8)),)) + data[index + 1:]
+        if kind == 2: # Chèn byte rác
+            return bytes(rnd.randrange(256) for _ in range(rnd.randint(1, 8))) + data
+        return data[:len(data) // 2] + b"\r\n" + data[len(data) // 2:] # Tách đôi dòng
+
+
+class VirtualEsp32:
+    """
+    Một ESP32 ảo gắn với một cặp pty: ứng dụng mở đầu slave như cổng Serial thật
+    (nên dùng đường dẫn liên kết cố định để tự kết nối lại sau khi bị ngắt).
+    Chỉ hỗ trợ hệ điều hành có pty (Linux, macOS).
+    """
+    def __init__(self, index, link=None, status_interval_ms=SERIAL_UPDATE_INTERVAL, faults=None):
+        self.index = index
+        self.link = link
+        self.status_interval_ms = status_interval_ms
+        self.faults = faults or FaultInjector()
+        self.master = None
+        self.slave = None
+        self.slave_path = None
+        self.model = None
+        self.generation = 0 # Tăng mỗi lần mở pty mới (số fd có thể được dùng lại)
+        self.input = bytearray()
+        self.reconnect_at = None
+        self.next_burst = None
+        self.next_disconnect = None
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.overflows = 0 # Lần ghi bị bỏ vì phía ứng dụng không đọc kịp (bộ đệm pty đầy)
+        self.commands = 0
+
+    @property
+    def connected(self):
+        return self.master is not None
+
+    def open(self, now):
+        """
+        Tạo cặp pty mới, trỏ đường dẫn liên kết tới nó và khởi động lại firmware ảo.
+        """
+        import pty
+        import tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave) # Không dội lại và không đổi "\n" thành "\r\n"
+        os.set_blocking(self.master, False)
+        self.slave_path = os.ttyname(self.slave)
+        if self.link:
+            temporary = f"{self.link}.tmp"
+            if os.path.lexists(temporary):
+                os.remove(temporary)
+            os.symlink(self.slave_path, temporary)
+            os.replace(temporary, self.link)
+        self.model = FirmwareModel(int(now * 1000), self.status_interval_ms)
+        self.generation += 1
+        self.input.clear()
+        faults = self.faults
+        self.next_burst = now + faults.burst_every if faults.burst_every and faults.burst_size else None
+        self.next_disconnect = now + faults.disconnect_every if faults.disconnect_every else None
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def disconnect(self, now):
+        """
+        Giả lập rút cáp: đóng cả hai đầu pty, ứng dụng nhận lỗi khi đọc; mở lại sau disconnect_for giây.
+        """
+        self.close()
+        self.faults.disconnects += 1
+        self.reconnect_at = now + self.faults.disconnect_for
+
+    def read_commands(self, now_ms):
+        """
+        Đọc lệnh từ ứng dụng (không chặn) và xử lý từng dòng.
+        """
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        self.input += data
+        while True:
+            end = self.input.find(b"\n")
+            if end < 0:
+                break
+            line = self.input[:end].decode("utf-8", "replace")
+            del self.input[:end + 1]
+            self.commands += 1
+            self.send(self.model.handle_command(line, now_ms))
+
+    def send(self, items):
+        for item in items:
+            data = self.faults.corrupt(encode_output(item))
+            try:
+                os.write(self.master, data)
+            except BlockingIOError:
+                self.overflows += 1
+                continue
+            except OSError:
+                return
+            self.lines_sent += 1
+            self.bytes_sent += len(data)
+
+    def step(self, now):
+        """
+        Một vòng chạy: kết nối lại, tiêm lỗi theo lịch, chạy loop() của firmware.
+        """
+        if not self.connected:
+            if self.reconnect_at is not None and now >= self.reconnect_at:
+                self.reconnect_at = None
+                self.open(now)
+            return
+        now_ms = int(now * 1000)
+        if self.next_disconnect is not None and now >= self.next_disconnect:
+            self.disconnect(now)
+            return
+        if self.next_burst is not None and now >= self.next_burst:
+            self.next_burst = now + self.faults.burst_every
+            self.faults.bursts += 1
+            self.send([self.model.status_output(now_ms) for _ in range(self.faults.burst_size)])
+        self.send(self.model.tick(now_ms))
+
+
+def run_simulator(devices, duration=None, stats_interval=None, out=sys.stdout):
+    """
+    Chạy các ESP32 ảo trên một luồng: chờ lệnh từ mọi pty bằng selector, giữa các lần chờ
+    chạy loop() của từng firmware ảo.
+
+    Args:
+        devices (list): Các VirtualEsp32.
+        duration (float): Thời gian chạy (giây), None để chạy tới khi Ctrl+C.
+        stats_interval (float): Chu kỳ in thống kê (giây), None để tắt.
+    """
+    selector = selectors.DefaultSelector()
+    registered = {}
+    start = time.monotonic()
+    for device in devices:
+        device.open(start)
+        print(f"Ngã tư {device.index}: {device.link or device.slave_path} -> {device.slave_path}",
+              file=out, flush=True)
+    next_stats = start + stats_interval if stats_interval else None
+    try:
+        while duration is None or time.monotonic() - start < duration:
+            for device in devices: # Đăng ký lại đầu master khi pty được tạo mới sau ngắt kết nối
+                current = (device.master, device.generation) if device.connected else None
+                if registered.get(device) != current:
+                    if device in registered:
+                        try:
+                            selector.unregister(registered.pop(device)[0])
+                        except (KeyError, ValueError):
+                            pass
+                    if current is not None:
+                        selector.register(device.master, selectors.EVENT_READ, device)
+                        registered[device] = current
+            # Ngủ tới khi có lệnh hoặc tới hạn gửi khung trạng thái kế tiếp (tối đa 10 ms)
+            timeout = 0.01
+            for device in devices:
+                if device.connected:
+                    now = time.monotonic()
+                    due = device.model.next_status_due(int(now * 1000)) / 1000
+                    timeout = min(timeout, due - now)
+            timeout = max(timeout, 0)
+            ready = selector.select(timeout) if registered else time.sleep(timeout) or ()
+            now = time.monotonic()
+            now_ms = int(now * 1000)
+            for key, _ in ready:
+                if key.data.connected:
+                    key.data.read_commands(now_ms)
+            for device in devices:
+                device.step(now)
+            if next_stats is not None and now >= next_stats:
+                next_stats = now + stats_interval
+                print(format_stats(devices, now - start), file=out, flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        selector.close()
+        for device in devices:
+            device.close()
+    print(format_stats(devices, time.monotonic() - start), file=out, flush=True)
+
+
+def format_stats(devices, elapsed):
+    lines = sum(device.lines_sent for device in devices)
+    overflows = sum(device.overflows for device in devices)
+    commands = sum(device.commands for device in devices)
+    garbled = sum(device.faults.garbled for device in devices)
+    disconnects = sum(device.faults.disconnects for device in devices)
+    return (f"[{elapsed:7.1f}s] đã gửi {lines:,} dòng ({lines / max(elapsed, 1e-9):,.0f} dòng/s), "
+            f"tràn bộ đệm {overflows:,}, lệnh {commands:,}, hỏng {garbled:,}, ngắt kết nối {disconnects:,}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ESP32 ảo (firmware trafficlight.ino) qua pty để thử tải GUI")
+    parser.add_argument("--count", type=int, default=1, help="Số ngã tư (ESP32 ảo)")
+    parser.add_argument("--link", default="/tmp/esp32",
+                        help="Tiền tố đường dẫn liên kết cố định, ngã tư i dùng <link>-<i> (mặc định /tmp/esp32)")
+    parser.add_argument("--interval-ms", type=int, default=SERIAL_UPDATE_INTERVAL,
+                        help="Chu kỳ gửi trạng thái (ms); firmware thật: 200, 2 ms = gấp 100 lần")
+    parser.add_argument("--garble", type=float, default=0.0, help="Xác suất làm hỏng một dòng (0..1)")
+    parser.add_argument("--burst-size", type=int, default=0, help="Số khung gửi dồn mỗi loạt")
+    parser.add_argument("--burst-every", type=float, default=0.0, help="Chu kỳ (giây) giữa các loạt")
+    parser.add_argument("--disconnect-every", type=float, default=0.0, help="Chu kỳ (giây) giữa các lần ngắt")
+    parser.add_argument("--disconnect-for", type=float, default=2.0, help="Thời gian (giây) mỗi lần ngắt")
+    parser.add_argument("--duration", type=float, help="Thời gian chạy (giây), mặc định tới khi Ctrl+C")
+    parser.add_argument("--stats", type=float, default=5.0, help="Chu kỳ in thống kê (giây), 0 để tắt")
+    parser.add_argument("--seed", type=int, help="Hạt giống cho tiêm lỗi")
+    args = parser.parse_args(argv)
+
+    devices = []
+    for index in range(args.count):
+        seed = None if args.seed is None else args.seed + index
+        faults = FaultInjector(args.garble, args.burst_size, args.burst_every, args.disconnect_every,
+                               args.disconnect_for, seed)
+        link = f"{args.link}-{index}" if args.link else None
+        devices.append(VirtualEsp32(index, link, args.interval_ms, faults))
+    run_simulator(devices, args.duration, args.stats or None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
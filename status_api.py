@@ -0,0 +1,346 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import struct
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import engine
+from command_writer import validate_command
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_HEADER_BYTES = 16384
+MAX_BODY_BYTES = 4096
+MAX_MESSAGE_BYTES = 65536
+HIGH_WATER_BYTES = 256 * 1024 # Vượt mức này: bỏ qua delta, gửi lại ảnh chụp đầy đủ khi người xem đọc kịp
+
+# Ánh xạ sự kiện của bộ máy trạng thái -> các trường thay đổi trong trạng thái JSON
+EVENT_FIELDS = {
+    engine.LightsChanged: lambda e: {"m1_color": e.m1_color, "m1_secs": e.m1_secs,
+                                     "m2_color": e.m2_color, "m2_secs": e.m2_secs},
+    engine.StatusChanged: lambda e: {"status": e.status},
+    engine.EmergencyModeChanged: lambda e: {"emergency_mode": e.mode},
+    engine.ProtocolChanged: lambda e: {"protocol": e.mode},
+}
+
+
+def websocket_frame(payload, opcode=0x1):
+    """
+    Đóng gói một khung WebSocket từ máy chủ (không mask, FIN=1) theo RFC 6455.
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def read_websocket_frame(reader):
+    """
+    Đọc một khung WebSocket từ trình duyệt (bắt buộc có mask).
+
+    Returns:
+        tuple: (fin, opcode, payload).
+    """
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > MAX_MESSAGE_BYTES:
+        raise ValueError("Khung WebSocket quá lớn")
+    if not second & 0x80:
+        raise ValueError("Khung từ client phải có mask")
+    mask = await reader.readexactly(4)
+    data = bytearray(await reader.readexactly(length))
+    for index in range(length):
+        data[index] ^= mask[index & 3]
+    return bool(first & 0x80), first & 0x0F, bytes(data)
+
+
+class Viewer:
+    """
+    Một kết nối WebSocket đang theo dõi trạng thái.
+    """
+    def __init__(self, writer, can_command):
+        self.writer = writer
+        self.can_command = can_command
+        self.resync = False # Đã bỏ qua delta vì người xem đọc chậm: cần gửi lại ảnh chụp đầy đủ
+
+
+class StatusApi:
+    """
+    Máy chủ HTTP/WebSocket nhúng (asyncio, chạy trên luồng riêng) cho bảng điều khiển trên trình duyệt:
+        GET  /state    trạng thái hiện tại (JSON)
+        GET  /ws       WebSocket: ảnh chụp ban đầu rồi các thay đổi (delta)
+        GET  /metrics  số liệu hiệu năng dạng Prometheus (nếu có MetricsRegistry)
+        POST /command  gửi lệnh như send_command(), cần token (Authorization: Bearer <token>)
+
+    publish() chỉ chuyển sự kiện sang vòng lặp asyncio (O(1), không phụ thuộc số người xem).
+    Mỗi thay đổi được mã hóa JSON và đóng khung WebSocket đúng một lần rồi ghi cùng một chuỗi byte
+    cho mọi người xem, nên hàng trăm người xem không làm tăng tải của luồng đọc hay luồng Tkinter.
+    """
+    def __init__(self, host="127.0.0.1", port=8765, token=None, send_command=None, metrics=None):
+        """
+        Args:
+            host (str): Địa chỉ lắng nghe (mặc định chỉ máy cục bộ).
+            port (int): Cổng TCP.
+            token (str): Token cho phép gửi lệnh; None để tắt nhận lệnh.
+            send_command (callable): Hàm an toàn luồng nhận một lệnh đã kiểm tra, trả về False nếu bị từ chối.
+            metrics (MetricsRegistry): Nguồn cho /metrics (tùy chọn).
+        """
+        self.host = host
+        self.port = port
+        self.token = token
+        self.send_command = send_command
+        self.metrics = metrics
+        self.state = {"m1_color": None, "m1_secs": None, "m2_color": None, "m2_secs": None,
+                      "status": None, "emergency_mode": 0, "protocol": "TEXT", "connection": None,
+                      "alarms": [], "last_alarm": None, "updated_at": None}
+        self.seq = 0
+        self.viewers = set()
+        self.error = None # Lỗi khởi động (ví dụ cổng đã được dùng)
+        self.loop = None
+        self._server = None
+        self._stop = None # asyncio.Event, đặt khi dừng
+        self._clients = {} # Tác vụ xử lý -> writer của mọi kết nối đang mở
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="status-api", daemon=True)
+
+    # ---- Gọi từ các luồng khác ----
+
+    def start(self, timeout=5.0):
+        """
+        Khởi động luồng máy chủ và chờ tới khi đã lắng nghe.
+
+        Returns:
+            bool: False nếu không khởi động được (xem self.error).
+        """
+        self._thread.start()
+        self._started.wait(timeout)
+        return self.error is None and self._server is not None
+
+    def stop(self):
+        loop = self.loop
+        if loop and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._shutdown)
+            except RuntimeError: # Vòng lặp vừa đóng
+                pass
+
+    def join(self, timeout=None):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def publish(self, item):
+        """
+        Đưa một thay đổi sang vòng lặp asyncio (an toàn luồng).
+
+        Args:
+            item: Sự kiện của IntersectionState hoặc dict các trường thay đổi.
+        """
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._apply, item)
+            except RuntimeError:
+                pass
+
+    # ---- Chạy trên luồng asyncio ----
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._serve())
+        except OSError as e:
+            self.error = e
+        finally:
+            self._started.set()
+            self.loop.close()
+
+    async def _serve(self):
+        self._stop = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port,
+                                                  limit=MAX_HEADER_BYTES)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        async with self._server:
+            await self._stop.wait()
+        # Đóng mọi kết nối còn mở; các tác vụ xử lý tự kết thúc khi đọc gặp EOF
+        for writer in self._clients.values():
+            writer.close()
+        if self._clients:
+            await asyncio.wait(list(self._clients), timeout=2)
+
+    def _shutdown(self):
+        if self._stop:
+            self._stop.set()
+
+    def _apply(self, item):
+        fields = EVENT_FIELDS.get(type(item))
+        changes = fields(item) if fields else item if isinstance(item, dict) else None
+        if not changes:
+            return
+        changes = {key: value for key, value in changes.items() if self.state.get(key) != value}
+        if not changes:
+            return
+        self.seq += 1
+        changes["updated_at"] = time.time()
+        self.state.update(changes)
+        if not self.viewers:
+            return
+        # Mã hóa một lần, ghi cùng chuỗi byte cho mọi người xem
+        frame = websocket_frame(json.dumps({"type": "delta", "seq": self.seq, "changes": changes},
+                                           ensure_ascii=False).encode())
+        snapshot = None
+        for viewer in list(self.viewers):
+            transport = viewer.writer.transport
+            if transport.is_closing():
+                self.viewers.discard(viewer)
+                continue
+            if transport.get_write_buffer_size() > HIGH_WATER_BYTES:
+                viewer.resync = True
+                continue
+            if viewer.resync:
+                if snapshot is None:
+                    snapshot = self._snapshot_frame()
+                viewer.resync = False
+                viewer.writer.write(snapshot)
+            else:
+                viewer.writer.write(frame)
+
+    def _snapshot_frame(self):
+        return websocket_frame(json.dumps({"type": "snapshot", "seq": self.seq, "state": self.state},
+                                          ensure_ascii=False).encode())
+
+    def _authorized(self, headers, query):
+        if not self.token:
+            return False
+        supplied = headers.get("authorization", "")
+        if supplied.lower().startswith("bearer "):
+            supplied = supplied[7:].strip()
+        else:
+            supplied = headers.get("x-auth-token") or query.get("token", [""])[0]
+        return hmac.compare_digest(supplied.encode(), self.token.encode())
+
+    async def _handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self._clients[task] = writer
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            method, target, _ = request_line.split(" ", 2)
+            headers = {}
+            for line in header_lines:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            if url.path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self._handle_websocket(reader, writer, headers, query)
+            elif method == "GET" and url.path == "/state":
+                self._respond(writer, 200, {"seq": self.seq, "state": self.state})
+            elif method == "GET" and url.path == "/metrics" and self.metrics:
+                self._respond_raw(writer, 200, self.metrics.render_text().encode(),
+                                  "text/plain; version=0.0.4; charset=utf-8")
+            elif method == "POST" and url.path == "/command":
+                length = int(headers.get("content-length", "0") or 0)
+                if length > MAX_BODY_BYTES:
+                    self._respond(writer, 413, {"error": "Nội dung quá lớn"})
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = self._command(body, self._authorized(headers, query))
+                    self._respond(writer, status, payload)
+            else:
+                self._respond(writer, 404, {"error": "Không tìm thấy"})
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._clients.pop(task, None)
+            writer.close()
+
+    def _command(self, body, authorized):
+        """
+        Kiểm tra quyền và lệnh, rồi chuyển cho send_command().
+
+        Returns:
+            tuple: (mã HTTP, nội dung JSON).
+        """
+        if not authorized:
+            return 401, {"error": "Token không hợp lệ"}
+        if not self.send_command:
+            return 503, {"error": "Không nhận lệnh"}
+        text = body.decode("utf-8", "replace").strip()
+        if text.startswith("{"):
+            try:
+                text = str(json.loads(text).get("command", ""))
+            except (ValueError, AttributeError):
+                return 400, {"error": "JSON không hợp lệ"}
+        try:
+            command = validate_command(text)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        if self.send_command(command) is False:
+            return 503, {"error": "Hàng đợi lệnh đầy"}
+        return 202, {"queued": command}
+
+    async def _handle_websocket(self, reader, writer, headers, query):
+        key = headers.get("sec-websocket-key")
+        if not key:
+            self._respond(writer, 400, {"error": "Thiếu Sec-WebSocket-Key"})
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        viewer = Viewer(writer, self._authorized(headers, query))
+        writer.write(self._snapshot_frame())
+        self.viewers.add(viewer)
+        try:
+            message = bytearray()
+            while True:
+                fin, opcode, payload = await read_websocket_frame(reader)
+                if opcode == 0x8: # Đóng
+                    writer.write(websocket_frame(payload[:2], 0x8))
+                    break
+                if opcode == 0x9: # Ping -> Pong
+                    writer.write(websocket_frame(payload, 0xA))
+                    continue
+                if opcode in (0x0, 0x1, 0x2):
+                    message += payload
+                    if len(message) > MAX_MESSAGE_BYTES:
+                        break
+                    if fin:
+                        self._on_websocket_message(viewer, bytes(message))
+                        message.clear()
+        finally:
+            self.viewers.discard(viewer)
+
+    def _on_websocket_message(self, viewer, data):
+        """
+        Tin nhắn từ người xem: {"command": "E1"} (cần token trong URL: /ws?token=...).
+        """
+        status, reply = self._command(data, viewer.can_command)
+        reply = dict(reply, type="command", status=status)
+        viewer.writer.write(websocket_frame(json.dumps(reply, ensure_ascii=False).encode()))
+
+    def _respond(self, writer, status, payload):
+        self._respond_raw(writer, status, json.dumps(payload, ensure_ascii=False).encode(),
+                          "application/json; charset=utf-8")
+
+    def _respond_raw(self, writer, status, body, content_type):
+        reason = {200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                  413: "Payload Too Large", 503: "Service Unavailable"}.get(status, "OK")
+        writer.write((f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                      f"Content-Length: {len(body)}\r\nCache-Control: no-store\r\nConnection: close\r\n\r\n").encode()
+                     + body)
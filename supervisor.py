@@ -0,0 +1,465 @@
+import tkinter as tk
+from tkinter import messagebox
+import json
+import os
+import queue
+import sys
+import time
+
+from main import TrafficLight, IntersectionDisplay
+import engine
+from command_writer import CommandWriter, describe_result
+from protocol import FRAME_PROTOCOL_COMMANDS, NEGOTIATION_TIMEOUT
+from serial_queue import SerialLineQueue
+from connection import (MultiSerialConnection, STATE_CONNECTING, STATE_WAITING_READY, STATE_CONNECTED,
+                        STATE_DISCONNECTED)
+from telemetry import TelemetryWriter
+from scheduler import PhaseApplier, PlanScheduler, load_plan_table
+from adaptive import AdaptiveController
+from safety import SafetyMonitor
+from log_view import LogView, CATEGORY_SYSTEM
+
+
+def load_config(path):
+    """
+    Đọc file cấu hình JSON của supervisor.
+
+    Định dạng:
+        {
+            "baudrate": 115200,
+            "columns": 6,
+            "protocol": "text",
+            "frame_interval_ms": 1000,
+            "telemetry_dir": "telemetry",
+            "plans": "plans.example.json",
+            "auto_e3": false,
+            "intersections": [
+                {"name": "Ngã tư A", "port": "COM5"},
+                {"name": "Ngã tư B", "port": "/dev/ttyUSB1", "protocol": "binary", "frame_interval_ms": 100}
+            ]
+        }
+
+    Args:
+        path (str): Đường dẫn tới file cấu hình.
+
+    Returns:
+        dict: Cấu hình đã kiểm tra, mỗi ngã tư luôn có "name", "port", "baudrate"
+            và "protocol" ("text", "binary": yêu cầu khung trạng thái nhị phân khi kết nối,
+            hoặc "sparse": khung thưa, đếm ngược chạy cục bộ).
+            "frame_interval_ms" (tùy chọn, chung hoặc riêng cho từng ngã tư, mặc định null: theo firmware):
+            chu kỳ khung nhị phân hoặc khung đồng bộ của chế độ sparse (ms), gửi kèm lệnh PROTO.
+            "telemetry_dir" (tùy chọn): thư mục ghi lịch sử pha đèn, mỗi ngã tư một thư mục con.
+            "plans" (tùy chọn): file bảng kế hoạch thời gian pha (đường dẫn tương đối theo file cấu hình),
+            được đọc vào "plan_table" (PlanTable); lịch riêng được chọn theo tên ngã tư.
+            "adaptive" (tùy chọn, thay cho "plans"): {"source": "udp:9000", "interval": 30, "min_green": 5,
+            "max_green": 60} – thời gian xanh thích ứng, dòng số xe mang tên ngã tư.
+            "auto_e3" (tùy chọn, mặc định false, có thể đặt riêng cho từng ngã tư): tự gửi E3 (cả hai đỏ)
+            khi bộ giám sát an toàn phát hiện hai hướng cùng xanh/vàng.
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    intersections = config.get("intersections")
+    if not intersections:
+        raise ValueError("Cấu hình không có ngã tư nào (khóa 'intersections')")
+    baudrate = config.get("baudrate", 115200)
+    frame_protocol = config.get("protocol", "text")
+    auto_e3 = config.get("auto_e3", False)
+    frame_interval_ms = config.get("frame_interval_ms")
+    names = set()
+    for item in intersections:
+        if "port" not in item:
+            raise ValueError(f"Ngã tư thiếu khóa 'port': {item}")
+        item.setdefault("name", item["port"])
+        item.setdefault("baudrate", baudrate)
+        item.setdefault("protocol", frame_protocol)
+        item.setdefault("auto_e3", auto_e3)
+        item.setdefault("frame_interval_ms", frame_interval_ms)
+        if not isinstance(item["auto_e3"], bool):
+            raise ValueError(f"'auto_e3' phải là true/false: {item['auto_e3']}")
+        interval = item["frame_interval_ms"]
+        if interval is not None and (not isinstance(interval, int) or isinstance(interval, bool) or interval <= 0):
+            raise ValueError(f"'frame_interval_ms' phải là số nguyên dương (ms): {interval}")
+        if item["protocol"] not in ("text", "binary", "sparse"):
+            raise ValueError(f"Giao thức không hợp lệ (chỉ text/binary/sparse): {item['protocol']}")
+        if item["name"] in names:
+            raise ValueError(f"Tên ngã tư bị trùng: {item['name']}")
+        names.add(item["name"])
+    adaptive = config.get("adaptive")
+    if adaptive is not None:
+        if config.get("plans"):
+            raise ValueError("Chỉ dùng một trong 'plans' hoặc 'adaptive'")
+        if not isinstance(adaptive, dict) or not adaptive.get("source"):
+            raise ValueError("Khóa 'adaptive' cần 'source' (file, udp:<cổng> hoặc sim:<xe/h M1>,<xe/h M2>)")
+    if config.get("plans"):
+        config["plan_table"] = load_plan_table(os.path.join(os.path.dirname(path), config["plans"]))
+    return config
+
+
+class IntersectionTile(tk.Frame, IntersectionDisplay):
+    """
+    Ô hiển thị thu gọn của một ngã tư trong lưới supervisor.
+    Dùng lại bộ máy trạng thái và logic hiển thị của IntersectionDisplay
+    cùng TrafficLight dạng thu gọn cho hai hướng.
+    """
+    def __init__(self, parent, name, supervisor, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.name = name
+        self.supervisor = supervisor
+        self.queue = SerialLineQueue(maxlen=200) # Hàng đợi riêng, khung "S," được gộp theo ngã tư
+        self.telemetry_channel = None # Kênh ghi lịch sử của ngã tư (nếu bật telemetry)
+        self.watchdog = None # Bộ kiểm tra an toàn của ngã tư (IntersectionWatchdog)
+        self.phase_applier = None # Áp dụng kế hoạch thời gian pha (nếu cấu hình có lịch / thích ứng)
+        self.port = None # Tên cổng Serial (từ cấu hình)
+        self.connection_state = None
+        self.frame_protocol = "text" # Định dạng khung yêu cầu khi ESP32 sẵn sàng ("text": không thỏa thuận)
+        self.frame_interval_ms = None # Chu kỳ khung nhị phân / khung đồng bộ (ms), None: mặc định firmware
+        self.negotiation_sent = False
+        self.negotiation_deadline = None # Thời điểm kiểm tra kết quả thỏa thuận định dạng khung
+        # Lệnh gửi tới ngã tư được ghi trên luồng riêng và ghép với dòng xác nhận của ESP32
+        self.command_writer = CommandWriter(lambda: supervisor.connection.serial(name),
+                                            on_result=lambda result: supervisor.command_results.put((name, result)))
+
+        tk.Label(self, text=name, font=("Arial", 10, "bold"), fg="white",
+                 bg="#1e293b").grid(row=0, column=0, columnspan=2, sticky="ew")
+        self.traffic_light_1 = TrafficLight(self, "M1", compact=True, bg="#334155")
+        self.traffic_light_1.grid(row=1, column=0, padx=2, pady=2)
+        self.traffic_light_2 = TrafficLight(self, "M2", compact=True, bg="#334155")
+        self.traffic_light_2.grid(row=1, column=1, padx=2, pady=2)
+        self.status_label = tk.Label(self, text="⚡ ĐANG KẾT NỐI...", font=("Arial", 8, "bold"),
+                                     fg="#38bdf8", bg="#1e293b", wraplength=180)
+        self.status_label.grid(row=2, column=0, columnspan=2, sticky="ew")
+        self.init_engine() # Bộ máy trạng thái riêng của ngã tư này
+
+    def log_message(self, message, category=CATEGORY_SYSTEM):
+        """
+        Ghi nhật ký vào khung nhật ký chung của supervisor, kèm tên ngã tư.
+        """
+        self.supervisor.log_message(f"[{self.name}] {message}", category)
+
+    def on_serial_item(self, item):
+        """
+        Được gọi trên luồng đọc chung: kiểm tra an toàn, ghép xác nhận lệnh, ghi lịch sử
+        rồi đưa mục vào hàng đợi của ô.
+        """
+        if self.watchdog:
+            self.watchdog.on_item(item)
+        self.command_writer.on_line(item)
+        if self.telemetry_channel:
+            self.telemetry_channel.on_item(item)
+        self.queue.put(item)
+
+    def handle_connection_state(self, event):
+        """
+        Xử lý thay đổi kết nối của ngã tư (gọi trên luồng chính): khi mở lại cổng, ESP32 khởi động lại
+        nên trạng thái đã biết, thỏa thuận định dạng khung và kế hoạch đã áp dụng đều được đặt lại.
+
+        Args:
+            event (ConnectionState): Trạng thái kết nối mới.
+        """
+        self.connection_state = event.state
+        if event.state == STATE_CONNECTING:
+            self.engine.reset() # Khung đầu tiên sau khi kết nối lại sẽ được phát lại đầy đủ
+            self.negotiation_sent = False
+            self.negotiation_deadline = None
+            if self.phase_applier: # ESP32 khởi động lại với thời gian mặc định khi mở lại cổng
+                self.phase_applier.reset()
+            self.status_label.config(text="⚡ ĐANG KẾT NỐI...", fg="#38bdf8")
+        elif event.state == STATE_WAITING_READY:
+            self.log_message(f"Đã mở cổng {self.port}, chờ dữ liệu từ ESP32...")
+            self.status_label.config(text="⏳ CHỜ DỮ LIỆU", fg="#38bdf8")
+        elif event.state == STATE_CONNECTED:
+            self.log_message(f"Kết nối Serial thành công tại {self.port}")
+            self.status_label.config(text="✅ ĐÃ KẾT NỐI", fg="#22c55e")
+        elif event.state == STATE_DISCONNECTED:
+            reason = f": {event.error}" if event.error else ""
+            self.log_message(f"Không có kết nối Serial tại {self.port}{reason}. Thử lại sau {event.retry_in:.1f}s")
+            self.status_label.config(text=f"⚠️ MẤT KẾT NỐI – THỬ LẠI SAU {event.retry_in:.0f}s", fg="#ef4444")
+
+    def on_command_result(self, result):
+        """
+        Ghi nhật ký kết quả của một lệnh (gọi trên luồng chính).
+
+        Args:
+            result (CommandResult): Kết quả từ CommandWriter của ngã tư.
+        """
+        described = describe_result(result)
+        if described:
+            category, message = described
+            self.log_message(message, category)
+
+    def update_negotiation(self, now):
+        """
+        Thỏa thuận định dạng khung (gọi mỗi nhịp trên luồng chính): lệnh PROTO chỉ được gửi sau khung
+        hợp lệ đầu tiên, vì mở cổng làm ESP32 khởi động lại và lệnh gửi sớm hơn sẽ bị mất;
+        nếu sau NEGOTIATION_TIMEOUT giây chưa có "PROTO_OK,..." thì báo tiếp tục dùng khung văn bản.
+        """
+        if self.frame_protocol not in FRAME_PROTOCOL_COMMANDS:
+            return
+        make_command, mode = FRAME_PROTOCOL_COMMANDS[self.frame_protocol]
+        if not self.negotiation_sent:
+            if self.engine.m1_color is not None: # Đã nhận khung trạng thái hợp lệ
+                self.negotiation_sent = True
+                if self.supervisor.send_command(self.name, make_command(self.frame_interval_ms)):
+                    self.negotiation_deadline = now + NEGOTIATION_TIMEOUT
+        elif self.negotiation_deadline is not None and now >= self.negotiation_deadline:
+            self.negotiation_deadline = None
+            if self.engine.protocol != mode:
+                self.log_message(f"ESP32 không xác nhận {engine.PROTOCOL_NAMES[mode]} – "
+                                 f"tiếp tục dùng khung văn bản", engine.LOG_WARNING)
+
+
+class SupervisorApp:
+    """
+    Lớp SupervisorApp giám sát nhiều ngã tư (nhiều ESP32) trong một tiến trình.
+    Mọi cổng Serial được đọc bởi một luồng duy nhất (MultiSerialReader) và được vẽ
+    trên một lưới các ô thu gọn; một nhịp Tkinter duy nhất xử lý hàng đợi của tất cả ngã tư.
+    Cổng mở thất bại hoặc mất kết nối được mở lại riêng từng cổng, chờ tăng theo cấp số nhân (MultiSerialConnection).
+    Bất biến an toàn được kiểm tra ngay trên luồng đọc, một luồng hẹn giờ chung phát hiện mất khung.
+    """
+    def __init__(self, root, config):
+        self.root = root
+        self.root.title("🚦 Giám sát nhiều ngã tư ESP32")
+        self.root.geometry("1200x800")
+        self.root.configure(bg="#1e293b")
+
+        self.config = config
+        self.tiles = {} # Tên ngã tư -> IntersectionTile
+        # Mở, theo dõi và mở lại mọi cổng trên một luồng nền; đọc bằng một luồng chung
+        self.connection = MultiSerialConnection(self.on_connection_event)
+        # Một luồng ghi lịch sử chung cho mọi ngã tư (None nếu cấu hình không có "telemetry_dir")
+        telemetry_dir = config.get("telemetry_dir")
+        self.telemetry = TelemetryWriter(telemetry_dir) if telemetry_dir else None
+        self.plan_scheduler = None # Luồng lịch kế hoạch thời gian pha chung (nếu cấu hình có "plans")
+        self.adaptive = None # Điều khiển thích ứng chung cho mọi ngã tư (nếu cấu hình có "adaptive")
+        # Sự kiện kết nối, kết quả lệnh và cảnh báo an toàn từ luồng nền chờ nhịp Tkinter xử lý
+        self.connection_events = queue.SimpleQueue()
+        self.command_results = queue.SimpleQueue()
+        self.safety_alarms = queue.SimpleQueue()
+        self.safety = SafetyMonitor(self.safety_alarms.put) # Giám sát an toàn chung cho mọi ngã tư
+
+        self.build_ui()
+        if self.telemetry:
+            for name, tile in self.tiles.items():
+                tile.telemetry_channel = self.telemetry.channel(name)
+            self.telemetry.start()
+        for item in config["intersections"]:
+            name = item["name"]
+            # E3 tự động đi qua ô lệnh khẩn của luồng ghi, không phụ thuộc nhịp Tkinter
+            tile = self.tiles[name]
+            tile.watchdog = self.safety.channel(name, tile.command_writer.send_urgent, item["auto_e3"])
+        self.safety.start()
+        for tile in self.tiles.values():
+            tile.command_writer.start()
+        if config.get("plan_table") or config.get("adaptive"):
+            self.start_phase_control()
+        self.connect_all()
+        self.process_serial_queues()
+
+    def build_ui(self):
+        """
+        Xây dựng giao diện: tiêu đề, lưới ngã tư có thanh cuộn và khung nhật ký chung.
+        """
+        header_frame = tk.Frame(self.root, bg="#1e293b")
+        header_frame.pack(fill="x", pady=5)
+        tk.Label(header_frame, text="🚦 GIÁM SÁT NHIỀU NGÃ TƯ", bg="#1e293b", fg="white",
+                 font=("Arial", 18, "bold")).pack()
+        self.status_label = tk.Label(header_frame, text="", fg="#38bdf8", bg="#1e293b",
+                                     font=("Arial", 12, "bold"))
+        self.status_label.pack()
+
+        # Lưới ngã tư đặt trong Canvas để cuộn được khi có nhiều ngã tư
+        grid_frame = tk.Frame(self.root, bg="#1e293b")
+        grid_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        canvas = tk.Canvas(grid_frame, bg="#1e293b", highlightthickness=0)
+        scrollbar = tk.Scrollbar(grid_frame, command=canvas.yview)
+        canvas.config(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        canvas.pack(side="left", fill="both", expand=True)
+        inner = tk.Frame(canvas, bg="#1e293b")
+        canvas.create_window((0, 0), window=inner, anchor="nw")
+        inner.bind("<Configure>", lambda e: canvas.config(scrollregion=canvas.bbox("all")))
+
+        columns = self.config.get("columns", 6)
+        for index, item in enumerate(self.config["intersections"]):
+            tile = IntersectionTile(inner, item["name"], self, bg="#1e293b",
+                                    relief="raised", bd=1)
+            tile.grid(row=index // columns, column=index % columns, padx=4, pady=4, sticky="n")
+            self.tiles[item["name"]] = tile
+
+        log_frame = tk.LabelFrame(self.root, text="📋 NHẬT KÝ HỆ THỐNG",
+                                  bg="#334155", fg="white", font=("Arial", 10))
+        log_frame.pack(fill="x", padx=10, pady=(0, 10))
+        self.log_view = LogView(log_frame, height=8, bg="#334155")
+        self.log_view.pack(fill="both", expand=True)
+
+    def connect_all(self):
+        """
+        Khai báo mọi cổng Serial trong cấu hình rồi bắt đầu luồng quản lý kết nối.
+        Không chờ cố định sau khi mở: dữ liệu được xử lý ngay khi tới.
+        """
+        for item in self.config["intersections"]:
+            name = item["name"]
+            tile = self.tiles[name]
+            tile.port = item["port"]
+            tile.frame_protocol = item["protocol"] # Thỏa thuận sau khung hợp lệ đầu tiên
+            tile.frame_interval_ms = item["frame_interval_ms"]
+            self.connection.add(name, item["port"], item["baudrate"], tile.on_serial_item)
+        self.update_status()
+        self.connection.start()
+
+    def update_status(self):
+        """
+        Cập nhật số ngã tư đang kết nối trên tiêu đề.
+        """
+        connected = sum(tile.connection_state == STATE_CONNECTED for tile in self.tiles.values())
+        self.status_label.config(text=f"✅ Đã kết nối {connected}/{len(self.tiles)} ngã tư",
+                                 fg="#22c55e" if connected == len(self.tiles) else "#fbbf24")
+
+    def start_phase_control(self):
+        """
+        Khởi động lịch kế hoạch thời gian pha hoặc điều khiển thích ứng cho mọi ngã tư.
+        Lệnh SET đi qua luồng ghi lệnh của từng ngã tư, xác nhận qua SET_UPDATED trong bộ máy trạng thái.
+        """
+        appliers = {name: PhaseApplier(name, tile.engine, tile.command_writer.send)
+                    for name, tile in self.tiles.items()}
+        for name, applier in appliers.items():
+            self.tiles[name].phase_applier = applier # Đặt lại khi ngã tư kết nối lại
+        if self.config.get("plan_table"):
+            self.plan_scheduler = PlanScheduler(self.config["plan_table"], appliers)
+            self.plan_scheduler.start()
+            return
+        options = dict(self.config["adaptive"])
+        try:
+            self.adaptive = AdaptiveController(options.pop("source"), **options)
+        except (OSError, ValueError, TypeError) as e:
+            self.log_message(f"Không khởi động được điều khiển thích ứng: {e}", engine.LOG_ERROR)
+            return
+        for name, applier in appliers.items():
+            self.adaptive.attach(name, applier)
+        self.adaptive.start()
+
+    def send_command(self, name, command):
+        """
+        Đưa một lệnh vào hàng đợi gửi của ngã tư (gọi trên luồng chính, không chặn).
+        Lỗi ghi và hết hạn chờ xác nhận được báo sau qua kết quả lệnh.
+
+        Returns:
+            bool: False nếu hàng đợi lệnh của ngã tư đầy.
+        """
+        if not self.tiles[name].command_writer.send(command):
+            return False
+        self.tiles[name].log_message(f"Gửi lệnh: {command}")
+        return True
+
+    def on_connection_event(self, name, event):
+        """
+        Được gọi trên luồng quản lý kết nối: đặt lại bộ giám sát an toàn trước khi cổng được đọc lại
+        (ESP32 khởi động lại khi mở cổng) hoặc khi cổng đã gỡ khỏi luồng đọc; việc cập nhật GUI
+        chờ nhịp xử lý trên luồng chính.
+        """
+        if event.state in (STATE_CONNECTING, STATE_DISCONNECTED):
+            self.tiles[name].watchdog.reset()
+        self.connection_events.put((name, event))
+
+    def show_safety_alarm(self, alarm):
+        """
+        Ghi cảnh báo an toàn của một ngã tư vào nhật ký chung.
+        """
+        self.tiles[alarm.name].log_message(f"AN TOÀN: {alarm.message}",
+                                           engine.LOG_ERROR if alarm.active else engine.LOG_WARNING)
+
+    def log_message(self, message, category=CATEGORY_SYSTEM):
+        """
+        Thêm một tin nhắn vào nhật ký chung (bộ đệm vòng, vẽ lại tối đa mỗi 100ms).
+
+        Args:
+            message (str): Tin nhắn cần ghi.
+            category (str): Nhóm tin nhắn dùng cho bộ lọc hiển thị.
+        """
+        self.log_view.add(message, category)
+
+    def process_serial_queues(self):
+        """
+        Xử lý hàng đợi của mọi ngã tư trong một nhịp duy nhất (mỗi 50ms).
+        Chỉ ngã tư có dữ liệu mới mới bị phân tích và vẽ lại; ngã tư dùng khung thưa
+        được cập nhật đếm ngược cục bộ (chỉ vẽ lại khi số giây thay đổi).
+        Sự kiện kết nối, kết quả lệnh và cảnh báo an toàn từ luồng nền cũng được xử lý tại đây.
+        """
+        changed = False
+        while True:
+            try:
+                name, event = self.connection_events.get_nowait()
+            except queue.Empty:
+                break
+            self.tiles[name].handle_connection_state(event)
+            changed = True
+        if changed:
+            self.update_status()
+        while True:
+            try:
+                name, result = self.command_results.get_nowait()
+            except queue.Empty:
+                break
+            self.tiles[name].on_command_result(result)
+        while True:
+            try:
+                alarm = self.safety_alarms.get_nowait()
+            except queue.Empty:
+                break
+            self.show_safety_alarm(alarm)
+        now = time.monotonic()
+        for tile in self.tiles.values():
+            if tile.queue:
+                for line in tile.queue.drain(50):
+                    tile.parse_serial(line)
+            tile.update_negotiation(now)
+            tile.engine.tick(now)
+        self.root.after(50, self.process_serial_queues)
+
+    def close(self):
+        """
+        Dừng luồng lịch / điều khiển thích ứng, giám sát an toàn, luồng ghi lệnh, luồng quản lý kết nối
+        (cùng luồng đọc chung, đóng mọi cổng Serial) và ghi nốt lịch sử còn chờ.
+        """
+        if self.plan_scheduler:
+            self.plan_scheduler.stop()
+            self.plan_scheduler.join(timeout=2)
+        if self.adaptive:
+            self.adaptive.stop()
+            self.adaptive.join(timeout=2)
+        self.safety.stop()
+        self.safety.join(timeout=2)
+        for tile in self.tiles.values():
+            tile.command_writer.stop()
+        for tile in self.tiles.values():
+            tile.command_writer.join(timeout=2)
+        self.connection.stop()
+        self.connection.join(timeout=3)
+        if self.telemetry:
+            self.telemetry.stop()
+            self.telemetry.join(timeout=3)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Cách dùng: python supervisor.py <file cấu hình JSON>")
+        sys.exit(2)
+    try:
+        supervisor_config = load_config(sys.argv[1])
+    except (OSError, ValueError) as e:
+        print(f"Lỗi cấu hình: {e}")
+        sys.exit(1)
+
+    root = tk.Tk()
+    app = SupervisorApp(root, supervisor_config)
+
+    def on_close():
+        """
+        Hỏi xác nhận, dừng luồng đọc và đóng mọi cổng Serial trước khi thoát.
+        """
+        if messagebox.askokcancel("Thoát", "Bạn có chắc muốn thoát ứng dụng?"):
+            app.close()
+            root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
+    root.mainloop()
@@ -0,0 +1,327 @@
+import argparse
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+
+from engine import EMERGENCY_ANNOUNCEMENTS, VALID_COLORS, parse_uint
+from protocol import COLOR_CODES, COLOR_NAMES, StatusFrame
+
+# Bản ghi cố định 16 byte cho mỗi khung trạng thái:
+#   [0..7]  thời điểm nhận (float64, giây Unix)
+#   [8] màu Mạch 1 (mã màu)   [9] giây còn lại Mạch 1 (uint8, cắt ở 255)
+#   [10] màu Mạch 2 (mã màu)  [11] giây còn lại Mạch 2
+#   [12] chế độ khẩn cấp (0-3) [13] số thứ tự khung nhị phân  [14] cờ  [15] dự phòng
+RECORD_STRUCT = struct.Struct("<dBBBBBBBx")
+RECORD_SIZE = RECORD_STRUCT.size
+FLAG_BINARY = 0x01 # Bản ghi từ khung nhị phân (số thứ tự có nghĩa)
+
+# Đầu file: chuỗi nhận dạng, phiên bản định dạng, kích thước bản ghi
+FILE_MAGIC = b"TLOG"
+FILE_VERSION = 1
+HEADER_STRUCT = struct.Struct("<4sHH")
+FILE_SUFFIX = ".tlog"
+
+TelemetryRecord = namedtuple("TelemetryRecord",
+                             "timestamp m1_color m1_secs m2_color m2_secs emergency_mode seq binary")
+
+
+def channel_directory_name(name):
+    """
+    Tên thư mục an toàn cho một ngã tư, ví dụ "/dev/ttyUSB0" -> "dev_ttyUSB0".
+    """
+    return re.sub(r"[^\w.-]+", "_", name, flags=re.UNICODE).strip("_.") or "default"
+
+
+class TelemetryChannel:
+    """
+    Nguồn bản ghi của một ngã tư. on_item() được gọi trên luồng đọc cho mỗi dòng/khung:
+    khung trạng thái được chuyển thành bản ghi và đưa vào hàng đợi có giới hạn,
+    luồng ghi của TelemetryWriter lấy ra theo lô.
+    """
+    def __init__(self, name, directory, maxlen):
+        self.name = name
+        self.directory = directory
+        self.pending = deque()
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        self.emergency_mode = 0 # Suy ra từ thông báo khẩn cấp (khung văn bản không mang chế độ)
+        self.recorded = 0
+        self.dropped = 0 # Bản ghi bị bỏ do hàng đợi đầy (đĩa quá chậm)
+        self.log = None # RotatingRecordLog, chỉ luồng ghi truy cập
+
+    def on_item(self, item):
+        """
+        Ghi nhận một mục nhận được từ Serial (gọi trên luồng đọc).
+
+        Args:
+            item (str | StatusFrame): Dòng văn bản hoặc khung nhị phân đã giải mã.
+        """
+        if item.__class__ is StatusFrame:
+            self.emergency_mode = item.emergency_mode
+            self.append((time.time(), COLOR_CODES[item.m1_color], item.m1_secs,
+                         COLOR_CODES[item.m2_color], item.m2_secs, item.emergency_mode,
+                         item.seq, FLAG_BINARY))
+        elif item.startswith("S,"):
+            parts = item.split(",")
+            if len(parts) not in (5, 7) or parts[1] not in VALID_COLORS or parts[3] not in VALID_COLORS:
+                return
+            m1_secs = parse_uint(parts[2])
+            m2_secs = parse_uint(parts[4])
+            if m1_secs is None or m2_secs is None:
+                return
+            self.append((time.time(), COLOR_CODES[parts[1]], min(m1_secs, 255),
+                         COLOR_CODES[parts[3]], min(m2_secs, 255), self.emergency_mode, 0, 0))
+        elif item.startswith(">>> KHẨN CẤP:"):
+            for marker, _, _, _, mode in EMERGENCY_ANNOUNCEMENTS:
+                if marker in item:
+                    self.emergency_mode = mode
+                    break
+        elif "TẮT KHẨN CẤP" in item:
+            self.emergency_mode = 0
+
+    def append(self, record):
+        with self.lock:
+            if len(self.pending) >= self.maxlen:
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append(record)
+
+    def take(self):
+        """
+        Lấy toàn bộ bản ghi đang chờ (gọi trên luồng ghi).
+        """
+        with self.lock:
+            if not self.pending:
+                return ()
+            batch, self.pending = self.pending, deque()
+        return batch
+
+
+class RotatingRecordLog:
+    """
+    File bản ghi chỉ ghi nối tiếp, tự xoay vòng theo kích thước:
+    khi file hiện tại vượt max_bytes thì mở file mới, chỉ giữ max_files file gần nhất.
+    """
+    def __init__(self, directory, max_bytes, max_files):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.file = None
+        self.size = 0
+        self.buffer = bytearray()
+
+    def write_batch(self, records):
+        """
+        Đóng gói một lô bản ghi vào bộ đệm dùng lại và ghi bằng một lần gọi write().
+        """
+        if self.file is None or self.size >= self.max_bytes:
+            self.rotate()
+        buffer = self.buffer
+        needed = len(records) * RECORD_SIZE
+        if len(buffer) < needed:
+            buffer.extend(bytes(needed - len(buffer)))
+        pack_into = RECORD_STRUCT.pack_into
+        offset = 0
+        for record in records:
+            pack_into(buffer, offset, *record)
+            offset += RECORD_SIZE
+        with memoryview(buffer) as view:
+            self.file.write(view[:needed])
+        self.file.flush()
+        self.size += needed
+
+    def rotate(self):
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path = os.path.join(self.directory, f"telemetry-{stamp}{FILE_SUFFIX}")
+        self.file = open(path, "ab")
+        self.file.write(HEADER_STRUCT.pack(FILE_MAGIC, FILE_VERSION, RECORD_SIZE))
+        self.size = HEADER_STRUCT.size
+        self.prune()
+
+    def prune(self):
+        """
+        Xóa các file cũ nhất khi vượt quá max_files.
+        """
+        files = list_log_files(self.directory)
+        for path in files[:max(len(files) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class TelemetryWriter:
+    """
+    Lưu mọi khung trạng thái nhận được xuống đĩa để tra cứu lịch sử pha khi có sự cố.
+    Mỗi ngã tư (kênh) có thư mục riêng với các file bản ghi cố định 16 byte, xoay vòng theo kích thước.
+    Bản ghi được gom theo lô và ghi trên một luồng nền duy nhất: luồng đọc chỉ thêm vào hàng đợi,
+    luồng Tkinter không bao giờ làm I/O file; bộ nhớ và dung lượng đĩa đều có giới hạn.
+    """
+    def __init__(self, base_dir, max_bytes=4 * 1024 * 1024, max_files=64, flush_interval=1.0, maxlen=50000):
+        """
+        Args:
+            base_dir (str): Thư mục gốc, mỗi ngã tư ghi vào một thư mục con.
+            max_bytes (int): Kích thước tối đa của một file trước khi xoay vòng.
+            max_files (int): Số file tối đa giữ lại cho mỗi ngã tư.
+            flush_interval (float): Chu kỳ (giây) ghi một lô xuống đĩa.
+            maxlen (int): Số bản ghi tối đa chờ ghi của mỗi ngã tư.
+        """
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.maxlen = maxlen
+        self.channels = {}
+        self.errors = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="telemetry-writer", daemon=True)
+
+    def channel(self, name):
+        """
+        Lấy (hoặc tạo) kênh ghi của một ngã tư.
+
+        Args:
+            name (str): Tên ngã tư hoặc cổng Serial.
+
+        Returns:
+            TelemetryChannel: Kênh có on_item() để gắn vào luồng đọc.
+        """
+        channel = self.channels.get(name)
+        if channel is None:
+            directory = os.path.join(self.base_dir, channel_directory_name(name))
+            channel = TelemetryChannel(name, directory, self.maxlen)
+            self.channels[name] = channel
+        return channel
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Dừng luồng ghi; các bản ghi còn chờ được ghi nốt trước khi đóng file.
+        """
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def flush(self):
+        """
+        Ghi mọi bản ghi đang chờ của tất cả ngã tư (chạy trên luồng ghi).
+        """
+        for channel in list(self.channels.values()):
+            batch = channel.take()
+            if not batch:
+                continue
+            if channel.log is None:
+                channel.log = RotatingRecordLog(channel.directory, self.max_bytes, self.max_files)
+            try:
+                channel.log.write_batch(batch)
+                channel.recorded += len(batch)
+            except OSError as e: # Đĩa đầy, mất quyền ghi...: bỏ lô này, thử lại ở lô sau
+                self.errors += 1
+                self.last_error = e
+                channel.log.close()
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+        for channel in self.channels.values():
+            if channel.log:
+                channel.log.close()
+
+
+def list_log_files(directory):
+    """
+    Các file bản ghi trong một thư mục, theo thứ tự thời gian (tên file chứa thời điểm tạo).
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names) if name.endswith(FILE_SUFFIX)]
+
+
+def read_records(path):
+    """
+    Đọc các bản ghi của một file (bỏ qua bản ghi cuối bị ghi dở).
+
+    Args:
+        path (str): Đường dẫn file .tlog.
+
+    Yields:
+        TelemetryRecord: Từng bản ghi theo thứ tự ghi.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER_STRUCT.size:
+        return
+    magic, version, record_size = HEADER_STRUCT.unpack_from(data)
+    if magic != FILE_MAGIC or version != FILE_VERSION or record_size != RECORD_SIZE:
+        raise ValueError(f"File bản ghi không hợp lệ: {path}")
+    end = HEADER_STRUCT.size + (len(data) - HEADER_STRUCT.size) // RECORD_SIZE * RECORD_SIZE
+    for timestamp, m1_code, m1_secs, m2_code, m2_secs, mode, seq, flags in RECORD_STRUCT.iter_unpack(
+            memoryview(data)[HEADER_STRUCT.size:end]):
+        yield TelemetryRecord(timestamp, COLOR_NAMES[m1_code], m1_secs, COLOR_NAMES[m2_code], m2_secs,
+                              mode, seq, bool(flags & FLAG_BINARY))
+
+
+def iter_records(directory, since=None, until=None):
+    """
+    Đọc lịch sử của một ngã tư trong khoảng thời gian [since, until] (giây Unix, None: không giới hạn).
+    """
+    for path in list_log_files(directory):
+        for record in read_records(path):
+            if since is not None and record.timestamp < since:
+                continue
+            if until is not None and record.timestamp > until:
+                return
+            yield record
+
+
+def parse_time(text):
+    return datetime.fromisoformat(text).timestamp() if text else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Xem lịch sử pha đèn đã ghi của một ngã tư")
+    parser.add_argument("directory", help="Thư mục bản ghi của ngã tư (ví dụ telemetry/COM5)")
+    parser.add_argument("--since", help="Từ thời điểm (ISO, ví dụ 2024-05-01T08:00)")
+    parser.add_argument("--until", help="Đến thời điểm (ISO)")
+    parser.add_argument("--changes", action="store_true", help="Chỉ in khi màu đèn hoặc chế độ khẩn cấp đổi")
+    args = parser.parse_args(argv)
+
+    previous = None
+    count = 0
+    for record in iter_records(args.directory, parse_time(args.since), parse_time(args.until)):
+        key = (record.m1_color, record.m2_color, record.emergency_mode)
+        count += 1
+        if args.changes and key == previous:
+            continue
+        previous = key
+        stamp = datetime.fromtimestamp(record.timestamp).isoformat(sep=" ", timespec="milliseconds")
+        print(f"{stamp} M1 {record.m1_color:<6} {record.m1_secs:>3}s | M2 {record.m2_color:<6} "
+              f"{record.m2_secs:>3}s | khẩn cấp {record.emergency_mode}"
+              + (f" | #{record.seq}" if record.binary else ""))
+    print(f"Tổng số bản ghi: {count:,}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import argparse
+import sys
+
+# Chỉ nạp thư viện chuẩn ở mức module để khởi động nhanh: pyserial, bộ máy trạng thái và
+# (với lệnh gui) tkinter chỉ được nạp trong lệnh con cần tới chúng.
+
+EXIT_OK = 0
+EXIT_FAILED = 1     # Lệnh bị từ chối, thất bại hoặc không được xác nhận
+EXIT_NO_DEVICE = 2  # Không kết nối được ESP32 trong thời gian chờ
+
+
+def add_connection_arguments(parser):
+    parser.add_argument("port", help="Cổng Serial (ví dụ COM5, /dev/ttyUSB0, /tmp/esp32-0)")
+    parser.add_argument("--baudrate", type=int, default=115200, help="Tốc độ baud (mặc định 115200)")
+
+
+def add_pipeline_arguments(parser):
+    parser.add_argument("--protocol", choices=("text", "binary", "sparse"), default="text",
+                        help="Định dạng khung trạng thái thỏa thuận khi kết nối")
+    parser.add_argument("--frame-interval-ms", type=int,
+                        help="Chu kỳ khung nhị phân hoặc khung đồng bộ của chế độ sparse (ms)")
+    parser.add_argument("--metrics", help='Xuất số liệu hiệu năng định kỳ ra file ("-": stdout)')
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="Chu kỳ xuất số liệu (giây)")
+    parser.add_argument("--api-port", type=int, help="Bật API trạng thái HTTP/WebSocket tại cổng này")
+    parser.add_argument("--api-host", default="127.0.0.1", help="Địa chỉ lắng nghe của API")
+    parser.add_argument("--api-token", help="Token cho phép gửi lệnh qua API (mặc định: sinh ngẫu nhiên)")
+    parser.add_argument("--duration", type=float, help="Thời gian chạy (giây), mặc định tới khi bị dừng")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="trafficctl", description="Giám sát và điều khiển đèn giao thông ESP32 không cần giao diện")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    monitor = commands.add_parser("monitor", help="Chạy đường xử lý Serial như dịch vụ nền, in các thay đổi")
+    add_connection_arguments(monitor)
+    add_pipeline_arguments(monitor)
+    monitor.add_argument("--telemetry", metavar="DIR", help="Ghi lịch sử pha đèn vào thư mục này")
+    monitor.add_argument("--json", action="store_true", help="Mỗi sự kiện một dòng JSON")
+    monitor.add_argument("--quiet", action="store_true", help="Chỉ in kết nối, cảnh báo và lỗi")
+    monitor.add_argument("--auto-e3", action="store_true",
+                         help="Tự gửi E3 (cả hai đỏ) khi phát hiện hai hướng cùng xanh/vàng")
+    timing = monitor.add_mutually_exclusive_group()
+    timing.add_argument("--plans", help="File JSON bảng kế hoạch thời gian pha theo khung giờ")
+    timing.add_argument("--adaptive", metavar="SOURCE",
+                        help='Thời gian xanh thích ứng theo số xe: file, "udp:<cổng>" hoặc "sim:<xe/h M1>,<xe/h M2>"')
+
+    record = commands.add_parser("record", help="Chỉ ghi lịch sử pha đèn (telemetry) xuống đĩa")
+    add_connection_arguments(record)
+    record.add_argument("directory", help="Thư mục telemetry")
+    add_pipeline_arguments(record)
+
+    send = commands.add_parser("send", help="Gửi E1/E2/E3/NORMAL và chờ ESP32 xác nhận")
+    add_connection_arguments(send)
+    send.add_argument("action", type=str.upper, choices=("E1", "E2", "E3", "NORMAL"), help="Lệnh")
+    send.add_argument("--timeout", type=float, default=10.0, help="Thời gian chờ xác nhận (giây)")
+    send.add_argument("--ready-timeout", type=float, default=10.0,
+                      help="Thời gian chờ ESP32 sẵn sàng sau khi mở cổng (giây)")
+    send.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+
+    set_phase = commands.add_parser("set", help="Đặt thời gian pha (SET,<GREEN|RED>,<giây>) và chờ xác nhận")
+    add_connection_arguments(set_phase)
+    set_phase.add_argument("color", type=str.upper, choices=("GREEN", "RED"), help="Màu đèn")
+    set_phase.add_argument("seconds", type=int, help="Thời gian (giây)")
+    set_phase.add_argument("--timeout", type=float, default=10.0, help="Thời gian chờ xác nhận (giây)")
+    set_phase.add_argument("--ready-timeout", type=float, default=10.0,
+                           help="Thời gian chờ ESP32 sẵn sàng sau khi mở cổng (giây)")
+    set_phase.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+
+    gui = commands.add_parser("gui", help="Mở giao diện Tkinter (các tham số như python main.py)")
+    gui.add_argument("args", nargs=argparse.REMAINDER, help="Tham số cho main.py")
+    return parser
+
+
+def make_status_api(args):
+    if args.api_port is None:
+        return None
+    import secrets
+    from status_api import StatusApi
+    token = args.api_token or secrets.token_urlsafe(24)
+    if not args.api_token:
+        print(f"Token gửi lệnh qua API: {token}", file=sys.stderr, flush=True)
+    return StatusApi(args.api_host, args.api_port, token=token)
+
+
+def run_daemon(args, telemetry_dir, json_output=False, quiet=False):
+    """
+    Chạy HeadlessMonitor tới khi nhận SIGTERM/SIGINT (hoặc hết --duration); báo READY/STOPPING cho systemd.
+    """
+    import signal
+    from headless import HeadlessMonitor, sd_notify
+    from metrics import MetricsExporter, MetricsRegistry
+    from scheduler import load_plan_table
+    from adaptive import AdaptiveController
+
+    plan_table = None
+    if getattr(args, "plans", None):
+        try:
+            plan_table = load_plan_table(args.plans)
+        except (OSError, ValueError) as e:
+            print(f"Không đọc được bảng kế hoạch {args.plans}: {e}", file=sys.stderr)
+            return EXIT_FAILED
+    adaptive = None
+    if getattr(args, "adaptive", None):
+        try:
+            adaptive = AdaptiveController(args.adaptive)
+        except (OSError, ValueError) as e:
+            print(f"Không mở được nguồn số xe {args.adaptive}: {e}", file=sys.stderr)
+            return EXIT_FAILED
+    registry = MetricsRegistry() if args.metrics else None
+    exporter = MetricsExporter(registry, args.metrics, args.metrics_interval) if registry else None
+    monitor = HeadlessMonitor(args.port, args.baudrate, args.protocol, args.frame_interval_ms,
+                              telemetry_dir=telemetry_dir, metrics=registry, status_api=make_status_api(args),
+                              out=sys.stdout, json_output=json_output, quiet=quiet, plan_table=plan_table,
+                              adaptive=adaptive, auto_e3=getattr(args, "auto_e3", False))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: monitor.stop())
+    if exporter:
+        exporter.start()
+    monitor.start()
+    sd_notify("READY=1")
+    try:
+        monitor.run(args.duration)
+    finally:
+        sd_notify("STOPPING=1")
+        monitor.close()
+        if exporter:
+            exporter.stop()
+            exporter.join(timeout=2)
+    return EXIT_OK
+
+
+def run_command(args, command):
+    """
+    Mở cổng, chờ ESP32 sẵn sàng, gửi một lệnh và in kết quả xác nhận.
+
+    Returns:
+        int: Mã thoát (EXIT_OK, EXIT_FAILED hoặc EXIT_NO_DEVICE).
+    """
+    import json
+    from command_writer import validate_command
+    from headless import HeadlessMonitor
+
+    try:
+        command = validate_command(command)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return EXIT_FAILED
+    monitor = HeadlessMonitor(args.port, args.baudrate, out=sys.stderr, quiet=True)
+    monitor.start()
+    try:
+        if not monitor.wait_connected(args.ready_timeout):
+            print(f"ESP32 tại {args.port} không sẵn sàng sau {args.ready_timeout:.0f}s", file=sys.stderr)
+            return EXIT_NO_DEVICE
+        result = monitor.execute(command, args.timeout)
+    finally:
+        monitor.close()
+    ok = result is not None and result.ok and result.acked
+    if args.json:
+        print(json.dumps({"command": command, "ok": ok,
+                          "reply": result.reply if result else None,
+                          "latency_ms": round(result.latency * 1000, 1) if result and result.latency else None,
+                          "attempts": result.attempts if result else 0,
+                          "error": (result.error if result else "Hết thời gian chờ")},
+                         ensure_ascii=False))
+    elif ok:
+        print(f"{command}: {result.reply} ({result.latency * 1000:.0f} ms)")
+    elif result is None:
+        print(f"{command}: hết thời gian chờ xác nhận", file=sys.stderr)
+    else:
+        print(f"{command}: {result.reply or result.error}", file=sys.stderr)
+    return EXIT_OK if ok else EXIT_FAILED
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "gui":
+        import main as gui_app # Chỉ lệnh gui mới nạp tkinter
+        return gui_app.main(args.args)
+    sys.stdout.reconfigure(encoding="utf-8", line_buffering=True)
+    if args.command == "monitor":
+        return run_daemon(args, args.telemetry, args.json, args.quiet)
+    if args.command == "record":
+        return run_daemon(args, args.directory, quiet=True)
+    if args.command == "send":
+        return run_command(args, args.action)
+    return run_command(args, f"SET,{args.color},{args.seconds}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -41,7 +41,27 @@ unsigned long cycleStartTime = 0; // Time when the current traffic light cycle s
 unsigned long lastInterruptTime = 0; // Last interrupt time (for debouncing)
 const unsigned long DEBOUNCE_DELAY = 200; // Debounce delay (milliseconds)
 unsigned long lastSerialUpdate = 0; // Last time serial status was sent
-const unsigned long SERIAL_UPDATE_INTERVAL = 200; // Interval for sending serial status (milliseconds)
+const unsigned long SERIAL_UPDATE_INTERVAL = 200; // Default interval for sending serial status (milliseconds)
+const unsigned long MIN_SERIAL_UPDATE_INTERVAL = 20; // Fastest allowed status interval (binary frames only)
+unsigned long serialUpdateInterval = SERIAL_UPDATE_INTERVAL; // Current status interval (changed by PROTO,BIN,<ms>)
+
+// Binary status frame (negotiated with "PROTO,BIN"), 8 bytes:
+// [0] 0xA5 sync, [1] sequence number, [2] m1 color, [3] m1 seconds, [4] m2 color, [5] m2 seconds,
+// [6] flags (bit 0-1: emergency mode, bit 2: transition yellow), [7] CRC-8 (poly 0x07) of bytes 1..6
+const byte FRAME_SYNC = 0xA5;
+const byte COLOR_RED = 0, COLOR_YELLOW = 1, COLOR_GREEN = 2;
+bool binaryFrames = false; // true: send binary frames instead of "S,..." text lines
+byte frameSeq = 0;         // Sequence number of the next binary frame (wraps at 255)
+
+// Sparse status (negotiated with "PROTO,SPARSE"): frames only on phase changes and periodic sync frames,
+// carrying the remaining time in milliseconds so the GUI can count down locally
+const unsigned long SPARSE_SYNC_INTERVAL = 5000;     // Default interval between sync frames (milliseconds)
+const unsigned long MIN_SPARSE_SYNC_INTERVAL = 1000; // Fastest allowed sync interval
+bool sparseFrames = false;
+unsigned long sparseSyncInterval = SPARSE_SYNC_INTERVAL;
+bool forceStatus = false;   // Send a sparse frame on the next loop (after a command changed the cycle)
+String lastSentM1Color, lastSentM2Color; // Colors in the last sparse frame
+int lastSentMode = -1;      // Emergency mode in the last sparse frame
 
 bool pendingEmergency = false; // Flag indicating if an emergency request is pending a yellow phase
 int pendingMode = 0;           // The emergency mode to apply after the yellow phase
@@ -55,6 +75,9 @@ void IRAM_ATTR toggleEmergency3();
 void displayDigitsCircuit1(int time_val); // Hàm hiển thị cho Mạch 1
 void displayDigitsCircuit2(int time_val); // Hàm hiển thị cho Mạch 2
 void sendSerialStatus();
+void sendSparseStatus();
+void computeStatus(String &m1_color, unsigned long &m1_ms, String &m2_color, unsigned long &m2_ms);
+void sendBinaryStatus(const String &m1_color, int m1_time, const String &m2_color, int m2_time);
 
 void setup() {
   Serial.begin(115200); // Initialize Serial communication at 115200 baud rate
@@ -116,6 +139,34 @@ void loop() {
       yellowPhase = false;
       cycleStartTime = millis(); // Reset cycle time to start from the beginning
       Serial.println(">>> TẮT KHẨN CẤP - QUAY LẠI BÌNH THƯỜNG <<<"); // Send message to GUI
+    } else if (command.startsWith("PROTO,BIN")) { // Switch status output to binary frames: PROTO,BIN[,<interval_ms>]
+      binaryFrames = true;
+      sparseFrames = false;
+      serialUpdateInterval = SERIAL_UPDATE_INTERVAL;
+      int comma2 = command.indexOf(',', 6);
+      if (comma2 > 0) {
+        unsigned long interval = command.substring(comma2 + 1).toInt();
+        serialUpdateInterval = max(interval, MIN_SERIAL_UPDATE_INTERVAL);
+      }
+      Serial.print("PROTO_OK,BIN,");
+      Serial.println(serialUpdateInterval);
+    } else if (command.startsWith("PROTO,SPARSE")) { // Sparse status frames: PROTO,SPARSE[,<sync_interval_ms>]
+      sparseFrames = true;
+      binaryFrames = false;
+      sparseSyncInterval = SPARSE_SYNC_INTERVAL;
+      int comma2 = command.indexOf(',', 6);
+      if (comma2 > 0) {
+        unsigned long interval = command.substring(comma2 + 1).toInt();
+        sparseSyncInterval = max(interval, MIN_SPARSE_SYNC_INTERVAL);
+      }
+      Serial.print("PROTO_OK,SPARSE,");
+      Serial.println(sparseSyncInterval);
+    } else if (command == "PROTO,TEXT") { // Switch back to "S,..." text status lines
+      binaryFrames = false;
+      sparseFrames = false;
+      serialUpdateInterval = SERIAL_UPDATE_INTERVAL;
+      Serial.print("PROTO_OK,TEXT,");
+      Serial.println(serialUpdateInterval);
     } else if (command.startsWith("SET,")) { // Command to set phase duration
       int comma1 = command.indexOf(',');
       int comma2 = command.indexOf(',', comma1 + 1);
@@ -133,8 +184,14 @@ void loop() {
       } else if (color_type == "RED") {
         current_opposing_red_duration_ms = new_duration_ms;
         // Calculate green duration based on the new opposing red duration.
-        // It's `red_duration - yellow_duration` because opposing_red_duration is (green_duration + yellow_duration)
-        current_active_green_duration_ms = current_opposing_red_duration_ms - YELLOW_DURATION_MS;
+        // It's `red_duration - yellow_duration` because opposing_red_duration is (green_duration + yellow_duration).
+        // Compare before subtracting: red < yellow would wrap the unsigned subtraction around
+        // (and red = 0 would make the total cycle 0, dividing by zero in the cycle computation).
+        if (current_opposing_red_duration_ms >= YELLOW_DURATION_MS) {
+          current_active_green_duration_ms = current_opposing_red_duration_ms - YELLOW_DURATION_MS;
+        } else {
+          current_active_green_duration_ms = 0;
+        }
         
         // Ensure minimum green duration is 1 second
         if (current_active_green_duration_ms < 1000) {
@@ -154,10 +211,13 @@ void loop() {
       current_total_cycle_duration_ms = current_active_green_duration_ms + YELLOW_DURATION_MS + current_opposing_red_duration_ms;
       cycleStartTime = millis(); // Restart cycle to apply new times immediately
     }
+    forceStatus = true; // Sparse mode: report the (possibly restarted) cycle right away
   }
 
-  // Send current light status via Serial periodically
-  if (millis() - lastSerialUpdate >= SERIAL_UPDATE_INTERVAL) {
+  // Send current light status via Serial periodically (sparse mode: on changes and sync interval)
+  if (sparseFrames) {
+    sendSparseStatus();
+  } else if (millis() - lastSerialUpdate >= serialUpdateInterval) {
     sendSerialStatus();
     lastSerialUpdate = millis();
   }
@@ -189,15 +249,13 @@ void loop() {
         digitalWrite(m1Green, LOW); digitalWrite(m1Yellow, HIGH); digitalWrite(m1Red, LOW);
         digitalWrite(m2Green, LOW); digitalWrite(m2Yellow, LOW); digitalWrite(m2Red, HIGH); // Mạch 2 remains Red or goes to Red
       } else if (pendingMode == 3) { // Preparing for Both Reds (lights that are green will turn yellow)
-        // If m1 was green, turn yellow, else keep current state (likely red)
-        digitalWrite(m1Yellow, (digitalRead(m1Green) == HIGH) ? HIGH : LOW);
-        digitalWrite(m1Green, LOW); // Turn off green
-        digitalWrite(m1Red, (digitalRead(m1Yellow) == LOW && digitalRead(m1Green) == LOW) ? HIGH : LOW); // Ensure red is on if not yellow/green
-
-        // If m2 was green, turn yellow, else keep current state (likely red)
-        digitalWrite(m2Yellow, (digitalRead(m2Green) == HIGH) ? HIGH : LOW);
-        digitalWrite(m2Green, LOW); // Turn off green
-        digitalWrite(m2Red, (digitalRead(m2Yellow) == LOW && digitalRead(m2Green) == LOW) ? HIGH : LOW); // Ensure red is on if not yellow/green
+        // A light that is green or already yellow stays yellow for the whole transition
+        // (checking only green would drop it to red on the next loop, skipping the yellow phase)
+        bool m1Amber = digitalRead(m1Green) == HIGH || digitalRead(m1Yellow) == HIGH;
+        digitalWrite(m1Green, LOW); digitalWrite(m1Yellow, m1Amber ? HIGH : LOW); digitalWrite(m1Red, m1Amber ? LOW : HIGH);
+
+        bool m2Amber = digitalRead(m2Green) == HIGH || digitalRead(m2Yellow) == HIGH;
+        digitalWrite(m2Green, LOW); digitalWrite(m2Yellow, m2Amber ? HIGH : LOW); digitalWrite(m2Red, m2Amber ? LOW : HIGH);
       }
       displayDigitsCircuit1(0); // Hiển thị 00 trên cả hai màn hình trong pha vàng chuyển tiếp
       displayDigitsCircuit2(0);
@@ -299,15 +357,15 @@ void displayDigitsCircuit2(int time_val) {
 }
 
 /**
- * @brief Sends current traffic light status over Serial.
- * Data is sent in the format "S,<m1_color>,<m1_time>,<m2_color>,<m2_time>".
+ * @brief Computes the current colors and remaining phase time (milliseconds) of both circuits.
+ * Shared by the periodic "S,..." / binary status and the sparse status frames.
  */
-void sendSerialStatus() {
-  String m1_color, m2_color;
-  int m1_time = 0, m2_time = 0;
+void computeStatus(String &m1_color, unsigned long &m1_ms, String &m2_color, unsigned long &m2_ms) {
+  m1_ms = m2_ms = 0;
 
   if (yellowPhase) { // Currently in emergency transition yellow phase
-    m1_time = m2_time = (YELLOW_DURATION_MS - (millis() - yellowStartTime)) / 1000;
+    unsigned long elapsed = millis() - yellowStartTime;
+    m1_ms = m2_ms = (elapsed < YELLOW_DURATION_MS) ? YELLOW_DURATION_MS - elapsed : 0;
     if (pendingMode == 1) { // Preparing for Circuit 1 Green (Circuit 2 Yellow, Circuit 1 Red)
       m1_color = "RED";
       m2_color = "YELLOW";
@@ -315,8 +373,8 @@ void sendSerialStatus() {
       m1_color = "YELLOW";
       m2_color = "RED";
     } else if (pendingMode == 3) { // Preparing for Both Reds (lights that are green will turn yellow)
-      m1_color = (digitalRead(m1Green) == HIGH) ? "YELLOW" : "RED";
-      m2_color = (digitalRead(m2Green) == HIGH) ? "YELLOW" : "RED";
+      m1_color = (digitalRead(m1Green) == HIGH || digitalRead(m1Yellow) == HIGH) ? "YELLOW" : "RED";
+      m2_color = (digitalRead(m2Green) == HIGH || digitalRead(m2Yellow) == HIGH) ? "YELLOW" : "RED";
     }
   } else if (emergencyMode == 1) { // Emergency mode: Circuit 1 Green
     m1_color = "GREEN"; m2_color = "RED";
@@ -330,31 +388,47 @@ void sendSerialStatus() {
     // Phase 1: Circuit 1 Red, Circuit 2 Green (then Yellow)
     if (cycleTime < current_opposing_red_duration_ms) {
       m1_color = "RED";
-      m1_time = (current_opposing_red_duration_ms - cycleTime) / 1000;
+      m1_ms = current_opposing_red_duration_ms - cycleTime;
 
       if (cycleTime < current_active_green_duration_ms) {
         m2_color = "GREEN";
-        m2_time = (current_active_green_duration_ms - cycleTime) / 1000;
+        m2_ms = current_active_green_duration_ms - cycleTime;
       } else {
         m2_color = "YELLOW";
-        m2_time = (current_opposing_red_duration_ms - cycleTime) / 1000;
+        m2_ms = current_opposing_red_duration_ms - cycleTime;
       }
     }
     // Phase 2: Circuit 1 Green (then Yellow), Circuit 2 Red
     else {
       unsigned long phase2_time = cycleTime - current_opposing_red_duration_ms;
       m2_color = "RED";
-      m2_time = (current_total_cycle_duration_ms - cycleTime) / 1000;
+      m2_ms = current_total_cycle_duration_ms - cycleTime;
 
       if (phase2_time < current_active_green_duration_ms) {
         m1_color = "GREEN";
-        m1_time = (current_active_green_duration_ms - phase2_time) / 1000;
+        m1_ms = current_active_green_duration_ms - phase2_time;
       } else {
         m1_color = "YELLOW";
-        m1_time = (current_total_cycle_duration_ms - cycleTime) / 1000;
+        m1_ms = current_total_cycle_duration_ms - cycleTime;
       }
     }
   }
+}
+
+/**
+ * @brief Sends current traffic light status over Serial.
+ * Data is sent in the format "S,<m1_color>,<m1_time>,<m2_color>,<m2_time>".
+ */
+void sendSerialStatus() {
+  String m1_color, m2_color;
+  unsigned long m1_ms, m2_ms;
+  computeStatus(m1_color, m1_ms, m2_color, m2_ms);
+  int m1_time = m1_ms / 1000, m2_time = m2_ms / 1000;
+
+  if (binaryFrames) {
+    sendBinaryStatus(m1_color, m1_time, m2_color, m2_time);
+    return;
+  }
 
   // Print status string to Serial
   Serial.print("S,"); Serial.print(m1_color); Serial.print(",");
@@ -363,6 +437,75 @@ void sendSerialStatus() {
   Serial.println(m2_time);
 }
 
+/**
+ * @brief Sparse status (negotiated with "PROTO,SPARSE"): sends a frame only when a color or the
+ * emergency mode changes, after a command, or every sparseSyncInterval as a sync frame.
+ * Format: "S,<m1_color>,<m1_time>,<m2_color>,<m2_time>,<m1_ms>,<m2_ms>" (remaining time in milliseconds),
+ * so the GUI can run the countdown locally between frames.
+ */
+void sendSparseStatus() {
+  String m1_color, m2_color;
+  unsigned long m1_ms, m2_ms;
+  computeStatus(m1_color, m1_ms, m2_color, m2_ms);
+
+  if (!forceStatus && m1_color == lastSentM1Color && m2_color == lastSentM2Color
+      && emergencyMode == lastSentMode && millis() - lastSerialUpdate < sparseSyncInterval) {
+    return;
+  }
+  forceStatus = false;
+  lastSentM1Color = m1_color;
+  lastSentM2Color = m2_color;
+  lastSentMode = emergencyMode;
+  lastSerialUpdate = millis();
+
+  Serial.print("S,"); Serial.print(m1_color); Serial.print(",");
+  Serial.print(m1_ms / 1000); Serial.print(",");
+  Serial.print(m2_color); Serial.print(",");
+  Serial.print(m2_ms / 1000); Serial.print(",");
+  Serial.print(m1_ms); Serial.print(",");
+  Serial.println(m2_ms);
+}
+
+/**
+ * @brief Converts a color name to its binary frame code.
+ */
+byte colorCode(const String &color) {
+  if (color == "GREEN") return COLOR_GREEN;
+  if (color == "YELLOW") return COLOR_YELLOW;
+  return COLOR_RED;
+}
+
+/**
+ * @brief CRC-8 with polynomial 0x07 and initial value 0 (same as crc8() in protocol.py).
+ */
+byte crc8(const byte *data, int len) {
+  byte crc = 0;
+  for (int i = 0; i < len; i++) {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (byte)((crc << 1) ^ 0x07) : (byte)(crc << 1);
+    }
+  }
+  return crc;
+}
+
+/**
+ * @brief Sends current traffic light status as an 8-byte binary frame.
+ * Used instead of the "S,..." text line after the GUI negotiated "PROTO,BIN".
+ */
+void sendBinaryStatus(const String &m1_color, int m1_time, const String &m2_color, int m2_time) {
+  byte frame[8];
+  frame[0] = FRAME_SYNC;
+  frame[1] = frameSeq++;
+  frame[2] = colorCode(m1_color);
+  frame[3] = (byte)constrain(m1_time, 0, 255);
+  frame[4] = colorCode(m2_color);
+  frame[5] = (byte)constrain(m2_time, 0, 255);
+  frame[6] = (byte)((emergencyMode & 0x03) | (yellowPhase ? 0x04 : 0));
+  frame[7] = crc8(frame + 1, 6);
+  Serial.write(frame, sizeof(frame));
+}
+
 /**
  * @brief Interrupt service routine (ISR) for emergency button 1 (Circuit 1 green).
  * Activates Circuit 1 emergency mode. If Circuit 2 is currently green, it will transition through yellow for 2 seconds.